@@ -2,6 +2,7 @@ from fastapi import APIRouter, HTTPException, Depends, status
 from sqlalchemy.orm import Session
 from app.models import User
 from app.database import get_db
+from app.schemas import LoginResult
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -12,7 +13,7 @@ class UserLogin(BaseModel):
     password: str
 
 
-@router.post("/login")
+@router.post("/login", response_model=LoginResult)
 def login(user: UserLogin, db: Session = Depends(get_db)):
     db_user = db.query(User).filter(User.username == user.username).first()
     if db_user is None or db_user.password != user.password:
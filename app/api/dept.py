@@ -1,5 +1,8 @@
+from contextlib import contextmanager
+
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import or_
+from sqlalchemy import or_, select
 from app.models import (
     Dept,
     ExpenseParticipant,
@@ -8,10 +11,30 @@ from app.models import (
     User,
     GroupMembership,
 )
-from app.database import get_db
-from fastapi import APIRouter, HTTPException, Depends
+from app.database import get_async_db, get_db
+from app.balances import (
+    new_deltas,
+    rebuild_member_balances,
+    record_dept_change,
+    update_member_balances,
+)
+from app.idempotency import Idempotency
+from app.ledger import dept_entry, snapshot_if_due
+from app.locks import locked_group
+from app.metrics import count_dept_payment
+from app.pagination import (
+    DEFAULT_PAGE_SIZE,
+    count_query,
+    page_query,
+    page_rows,
+    select_fields,
+)
+from app.schemas import DeptOut, Message, SimplifyResult
+from app.settlement import net_balances, simplify_debts
+from app.streaming import stream_rows_async, wants_ndjson
+from fastapi import APIRouter, HTTPException, Depends, Header, Response
 from pydantic import BaseModel
-from typing import List
+from typing import Annotated, Dict, List, Optional, Union
 
 
 class DeptCreate(BaseModel):
@@ -28,26 +51,112 @@ class DeptPaid(BaseModel):
 router = APIRouter()
 
 
-@router.get("/{group_id}")
-def list_group_depts(group_id: int, db: Session = Depends(get_db)):
-    depts = db.query(Dept).filter(Dept.group_id == group_id).all()
-    if not depts:
+@contextmanager
+def locked_dept(db, dept_id):
+    """Hold the write lock of the dept's group and yield the dept."""
+    group_id = db.query(Dept.group_id).filter(Dept.dept_id == dept_id).scalar()
+    if group_id is None:
+        raise HTTPException(status_code=404, detail="Dept not found")
+
+    with locked_group(db, group_id):
+        # Loaded under the lock, a concurrent payment may have settled it
+        dept = db.query(Dept).filter(Dept.dept_id == dept_id).first()
+        if dept is None:
+            raise HTTPException(status_code=404, detail="Dept not found")
+        yield dept
+
+
+@router.get(
+    "/{group_id}",
+    response_model=Union[List[DeptOut], Dict],
+    response_model_exclude_unset=True,
+)
+async def list_group_depts(
+    group_id: int,
+    response: Response,
+    fields: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    count: bool = True,
+    accept: Annotated[Optional[str], Header()] = None,
+    db: AsyncSession = Depends(get_async_db),
+):
+    statement = select(*select_fields(Dept, DeptOut, fields)).where(
+        Dept.group_id == group_id
+    )
+    if wants_ndjson(accept):
+        return stream_rows_async(db, statement, Dept.dept_id, cursor)
+    if count:
+        total = await db.scalar(count_query(statement))
+        response.headers["X-Total-Count"] = str(total)
+    rows = (
+        await db.execute(page_query(statement, Dept.dept_id, limit, cursor))
+    ).all()
+    if not rows and cursor is None:
+        # A group without depts, a page past the last one is just empty
         return {}
-    return depts
+    return page_rows(rows, Dept.dept_id, limit, response)
 
 
-@router.get("/{group_id}/{user_id}")
-def list_user_depts(
-    group_id: int, user_id: int, db: Session = Depends(get_db)
+@router.post("/{group_id}/simplify", response_model=SimplifyResult)
+def simplify_group_depts(
+    group_id: int, persist: bool = False, db: Session = Depends(get_db)
+):
+    with locked_group(db, group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+
+        depts = db.query(Dept).filter(Dept.group_id == group_id).all()
+        transfers = simplify_debts(net_balances(depts))
+
+        if persist:
+            # Replace the group's depts with the transfers in one
+            # transaction. The ledger closes the old depts and opens the
+            # new ones, the balances don't change.
+            db.add_all(dept_entry(d, -d.amount, "simplify") for d in depts)
+            for dept in depts:
+                db.delete(dept)
+            db.flush()
+
+            new_depts = [
+                Dept(
+                    user_id=user_id,
+                    lender_id=lender_id,
+                    group_id=group_id,
+                    amount=amount,
+                )
+                for user_id, lender_id, amount in transfers
+            ]
+            db.add_all(new_depts)
+            db.flush()
+            db.add_all(dept_entry(d, d.amount, "simplify") for d in new_depts)
+            rebuild_member_balances(db, group_id)
+            snapshot_if_due(db, group_id)
+            db.commit()
+
+    return {
+        "depts_before": len(depts),
+        "depts_after": len(transfers),
+        "persisted": persist,
+        "transfers": [
+            {"user_id": user_id, "lender_id": lender_id, "amount": amount}
+            for user_id, lender_id, amount in transfers
+        ],
+    }
+
+
+@router.get("/{group_id}/{user_id}", response_model=List[DeptOut])
+async def list_user_depts(
+    group_id: int, user_id: int, db: AsyncSession = Depends(get_async_db)
 ):
     depts = (
-        db.query(Dept)
-        .filter(
-            Dept.group_id == group_id,
-            or_(Dept.user_id == user_id, Dept.lender_id == user_id),
+        await db.scalars(
+            select(Dept).where(
+                Dept.group_id == group_id,
+                or_(Dept.user_id == user_id, Dept.lender_id == user_id),
+            )
         )
-        .all()
-    )
+    ).all()
     if not depts:
         raise HTTPException(
             status_code=404, detail="No depts found for the given user ID"
@@ -55,38 +164,63 @@ def list_user_depts(
     return depts
 
 
-@router.delete("/{dept_id}")
+@router.delete("/{dept_id}", response_model=Message)
 def delete_dept(dept_id: int, db: Session = Depends(get_db)):
-    dept = db.query(Dept).filter(Dept.dept_id == dept_id).first()
-
-    if dept is None:
-        raise HTTPException(status_code=404, detail="Dept not found")
-
-    db.delete(dept)
-    db.commit()
+    with locked_dept(db, dept_id) as dept:
+        deltas = new_deltas()
+        record_dept_change(deltas, dept.user_id, dept.lender_id, -dept.amount)
+        update_member_balances(db, dept.group_id, deltas)
+        db.add(dept_entry(dept, -dept.amount, "dept_deleted"))
+        snapshot_if_due(db, dept.group_id)
+
+        db.delete(dept)
+        db.commit()
     return {"message": "Dept deleted successfully"}
 
 
-@router.patch("/{dept_id}")
+@router.patch("/{dept_id}", response_model=Message)
 def update_dept_amount(
-    dept_id: int, dept_paid: DeptPaid, db: Session = Depends(get_db)
+    dept_id: int,
+    dept_paid: DeptPaid,
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
+    db: Session = Depends(get_db),
 ):
-    existing_dept = db.query(Dept).filter(Dept.dept_id == dept_id).first()
-
-    if existing_dept is None:
-        raise HTTPException(status_code=404, detail="Dept not found")
-
-    existing_dept.amount = existing_dept.amount - dept_paid.amount
-
-    if existing_dept.amount <= 0:
-        db.delete(existing_dept)
-        db.commit()
-        return {"message": "Dept completely paid successfully"}
-    else:
-        db.commit()
-        db.refresh(existing_dept)
-        return {
-            "message": "Dept updated successfully, amount left: {}".format(
+    idempotency = Idempotency(
+        db, idempotency_key, "PATCH", f"/dept/{dept_id}", dept_paid.dict()
+    )
+    with idempotency.hold():
+        # Checked first, the dept of a replayed payment may be gone
+        replayed = idempotency.replay()
+        if replayed is not None:
+            return replayed
+        return _pay_dept(db, dept_id, dept_paid, idempotency)
+
+
+def _pay_dept(db, dept_id, dept_paid, idempotency):
+    with locked_dept(db, dept_id) as existing_dept:
+        # Paying more than is owed settles the dept, the rest is dropped
+        paid = min(dept_paid.amount, existing_dept.amount)
+        deltas = new_deltas()
+        record_dept_change(
+            deltas, existing_dept.user_id, existing_dept.lender_id, -paid
+        )
+        update_member_balances(db, existing_dept.group_id, deltas)
+        db.add(dept_entry(existing_dept, -paid, "payment"))
+        snapshot_if_due(db, existing_dept.group_id)
+
+        existing_dept.amount = existing_dept.amount - dept_paid.amount
+        settled = existing_dept.amount <= 0
+
+        if settled:
+            db.delete(existing_dept)
+            message = "Dept completely paid successfully"
+        else:
+            message = "Dept updated successfully, amount left: {}".format(
                 existing_dept.amount
             )
-        }
+
+        response = idempotency.save({"message": message})
+        db.commit()
+
+    count_dept_payment(paid, settled)
+    return response
@@ -1,5 +1,17 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy import and_, or_
+import csv
+import itertools
+import json
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Depends,
+    Header,
+    Response,
+    UploadFile,
+)
+from sqlalchemy import and_, or_, select
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session, joinedload
 from app.models import (
     Dept,
@@ -9,7 +21,25 @@ from app.models import (
     GroupMembership,
 )
 from app.database import get_db
-from pydantic import BaseModel
+from app.balances import new_deltas, update_member_balances
+from app.idempotency import Idempotency
+from app.ledger import expense_entries, expense_shares, snapshot_if_due
+from app.locks import add_to_group, locked_group
+from app.metrics import count_expenses_created
+from app.money import split_amount
+from app.pagination import DEFAULT_PAGE_SIZE, fetch_page, select_fields
+from app.reconcile import split_expense
+from app.schemas import (
+    BatchResult,
+    ExpenseDetail,
+    ExpenseOut,
+    ImportProgress,
+    Message,
+    ParticipantOut,
+)
+from app.streaming import stream_rows, wants_ndjson
+from pydantic import BaseModel, ValidationError
+from typing import Annotated, List, Optional
 
 
 class ExpenseCreate(BaseModel):
@@ -25,22 +55,241 @@ class CreateExpenseParticipant(BaseModel):
     amount_paid: int
 
 
+class ExpenseBatch(BaseModel):
+    group_id: int
+    expenses: List[ExpenseCreate]
+    atomic: bool = False
+
+
 class CreateDept(BaseModel):
     user_id: int
     lender_id: int
     group_id: int
-    amount: float
+    amount: int
 
 
+IMPORT_FORMATS = ("csv", "ndjson", "jsonl")
+MAX_IMPORT_ERRORS = 100
+MAX_IMPORT_CHUNK_SIZE = 5000
+
 router = APIRouter()
 
 
-@router.get("/")
-def get_expenses(db: Session = Depends(get_db)):
-    return db.query(Expense).all()
+def _expense_data(db_expense):
+    return {
+        "expense_id": db_expense.expense_id,
+        "group_id": db_expense.group_id,
+        "description": db_expense.description,
+        "amount": db_expense.amount,
+        "created_by": db_expense.created_by,
+        "created_at": db_expense.created_at,
+    }
+
+
+class _Unreadable:
+    """Yielded by ``_read_rows`` where the rest of an upload can't be read."""
+
+    def __init__(self, detail):
+        self.detail = detail
+
+
+def _decode_lines(binary):
+    # Line by line, so an invalid byte is reported at the row it is in
+    for line in binary:
+        yield line.decode("utf-8")
+
+
+def _ndjson_rows(lines):
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def _read_rows(binary, file_format):
+    lines = _decode_lines(binary)
+    try:
+        if file_format == "csv":
+            yield from csv.DictReader(lines)
+        else:
+            yield from _ndjson_rows(lines)
+    except UnicodeDecodeError:
+        yield _Unreadable("Invalid UTF-8")
+    except csv.Error as exc:
+        yield _Unreadable(f"Invalid CSV: {exc}")
+
+
+def _parse_row(row, group_id, member_set):
+    """Return ``(item, error)`` for one imported row of ``group_id``."""
+    try:
+        item = ExpenseCreate(**{"group_id": group_id, **row})
+    except (TypeError, ValidationError):
+        return None, "Invalid row"
+
+    if item.group_id != group_id:
+        return None, "Wrong group"
+    if item.created_by not in member_set:
+        return None, "User not in Group"
+    return item, None
+
+
+def _create_expenses(db, group, member_ids, items):
+    """Insert ``items`` for ``group`` and apply their splits.
+
+    The group's depts are loaded once for all of the items. Nothing is
+    committed, that is left to the caller.
+    """
+    db_expenses = [Expense(**item.dict()) for item in items]
+    db.add_all(db_expenses)
+    db.flush()
+
+    depts = db.query(Dept).filter(Dept.group_id == group.group_id).all()
+    dept_index, amounts = _dept_amounts(depts)
+
+    deltas = new_deltas()
+    changed = set()
+    for db_expense in db_expenses:
+        shares = split_amount(
+            db_expense.amount, member_ids, db_expense.expense_id
+        )
+        changed |= split_expense(
+            amounts, db_expense.created_by, shares, deltas
+        )
+        db.add_all(expense_entries(db_expense, shares))
+    # Written once for the whole batch
+    _save_depts(db, group.group_id, dept_index, amounts, changed)
+    update_member_balances(db, group.group_id, deltas)
+    snapshot_if_due(db, group.group_id)
+
+    add_to_group(
+        db, group.group_id, total_expenses=sum(e.amount for e in db_expenses)
+    )
+    return db_expenses
+
+
+def _fail_row(progress, row_number, detail):
+    progress["failed"] += 1
+    if len(progress["errors"]) < MAX_IMPORT_ERRORS:
+        progress["errors"].append({"row": row_number, "detail": detail})
+
+
+def _import_rows(db, group, member_ids, rows, chunk_size, offset):
+    """Validate ``rows`` and commit them for ``group`` in chunks.
+
+    Returns the import progress. A database error or an unreadable row
+    stops the import after the rows read so far, ``next_offset`` tells
+    where to resume.
+    """
+    member_set = set(member_ids)
+    progress = {
+        "rows_read": 0,
+        "imported": 0,
+        "failed": 0,
+        "chunks_committed": 0,
+        "next_offset": offset,
+        "complete": False,
+        "errors": [],
+    }
+
+    def commit_chunk(chunk, row_number):
+        if chunk:
+            with locked_group(db, group.group_id):
+                _create_expenses(db, group, member_ids, chunk)
+                db.commit()
+            count_expenses_created(len(chunk))
+            progress["imported"] += len(chunk)
+            progress["chunks_committed"] += 1
+        progress["next_offset"] = row_number
+
+    chunk = []
+    row_number = offset
+    try:
+        for row in rows:
+            row_number += 1
+            if isinstance(row, _Unreadable):
+                _fail_row(progress, row_number, row.detail)
+                commit_chunk(chunk, row_number - 1)
+                return progress
+
+            progress["rows_read"] += 1
+            item, error = _parse_row(row, group.group_id, member_set)
+            if error:
+                _fail_row(progress, row_number, error)
+            else:
+                chunk.append(item)
+
+            if len(chunk) >= chunk_size:
+                commit_chunk(chunk, row_number)
+                chunk = []
+
+        commit_chunk(chunk, row_number)
+        progress["complete"] = True
+    except SQLAlchemyError:
+        # Everything up to next_offset is committed, the client can resume
+        db.rollback()
+
+    return progress
+
+
+def _save_depts(db, group_id, dept_index, amounts, keys):
+    """Write the amounts of ``keys`` back to the group's Dept rows.
+
+    ``dept_index`` maps ``(lender_id, user_id)`` to the rows that
+    ``amounts`` was loaded from, see ``_dept_amounts``. Rows are updated
+    in place, added or deleted, and ``dept_index`` follows them.
+    """
+    for key in sorted(keys):
+        amount = amounts.get(key)
+        dept = dept_index.get(key)
+        if amount is None:
+            if dept is not None:
+                db.delete(dept_index.pop(key))
+        elif dept is None:
+            lender_id, user_id = key
+            dept_index[key] = Dept(
+                user_id=user_id,
+                lender_id=lender_id,
+                group_id=group_id,
+                amount=amount,
+            )
+            db.add(dept_index[key])
+        elif dept.amount != amount:
+            dept.amount = amount
+
+
+def _dept_amounts(depts):
+    """Index of ``depts`` and their amounts, for ``app.reconcile``."""
+    dept_index = {(d.lender_id, d.user_id): d for d in depts}
+    return dept_index, {key: d.amount for key, d in dept_index.items()}
 
 
-@router.get("/{expense_id}")
+@router.get(
+    "/", response_model=List[ExpenseOut], response_model_exclude_unset=True
+)
+def get_expenses(
+    response: Response,
+    group_id: Optional[int] = None,
+    fields: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    count: bool = True,
+    accept: Annotated[Optional[str], Header()] = None,
+    db: Session = Depends(get_db),
+):
+    statement = select(*select_fields(Expense, ExpenseOut, fields))
+    if group_id is not None:
+        statement = statement.where(Expense.group_id == group_id)
+    if wants_ndjson(accept):
+        return stream_rows(db, statement, Expense.expense_id, cursor)
+    return fetch_page(
+        db, statement, Expense.expense_id, response, limit, cursor, count
+    )
+
+
+@router.get("/{expense_id}", response_model=ExpenseDetail)
 def get_expense(expense_id: int, db: Session = Depends(get_db)):
     expense = (
         db.query(Expense)
@@ -53,8 +302,24 @@ def get_expense(expense_id: int, db: Session = Depends(get_db)):
     return expense
 
 
-@router.post("/")
-def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
+@router.post("/", response_model=ExpenseOut)
+def create_expense(
+    expense: ExpenseCreate,
+    idempotency_key: Annotated[Optional[str], Header(max_length=255)] = None,
+    db: Session = Depends(get_db),
+):
+    idempotency = Idempotency(
+        db, idempotency_key, "POST", "/expenses", expense.dict()
+    )
+    with idempotency.hold():
+        # A retry gets the first response, the depts are left alone
+        replayed = idempotency.replay()
+        if replayed is not None:
+            return replayed
+        return _create_expense(db, expense, idempotency)
+
+
+def _create_expense(db, expense, idempotency):
     if (
         db.query(GroupMembership)
         .filter(
@@ -68,177 +333,208 @@ def create_expense(expense: ExpenseCreate, db: Session = Depends(get_db)):
     ):
         raise HTTPException(status_code=404, detail="User not in Group")
 
-    group = db.query(Group).filter(Group.group_id == expense.group_id).first()
-    if group is None:
-        raise HTTPException(status_code=404, detail="Group not found")
+    # The expense, the group total and the depts below are written in a
+    # single transaction under the group's write lock, see app.locks
+    with locked_group(db, expense.group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
 
-    db_expense = Expense(**expense.dict())
-    db.add(db_expense)
-    db.commit()
+        db_expense = Expense(**expense.dict())
+        db.add(db_expense)
+        db.flush()
 
-    # Update total expense of the group
-    group.total_expenses += expense.amount
-    db.commit()
+        # Update total expense of the group
+        add_to_group(db, group.group_id, total_expenses=expense.amount)
 
-    db.refresh(db_expense)
-    expense_data = {
-        "expense_id": db_expense.expense_id,
-        "group_id": db_expense.group_id,
-        "description": db_expense.description,
-        "amount": db_expense.amount,
-        "created_by": db_expense.created_by,
-        "created_at": db_expense.created_at,
-    }
+        expense_data = _expense_data(db_expense)
 
-    # Update dept of group members
-    mean_value = expense.amount / group.total_members
-
-    members = (
-        db.query(GroupMembership.user_id)
-        .filter(GroupMembership.group_id == db_expense.group_id)
-        .all()
-    )
-    member_ids = [m.user_id for m in members]
+        # Update dept of group members
+        members = (
+            db.query(GroupMembership.user_id)
+            .filter(GroupMembership.group_id == db_expense.group_id)
+            .all()
+        )
+        shares = split_amount(
+            expense.amount, [m.user_id for m in members], db_expense.expense_id
+        )
 
-    depts = (
-        db.query(Dept)
-        .filter(
-            Dept.group_id == db_expense.group_id,
-            or_(
-                Dept.lender_id == db_expense.created_by,
-                Dept.user_id == db_expense.created_by,
-            ),
+        depts = (
+            db.query(Dept)
+            .filter(
+                Dept.group_id == db_expense.group_id,
+                or_(
+                    Dept.lender_id == db_expense.created_by,
+                    Dept.user_id == db_expense.created_by,
+                ),
+            )
+            .all()
         )
-        .all()
-    )
 
-    dept_index = {(d.lender_id, d.user_id): d for d in depts}
+        dept_index, amounts = _dept_amounts(depts)
+        deltas = new_deltas()
+        changed = split_expense(amounts, db_expense.created_by, shares, deltas)
+        _save_depts(db, group.group_id, dept_index, amounts, changed)
+        db.add_all(expense_entries(db_expense, shares))
+        update_member_balances(db, db_expense.group_id, deltas)
+        snapshot_if_due(db, db_expense.group_id)
 
-    for member_id in member_ids:
-        if member_id == db_expense.created_by:
-            continue
+        idempotency.save(expense_data)
+        db.commit()
+
+    count_expenses_created()
+    return expense_data
+
+
+@router.post("/batch", response_model=BatchResult)
+def create_expenses_batch(batch: ExpenseBatch, db: Session = Depends(get_db)):
+    with locked_group(db, batch.group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
 
-        key_by_payer = (db_expense.created_by, member_id)
-        key_to_payer = (member_id, db_expense.created_by)
-
-        flag = False
-        if key_by_payer in dept_index:
-            dept_index[key_by_payer].amount += mean_value
-            flag = True
-
-        if key_to_payer in dept_index:
-            flag = True
-            if dept_index[key_to_payer].amount > mean_value:
-                dept_index[key_to_payer].amount -= mean_value
-            elif mean_value - dept_index[key_to_payer].amount >= 0.01:
-                new_dept = Dept(
-                    user_id=member_id,
-                    lender_id=db_expense.created_by,
-                    group_id=db_expense.group_id,
-                    amount=mean_value - dept_index[key_to_payer].amount,
-                )
-                db.add(new_dept)
-                db.delete(dept_index[key_to_payer])
+        members = (
+            db.query(GroupMembership.user_id)
+            .filter(GroupMembership.group_id == batch.group_id)
+            .all()
+        )
+        member_ids = [m.user_id for m in members]
+        member_set = set(member_ids)
+
+        # Validate everything up front so an atomic batch fails before writing
+        valid, errors = [], []
+        for index, item in enumerate(batch.expenses):
+            if item.group_id != batch.group_id:
+                errors.append({"index": index, "detail": "Wrong group"})
+            elif item.created_by not in member_set:
+                errors.append({"index": index, "detail": "User not in Group"})
             else:
-                db.delete(dept_index[key_to_payer])
-
-        if not flag:
-            new_dept = Dept(
-                user_id=member_id,
-                lender_id=db_expense.created_by,
-                group_id=db_expense.group_id,
-                amount=mean_value,
-            )
-            db.add(new_dept)
+                valid.append(item)
 
-    db.commit()
+        if errors and batch.atomic:
+            raise HTTPException(status_code=400, detail=errors)
 
-    return expense_data
+        db_expenses = _create_expenses(db, group, member_ids, valid)
+        created = [_expense_data(e) for e in db_expenses]
+        db.commit()
 
+    count_expenses_created(len(created))
 
-# Delete an expense
-@router.delete("/{expense_id}")
-def delete_expense(expense_id: int, db: Session = Depends(get_db)):
-    expense = (
-        db.query(Expense).filter(Expense.expense_id == expense_id).first()
-    )
-    if expense is None:
-        raise HTTPException(status_code=404, detail="Expense not found")
+    return {"created": created, "errors": errors}
 
-    # Update total expense of the group
-    group_id = expense.group_id
-    group = db.query(Group).filter(Group.group_id == group_id).first()
 
-    group.total_expenses -= expense.amount
-    db.commit()
+@router.post("/import", response_model=ImportProgress)
+def import_expenses(
+    group_id: int,
+    file: UploadFile,
+    chunk_size: int = 500,
+    offset: int = 0,
+    db: Session = Depends(get_db),
+):
+    if not 1 <= chunk_size <= MAX_IMPORT_CHUNK_SIZE or offset < 0:
+        raise HTTPException(
+            status_code=400, detail="Invalid chunk_size or offset"
+        )
 
-    # Update dept of group members
-    mean_value = expense.amount / group.total_members
+    file_format = (file.filename or "").rsplit(".", 1)[-1].lower()
+    if file_format not in IMPORT_FORMATS:
+        raise HTTPException(status_code=400, detail="Unsupported file type")
+
+    group = db.query(Group).filter(Group.group_id == group_id).first()
+    if group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
 
     members = (
         db.query(GroupMembership.user_id)
-        .filter(GroupMembership.group_id == expense.group_id)
+        .filter(GroupMembership.group_id == group_id)
         .all()
     )
     member_ids = [m.user_id for m in members]
 
-    depts = (
-        db.query(Dept)
-        .filter(
-            Dept.group_id == expense.group_id,
-            or_(
-                Dept.lender_id == expense.created_by,
-                Dept.user_id == expense.created_by,
-            ),
-        )
+    # Rows are parsed one at a time from the spooled upload and written in
+    # chunks, so memory use depends on chunk_size rather than file size
+    rows = itertools.islice(_read_rows(file.file, file_format), offset, None)
+    return _import_rows(db, group, member_ids, rows, chunk_size, offset)
+
+
+def _current_shares(db, expense):
+    members = (
+        db.query(GroupMembership.user_id)
+        .filter(GroupMembership.group_id == expense.group_id)
         .all()
     )
+    return split_amount(
+        expense.amount, [m.user_id for m in members], expense.expense_id
+    )
 
-    dept_index = {(d.lender_id, d.user_id): d for d in depts}
 
-    for member_id in member_ids:
-        if member_id == expense.created_by:
-            continue
+# Delete an expense
+@router.delete("/{expense_id}", response_model=Message)
+def delete_expense(expense_id: int, db: Session = Depends(get_db)):
+    group_id = (
+        db.query(Expense.group_id)
+        .filter(Expense.expense_id == expense_id)
+        .scalar()
+    )
+    if group_id is None:
+        raise HTTPException(status_code=404, detail="Expense not found")
 
-        key_by_payer = (expense.created_by, member_id)
-        key_to_payer = (member_id, expense.created_by)
-
-        if key_to_payer in dept_index:
-            dept_index[key_to_payer].amount += mean_value
-
-        if key_by_payer in dept_index:
-            if dept_index[key_by_payer].amount > mean_value:
-                dept_index[key_by_payer].amount -= mean_value
-            elif mean_value - dept_index[key_by_payer].amount >= 0.01:
-                new_dept = Dept(
-                    user_id=expense.created_by,
-                    lender_id=member_id,
-                    group_id=expense.group_id,
-                    amount=mean_value - dept_index[key_by_payer].amount,
-                )
-                db.add(new_dept)
-                db.delete(dept_index[key_by_payer])
-            else:
-                db.delete(dept_index[key_by_payer])
+    with locked_group(db, group_id):
+        # Loaded under the lock, a concurrent request may have deleted it
+        expense = (
+            db.query(Expense).filter(Expense.expense_id == expense_id).first()
+        )
+        if expense is None:
+            raise HTTPException(status_code=404, detail="Expense not found")
+
+        # Update total expense of the group
+        add_to_group(db, group_id, total_expenses=-expense.amount)
+
+        # Update dept of group members, undoing the shares the expense was
+        # split into. They come from the ledger, members may have joined
+        # since.
+        shares = expense_shares(db, expense)
+        if not shares:
+            # Expenses from before the ledger have no entries
+            shares = _current_shares(db, expense)
+
+        depts = (
+            db.query(Dept)
+            .filter(
+                Dept.group_id == expense.group_id,
+                or_(
+                    Dept.lender_id == expense.created_by,
+                    Dept.user_id == expense.created_by,
+                ),
+            )
+            .all()
+        )
 
-    db.commit()
+        dept_index, amounts = _dept_amounts(depts)
+        deltas = new_deltas()
+        changed = split_expense(
+            amounts, expense.created_by, shares, deltas, sign=-1
+        )
+        _save_depts(db, group_id, dept_index, amounts, changed)
 
-    expense_participants = (
-        db.query(ExpenseParticipant)
-        .filter(ExpenseParticipant.expense_id == expense.expense_id)
-        .all()
-    )
+        db.add_all(
+            expense_entries(expense, shares, kind="expense_deleted", sign=-1)
+        )
+        update_member_balances(db, expense.group_id, deltas)
+        snapshot_if_due(db, expense.group_id)
+
+        # Participants and the expense itself go with set-based DELETEs, so
+        # the whole removal is one transaction regardless of participant count
+        db.query(ExpenseParticipant).filter(
+            ExpenseParticipant.expense_id == expense_id
+        ).delete(synchronize_session=False)
+        db.query(Expense).filter(Expense.expense_id == expense_id).delete(
+            synchronize_session=False
+        )
 
-    for expense_participant in expense_participants:
-        db.delete(expense_participant)
         db.commit()
-
-    db.delete(expense)
-    db.commit()
     return {"message": "Expense deleted successfully"}
 
 
-@router.post("/participant")
+@router.post("/participant", response_model=ParticipantOut)
 def create_expense_participant(
     p: CreateExpenseParticipant, db: Session = Depends(get_db)
 ):
@@ -248,10 +544,15 @@ def create_expense_participant(
     if expense is None:
         raise HTTPException(status_code=404, detail="Expense not found")
 
-    group = db.query(Group).filter(Group.group_id == expense.group_id).first()
-
-    average_amount = expense.amount / group.total_members
-    amount_owed = p.amount_paid - average_amount
+    members = (
+        db.query(GroupMembership.user_id)
+        .filter(GroupMembership.group_id == expense.group_id)
+        .all()
+    )
+    shares = split_amount(
+        expense.amount, [m.user_id for m in members], expense.expense_id
+    )
+    amount_owed = p.amount_paid - shares.get(p.user_id, 0)
 
     expense_participant = ExpenseParticipant(
         expense_id=p.expense_id,
@@ -1,8 +1,43 @@
-from fastapi import APIRouter, HTTPException, Depends
-from sqlalchemy import and_
-from sqlalchemy.orm import Session, joinedload
-from app.models import Group, User, GroupMembership
-from app.database import get_db
+from typing import Annotated, List, Optional
+
+from fastapi import APIRouter, HTTPException, Depends, Header, Response
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, aliased, joinedload
+from app.models import (
+    Dept,
+    Expense,
+    Group,
+    User,
+    GroupMembership,
+    LedgerEntry,
+    MemberBalance,
+)
+from app.database import get_async_db, get_db
+from app.balances import rebuild_member_balances
+from app.ledger import ledger_balances, take_snapshot
+from app.locks import add_to_group, locked_group
+from app.recompute import recompute_depts
+from app.pagination import (
+    DEFAULT_PAGE_SIZE,
+    check_limit,
+    decode_cursor,
+    encode_cursor,
+    fetch_page,
+    select_fields,
+)
+from app.schemas import (
+    BalanceOut,
+    GroupDashboard,
+    GroupDetail,
+    GroupOut,
+    LedgerEntryOut,
+    MembershipOut,
+    RebuildResult,
+    RecomputeResult,
+    SnapshotResult,
+)
+from app.streaming import stream_rows, wants_ndjson
 from pydantic import BaseModel
 
 router = APIRouter()
@@ -13,12 +48,27 @@ class GroupCreate(BaseModel):
     created_by: int
 
 
-@router.get("/")
-def get_groups(db: Session = Depends(get_db)):
-    return db.query(Group).all()
+@router.get(
+    "/", response_model=List[GroupOut], response_model_exclude_unset=True
+)
+def get_groups(
+    response: Response,
+    fields: Optional[str] = None,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    count: bool = True,
+    accept: Annotated[Optional[str], Header()] = None,
+    db: Session = Depends(get_db),
+):
+    statement = select(*select_fields(Group, GroupOut, fields))
+    if wants_ndjson(accept):
+        return stream_rows(db, statement, Group.group_id, cursor)
+    return fetch_page(
+        db, statement, Group.group_id, response, limit, cursor, count
+    )
 
 
-@router.get("/{group_id}")
+@router.get("/{group_id}", response_model=GroupDetail)
 def get_group(group_id: int, db: Session = Depends(get_db)):
     group = (
         db.query(Group)
@@ -33,7 +83,167 @@ def get_group(group_id: int, db: Session = Depends(get_db)):
     return group
 
 
-@router.post("/")
+@router.get("/{group_id}/dashboard", response_model=GroupDashboard)
+async def get_group_dashboard(
+    group_id: int,
+    expenses_limit: int = DEFAULT_PAGE_SIZE,
+    db: AsyncSession = Depends(get_async_db),
+):
+    # Everything the group page renders, in a fixed five queries. The
+    # page is polled on every rerun, so it is served without a worker
+    # thread.
+    check_limit(expenses_limit)
+
+    group = await db.get(Group, group_id)
+    if group is None:
+        raise HTTPException(status_code=404, detail="Group not found")
+
+    members = await db.execute(
+        select(
+            GroupMembership.user_id, GroupMembership.is_admin, User.username
+        )
+        .outerjoin(User, User.user_id == GroupMembership.user_id)
+        .where(GroupMembership.group_id == group_id)
+        .order_by(GroupMembership.membership_id)
+    )
+
+    expenses = await db.execute(
+        select(
+            Expense.expense_id,
+            Expense.description,
+            Expense.amount,
+            Expense.created_by,
+            Expense.created_at,
+        )
+        .where(Expense.group_id == group_id)
+        .order_by(Expense.created_at.desc(), Expense.expense_id.desc())
+        .limit(expenses_limit)
+    )
+
+    debtor, lender = aliased(User), aliased(User)
+    depts = await db.execute(
+        select(
+            Dept.dept_id,
+            Dept.user_id,
+            debtor.username.label("username"),
+            Dept.lender_id,
+            lender.username.label("lender_username"),
+            Dept.amount,
+        )
+        .outerjoin(debtor, debtor.user_id == Dept.user_id)
+        .outerjoin(lender, lender.user_id == Dept.lender_id)
+        .where(Dept.group_id == group_id)
+        .order_by(Dept.dept_id)
+    )
+
+    balances = await db.execute(
+        select(MemberBalance.user_id, MemberBalance.net_amount)
+        .where(MemberBalance.group_id == group_id)
+        .order_by(MemberBalance.user_id)
+    )
+
+    return {
+        "group_id": group.group_id,
+        "group_name": group.group_name,
+        "created_by": group.created_by,
+        "created_at": group.created_at,
+        "total_expenses": group.total_expenses,
+        "total_members": group.total_members,
+        "members": [m._asdict() for m in members],
+        "expenses": [e._asdict() for e in expenses],
+        "depts": [d._asdict() for d in depts],
+        "balances": [b._asdict() for b in balances],
+    }
+
+
+@router.get("/{group_id}/balances", response_model=List[BalanceOut])
+def get_group_balances(group_id: int, db: Session = Depends(get_db)):
+    # Served from the materialized table, no scan over the group's depts
+    balances = (
+        db.query(MemberBalance.user_id, MemberBalance.net_amount)
+        .filter(MemberBalance.group_id == group_id)
+        .order_by(MemberBalance.user_id)
+        .all()
+    )
+    return [
+        {"user_id": b.user_id, "net_amount": b.net_amount} for b in balances
+    ]
+
+
+@router.post("/{group_id}/balances/rebuild", response_model=RebuildResult)
+def rebuild_group_balances(group_id: int, db: Session = Depends(get_db)):
+    with locked_group(db, group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+
+        drift = rebuild_member_balances(db, group_id)
+        db.commit()
+    return {"drift": drift}
+
+
+@router.post("/{group_id}/depts/recompute", response_model=RecomputeResult)
+def recompute_group_depts(
+    group_id: int, persist: bool = False, db: Session = Depends(get_db)
+):
+    # Under the lock, so the ledger and the depts are read at one point
+    with locked_group(db, group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+
+        result = recompute_depts(db, group_id, persist)
+        db.commit()
+    return result
+
+
+@router.get("/{group_id}/ledger", response_model=List[LedgerEntryOut])
+def get_group_ledger(
+    group_id: int,
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    # Oldest first, entries are only ever appended
+    check_limit(limit)
+    query = db.query(LedgerEntry).filter(LedgerEntry.group_id == group_id)
+    if cursor is not None:
+        (entry_id,) = decode_cursor(cursor, 1)
+        if not isinstance(entry_id, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.filter(LedgerEntry.entry_id > entry_id)
+
+    entries = query.order_by(LedgerEntry.entry_id).limit(limit + 1).all()
+
+    if len(entries) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            entries[limit - 1].entry_id
+        )
+    return entries[:limit]
+
+
+@router.get("/{group_id}/ledger/balances", response_model=List[BalanceOut])
+def get_group_ledger_balances(group_id: int, db: Session = Depends(get_db)):
+    # Latest snapshot plus the entries after it
+    balances = ledger_balances(db, group_id)
+    return [
+        {"user_id": user_id, "net_amount": amount}
+        for user_id, amount in sorted(balances.items())
+    ]
+
+
+@router.post("/{group_id}/ledger/snapshot", response_model=SnapshotResult)
+def snapshot_group_ledger(group_id: int, db: Session = Depends(get_db)):
+    # Under the lock, a concurrent write may be taking a snapshot too
+    with locked_group(db, group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
+
+        last_entry_id = take_snapshot(db, group_id)
+        db.commit()
+    return {"last_entry_id": last_entry_id}
+
+
+@router.post("/", response_model=GroupOut)
 def create_group(group: GroupCreate, db: Session = Depends(get_db)):
     if db.query(User).filter(User.user_id == group.created_by).first() is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -53,36 +263,34 @@ def create_group(group: GroupCreate, db: Session = Depends(get_db)):
     return db_group
 
 
-@router.post("/{group_id}/add_member/{user_id}")
+@router.post("/{group_id}/add_member/{user_id}", response_model=MembershipOut)
 def add_group_member(
     group_id: int, user_id: int, db: Session = Depends(get_db)
 ):
     if db.query(User).filter(User.user_id == user_id).first() is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    group = db.query(Group).filter(Group.group_id == group_id).first()
-    if group is None:
-        raise HTTPException(status_code=404, detail="Group not found")
+    with locked_group(db, group_id) as group:
+        if group is None:
+            raise HTTPException(status_code=404, detail="Group not found")
 
-    if (
-        db.query(GroupMembership)
-        .filter(
-            and_(
-                GroupMembership.group_id == group_id,
-                GroupMembership.user_id == user_id,
+        if (
+            db.query(GroupMembership)
+            .filter(
+                and_(
+                    GroupMembership.group_id == group_id,
+                    GroupMembership.user_id == user_id,
+                )
             )
-        )
-        .first()
-    ):
-        raise HTTPException(status_code=404, detail="Already in group")
-
-    # Update total members of the group
-    group.total_members += 1
-    db.commit()
+            .first()
+        ):
+            raise HTTPException(status_code=404, detail="Already in group")
 
-    group_membership = GroupMembership(group_id=group_id, user_id=user_id)
-    db.add(group_membership)
-    db.commit()
+        # The counter and the membership go in one transaction
+        add_to_group(db, group_id, total_members=1)
+        group_membership = GroupMembership(group_id=group_id, user_id=user_id)
+        db.add(group_membership)
+        db.commit()
 
     db.refresh(group_membership)
     return group_membership
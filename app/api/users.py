@@ -1,4 +1,15 @@
-from fastapi import APIRouter, HTTPException, Depends, status
+from datetime import datetime
+from typing import Annotated, List, Optional
+
+from fastapi import (
+    APIRouter,
+    HTTPException,
+    Depends,
+    Header,
+    Response,
+    status,
+)
+from sqlalchemy import select, tuple_
 from sqlalchemy.orm import Session
 from app.models import (
     User,
@@ -8,6 +19,17 @@ from app.models import (
     Expense,
 )
 from app.database import get_db
+from app.pagination import (
+    DEFAULT_PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    check_limit,
+    decode_cursor,
+    encode_cursor,
+    fetch_page,
+    select_fields,
+)
+from app.schemas import GroupOut, UserExpenseOut, UserOut
+from app.streaming import stream_rows, wants_ndjson
 from pydantic import BaseModel
 from passlib.context import CryptContext
 
@@ -22,12 +44,47 @@ class UserCreate(BaseModel):
     email: str
 
 
-@router.get("/")
-def get_users(db: Session = Depends(get_db)):
-    return db.query(User).all()
+@router.get(
+    "/", response_model=List[UserOut], response_model_exclude_unset=True
+)
+def get_users(
+    response: Response,
+    ids: Optional[str] = None,
+    fields: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    count: bool = True,
+    accept: Annotated[Optional[str], Header()] = None,
+    db: Session = Depends(get_db),
+):
+    statement = select(*select_fields(User, UserOut, fields))
+    page_size = DEFAULT_PAGE_SIZE
+
+    # ids=1,2,3 resolves a set of users with a single IN query
+    if ids is not None:
+        try:
+            user_ids = {int(i) for i in ids.split(",") if i.strip()}
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid ids")
+        if len(user_ids) > MAX_PAGE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"At most {MAX_PAGE_SIZE} ids can be requested",
+            )
+        statement = statement.where(User.user_id.in_(user_ids))
+        # All of the requested users on one page, unless limit says otherwise
+        page_size = max(len(user_ids), 1)
+
+    if wants_ndjson(accept):
+        return stream_rows(db, statement, User.user_id, cursor)
+    if limit is None:
+        limit = page_size
+    return fetch_page(
+        db, statement, User.user_id, response, limit, cursor, count
+    )
 
 
-@router.get("/username/{username}")
+@router.get("/username/{username}", response_model=UserOut)
 def get_user_by_username(username: str, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.username == username).first()
     if user is None:
@@ -35,7 +92,7 @@ def get_user_by_username(username: str, db: Session = Depends(get_db)):
     return user
 
 
-@router.get("/{user_id}")
+@router.get("/{user_id}", response_model=UserOut)
 def get_user(user_id: int, db: Session = Depends(get_db)):
     user = db.query(User).filter(User.user_id == user_id).first()
     if user is None:
@@ -43,7 +100,7 @@ def get_user(user_id: int, db: Session = Depends(get_db)):
     return user
 
 
-@router.post("/")
+@router.post("/", response_model=UserOut)
 def create_user(user: UserCreate, db: Session = Depends(get_db)):
     # Check if the username or email already exists
     if db.query(User).filter(User.username == user.username).first():
@@ -72,7 +129,7 @@ def create_user(user: UserCreate, db: Session = Depends(get_db)):
     return db_user
 
 
-@router.get("/{user_id}/groups")
+@router.get("/{user_id}/groups", response_model=List[GroupOut])
 def get_user_groups(user_id: int, db: Session = Depends(get_db)):
     if db.query(User).filter(User.user_id == user_id).first() is None:
         raise HTTPException(status_code=404, detail="User not found")
@@ -86,30 +143,59 @@ def get_user_groups(user_id: int, db: Session = Depends(get_db)):
     return groups
 
 
-@router.get("/{user_id}/expenses")
-def get_user_expenses(user_id: int, db: Session = Depends(get_db)):
+@router.get("/{user_id}/expenses", response_model=List[UserExpenseOut])
+def get_user_expenses(
+    user_id: int,
+    response: Response,
+    limit: int = DEFAULT_PAGE_SIZE,
+    cursor: Optional[str] = None,
+    db: Session = Depends(get_db),
+):
+    check_limit(limit)
     if db.query(User).filter(User.user_id == user_id).first() is None:
         raise HTTPException(status_code=404, detail="User not found")
 
-    expenses_with_details = []
-    expense_participants = (
-        db.query(ExpenseParticipant)
+    # Pages are ordered by (created_at, expense_id) of the expense, the
+    # participant id breaks ties between rows of the same expense
+    sort_key = (
+        Expense.created_at,
+        Expense.expense_id,
+        ExpenseParticipant.expense_participant_id,
+    )
+    query = (
+        db.query(
+            ExpenseParticipant.expense_participant_id,
+            ExpenseParticipant.expense_id,
+            ExpenseParticipant.user_id,
+            ExpenseParticipant.amount_paid,
+            ExpenseParticipant.amount_owed,
+            Expense.description.label("expense_description"),
+            Expense.amount.label("expense_amount"),
+            Expense.created_at.label("expense_created_at"),
+        )
+        .join(Expense, Expense.expense_id == ExpenseParticipant.expense_id)
         .filter(ExpenseParticipant.user_id == user_id)
-        .all()
     )
-
-    for expense_participant in expense_participants:
-        expense = (
-            db.query(Expense)
-            .filter(Expense.expense_id == expense_participant.expense_id)
-            .first()
+    if cursor is not None:
+        created_at, expense_id, participant_id = decode_cursor(cursor, 3)
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if not all(isinstance(i, int) for i in (expense_id, participant_id)):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        query = query.filter(
+            tuple_(*sort_key) > tuple_(created_at, expense_id, participant_id)
         )
-        expense_details = {
-            "expense_description": expense.description,
-            "expense_amount": expense.amount,
-        }
-        expenses_with_details.append(
-            {**expense_participant.__dict__, **expense_details}
+
+    rows = query.order_by(*sort_key).limit(limit + 1).all()
+
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            last.expense_created_at,
+            last.expense_id,
+            last.expense_participant_id,
         )
 
-    return expenses_with_details
+    return [row._asdict() for row in rows[:limit]]
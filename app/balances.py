@@ -0,0 +1,86 @@
+from sqlalchemy import bindparam, update
+
+from app.models import Dept, MemberBalance
+from app.reconcile import new_deltas, record_dept_change
+from app.settlement import MIN_AMOUNT, net_balances
+
+
+def update_member_balances(db, group_id, deltas):
+    """Apply ``deltas`` to the group's MemberBalance rows.
+
+    Existing rows are changed with ``SET net_amount = net_amount + :delta``
+    and only missing rows are inserted. Nothing is committed, so the
+    update is part of the caller's transaction.
+    """
+    if not deltas:
+        return
+
+    existing = {
+        row.user_id
+        for row in db.query(MemberBalance.user_id).filter(
+            MemberBalance.group_id == group_id,
+            MemberBalance.user_id.in_(list(deltas)),
+        )
+    }
+
+    increments = []
+    for user_id, delta in deltas.items():
+        if user_id in existing:
+            increments.append({"b_user_id": user_id, "b_delta": delta})
+        else:
+            db.add(
+                MemberBalance(
+                    group_id=group_id, user_id=user_id, net_amount=delta
+                )
+            )
+
+    if increments:
+        table = MemberBalance.__table__
+        db.execute(
+            update(table)
+            .where(
+                table.c.group_id == group_id,
+                table.c.user_id == bindparam("b_user_id"),
+            )
+            .values(net_amount=table.c.net_amount + bindparam("b_delta")),
+            increments,
+        )
+
+
+def rebuild_member_balances(db, group_id):
+    """Recompute the group's MemberBalance rows from its depts.
+
+    Returns the drift that was found, one entry per user whose stored
+    balance differed from the depts by at least MIN_AMOUNT.
+    """
+    depts = db.query(Dept).filter(Dept.group_id == group_id).all()
+    expected = net_balances(depts)
+
+    rows = (
+        db.query(MemberBalance)
+        .filter(MemberBalance.group_id == group_id)
+        .all()
+    )
+    by_user = {row.user_id: row for row in rows}
+
+    drift = []
+    for user_id in sorted(set(expected) | set(by_user)):
+        amount = expected.get(user_id, 0)
+        row = by_user.get(user_id)
+        stored = row.net_amount if row is not None else 0
+
+        if abs(stored - amount) >= MIN_AMOUNT:
+            drift.append(
+                {"user_id": user_id, "expected": amount, "stored": stored}
+            )
+
+        if row is None:
+            db.add(
+                MemberBalance(
+                    group_id=group_id, user_id=user_id, net_amount=amount
+                )
+            )
+        else:
+            row.net_amount = amount
+
+    return drift
@@ -0,0 +1,111 @@
+"""Replay the stored response of a request retried with the same key.
+
+Clients send an ``Idempotency-Key`` header, any unique string of up to
+255 characters, with POST /expenses and PATCH /dept. The first request
+with a key runs as usual and its response is stored in the same
+transaction as its writes. Later requests with the key get the stored
+response back without touching the depts, or a 422 when they differ
+from the first one. Only successful responses are stored, a request
+that failed can be retried with the same key.
+
+Requests with the same key are serialized within a worker process. A
+duplicate committed by another worker in the meantime fails on the
+primary key and gets a 409, retrying it replays the response.
+"""
+
+import hashlib
+import json
+import os
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta
+
+from fastapi import HTTPException
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy.exc import IntegrityError
+
+from app.locks import KeyedLock
+from app.models import IdempotencyKey
+
+# Seconds a key is remembered for
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+
+key_locks = KeyedLock()
+
+
+def fingerprint(method, path, body):
+    """Hash of a request, to tell when a key is reused for another one."""
+    data = json.dumps([method, path, body], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class Idempotency:
+    """The Idempotency-Key of one request, a no-op when ``key`` is None."""
+
+    def __init__(self, db, key, method, path, body):
+        self.db = db
+        self.key = key
+        self.fingerprint = fingerprint(method, path, body)
+
+    def _cutoff(self):
+        return datetime.now() - timedelta(seconds=IDEMPOTENCY_TTL)
+
+    @contextmanager
+    def hold(self):
+        """Serialize the requests made with this key."""
+        lock = key_locks.hold(self.key) if self.key else nullcontext()
+        with lock:
+            try:
+                yield
+            except IntegrityError:
+                self.db.rollback()
+                if self.key is None or self._stored() is None:
+                    raise
+                raise HTTPException(
+                    status_code=409,
+                    detail="Idempotency-Key was used by a concurrent request",
+                )
+
+    def _stored(self):
+        return (
+            self.db.query(IdempotencyKey)
+            .filter(
+                IdempotencyKey.key == self.key,
+                IdempotencyKey.created_at > self._cutoff(),
+            )
+            .first()
+        )
+
+    def replay(self):
+        """Response stored for the key, None if there is none yet."""
+        if self.key is None:
+            return None
+
+        stored = self._stored()
+        if stored is None:
+            return None
+        if stored.fingerprint != self.fingerprint:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key was used for another request",
+            )
+        return json.loads(stored.response)
+
+    def save(self, response):
+        """Store ``response`` for the key, nothing is committed.
+
+        Expired keys are deleted first, so an old key can be used again.
+        """
+        if self.key is None:
+            return response
+
+        self.db.query(IdempotencyKey).filter(
+            IdempotencyKey.created_at <= self._cutoff()
+        ).delete(synchronize_session=False)
+        self.db.add(
+            IdempotencyKey(
+                key=self.key,
+                fingerprint=self.fingerprint,
+                response=json.dumps(jsonable_encoder(response)),
+            )
+        )
+        return response
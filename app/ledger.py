@@ -0,0 +1,152 @@
+"""Append-only ledger of dept changes, with balance snapshots over it.
+
+Expenses, their deletion and dept payments append LedgerEntry rows in
+the transaction that changes the depts. A group's balances are its
+latest BalanceSnapshot plus the entries after it, so reading them costs
+the tail of the ledger rather than its whole history.
+"""
+
+from collections import defaultdict
+
+from sqlalchemy import func
+
+from app.models import BalanceSnapshot, LedgerEntry
+
+# A group is snapshotted once this many entries follow its last snapshot
+SNAPSHOT_INTERVAL = 500
+
+
+def expense_entries(expense, shares, kind="expense", sign=1):
+    """Entries charging every member their share of ``expense``.
+
+    ``shares`` comes from ``split_amount``. ``sign=-1`` reverses the
+    expense, e.g. when it is deleted.
+    """
+    return [
+        LedgerEntry(
+            group_id=expense.group_id,
+            user_id=member_id,
+            lender_id=expense.created_by,
+            amount=sign * share,
+            kind=kind,
+            expense_id=expense.expense_id,
+        )
+        for member_id, share in shares.items()
+        if member_id != expense.created_by and share
+    ]
+
+
+def expense_shares(db, expense):
+    """The shares of ``expense`` as its "expense" entries recorded them.
+
+    Maps each member to their share like ``split_amount`` does, without
+    the payer and the members whose share was 0.
+    """
+    rows = (
+        db.query(LedgerEntry.user_id, func.sum(LedgerEntry.amount))
+        .filter(
+            LedgerEntry.expense_id == expense.expense_id,
+            LedgerEntry.kind == "expense",
+        )
+        .group_by(LedgerEntry.user_id)
+        .all()
+    )
+    return {user_id: int(amount) for user_id, amount in rows}
+
+
+def dept_entry(dept, amount, kind):
+    """Entry for ``dept.user_id`` now owing ``amount`` more."""
+    return LedgerEntry(
+        group_id=dept.group_id,
+        user_id=dept.user_id,
+        lender_id=dept.lender_id,
+        amount=amount,
+        kind=kind,
+        dept_id=dept.dept_id,
+    )
+
+
+def latest_snapshot_entry(db, group_id):
+    """Last entry id covered by the group's latest snapshot, 0 if none."""
+    last = (
+        db.query(func.max(BalanceSnapshot.last_entry_id))
+        .filter(BalanceSnapshot.group_id == group_id)
+        .scalar()
+    )
+    return last or 0
+
+
+def ledger_balances(db, group_id, upto=None):
+    """Net balance per user from the ledger, positive when owed.
+
+    Starts from the latest snapshot and adds the entries after it, up to
+    and including ``upto`` when it is given.
+    """
+    last = latest_snapshot_entry(db, group_id)
+    balances = defaultdict(int)
+
+    snapshot = db.query(
+        BalanceSnapshot.user_id, BalanceSnapshot.net_amount
+    ).filter(
+        BalanceSnapshot.group_id == group_id,
+        BalanceSnapshot.last_entry_id == last,
+    )
+    for row in snapshot:
+        balances[row.user_id] += row.net_amount
+
+    tail = db.query(
+        LedgerEntry.user_id,
+        LedgerEntry.lender_id,
+        func.sum(LedgerEntry.amount).label("amount"),
+    ).filter(LedgerEntry.group_id == group_id, LedgerEntry.entry_id > last)
+    if upto is not None:
+        tail = tail.filter(LedgerEntry.entry_id <= upto)
+    for row in tail.group_by(LedgerEntry.user_id, LedgerEntry.lender_id):
+        balances[row.lender_id] += row.amount
+        balances[row.user_id] -= row.amount
+
+    return dict(balances)
+
+
+def take_snapshot(db, group_id):
+    """Snapshot the group's balances over the ledger as it is now.
+
+    Returns the last entry id the snapshot covers, or None when the
+    group has no entries. Nothing is committed.
+    """
+    db.flush()
+    last = (
+        db.query(func.max(LedgerEntry.entry_id))
+        .filter(LedgerEntry.group_id == group_id)
+        .scalar()
+    )
+    if last is None or last == latest_snapshot_entry(db, group_id):
+        return last
+
+    balances = ledger_balances(db, group_id, upto=last)
+    db.add_all(
+        BalanceSnapshot(
+            group_id=group_id,
+            last_entry_id=last,
+            user_id=user_id,
+            net_amount=amount,
+        )
+        for user_id, amount in sorted(balances.items())
+    )
+    return last
+
+
+def snapshot_if_due(db, group_id):
+    """Take a snapshot once the group's tail reaches SNAPSHOT_INTERVAL."""
+    db.flush()
+    tail = (
+        db.query(LedgerEntry.entry_id)
+        .filter(
+            LedgerEntry.group_id == group_id,
+            LedgerEntry.entry_id > latest_snapshot_entry(db, group_id),
+        )
+        .limit(SNAPSHOT_INTERVAL)
+        .count()
+    )
+    if tail >= SNAPSHOT_INTERVAL:
+        take_snapshot(db, group_id)
@@ -0,0 +1,99 @@
+"""Serialize the writes to a group.
+
+Creating or deleting an expense, paying a dept and simplifying all read
+the group's depts, rewrite them in Python and commit. Two such requests
+for the same group running at once would each start from the same depts
+and one of the rewrites would be lost. ``locked_group`` runs them one
+after the other: a lock per group serializes the worker threads of a
+process, and ``SELECT ... FOR UPDATE`` on the group row does the same
+across processes on PostgreSQL. SQLite ignores FOR UPDATE and pysqlite
+only begins a transaction at the first write, after the depts were
+read. On SQLite the block starts with ``BEGIN IMMEDIATE`` instead, which
+takes the database's single write lock before anything is read.
+
+The group counters are changed with ``add_to_group``, a single
+``UPDATE ... SET x = x + :delta``, so they stay right even for writes
+that don't take the lock.
+"""
+
+import threading
+from contextlib import contextmanager
+
+from sqlalchemy import update
+
+from app.models import Group
+
+
+class KeyedLock:
+    """A lock per key, dropped once no thread holds or waits for it."""
+
+    def __init__(self):
+        self._guard = threading.Lock()
+        # key -> [lock, number of threads holding or waiting for it]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    @contextmanager
+    def hold(self, key):
+        with self._guard:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._guard:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._locks[key]
+
+
+group_locks = KeyedLock()
+
+
+def _begin_immediate(db):
+    connection = db.connection()
+    # The writes go through the sync engine, i.e. pysqlite on SQLite
+    if connection.dialect.driver != "pysqlite":
+        return
+    # A transaction that already wrote holds the write lock
+    if not connection.connection.dbapi_connection.in_transaction:
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+@contextmanager
+def locked_group(db, group_id):
+    """Hold the write lock of ``group_id`` and yield its Group.
+
+    The Group is None when there is no such group. Commit inside the
+    block, the lock is released when it ends.
+    """
+    with group_locks.hold(group_id):
+        _begin_immediate(db)
+        yield (
+            db.query(Group)
+            .filter(Group.group_id == group_id)
+            .with_for_update()
+            .first()
+        )
+
+
+def add_to_group(db, group_id, **deltas):
+    """Add ``deltas`` to the group's counters, e.g. ``total_members=1``.
+
+    Runs in the database as one UPDATE, nothing is committed. Group
+    objects already loaded keep their old values until refreshed.
+    """
+    db.execute(
+        update(Group)
+        .where(Group.group_id == group_id)
+        .values(
+            {
+                getattr(Group, name): getattr(Group, name) + delta
+                for name, delta in deltas.items()
+            }
+        )
+        .execution_options(synchronize_session=False)
+    )
@@ -1,17 +1,49 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+
+from fastapi import Depends, FastAPI, Response
+from fastapi.responses import ORJSONResponse
+from prometheus_client import CONTENT_TYPE_LATEST
+from sqlalchemy.orm import Session
 from app.api import users, groups, expenses, auth, dept
-from app.database import Base, engine
+from app.database import async_engine, engine, get_db
+from app.metrics import (
+    MetricsMiddleware,
+    instrument_pool,
+    mark_worker_dead,
+    render_metrics,
+)
+from app.migrate import migrate
+from app.timing import TimingMiddleware, instrument_engine
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    mark_worker_dead()
+
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse, lifespan=lifespan)
+app.add_middleware(TimingMiddleware)
+app.add_middleware(MetricsMiddleware)
 # @app.get("/")
 # async def read_root():
 #     return {"message": "Hello, World"}
 
 
-Base.metadata.create_all(bind=engine)
+migrate(engine)
+
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+instrument_pool(engine, "sync")
+instrument_pool(async_engine.sync_engine, "async")
 
 app.include_router(users.router, prefix="/users", tags=["users"])
 app.include_router(groups.router, prefix="/groups", tags=["groups"])
 app.include_router(expenses.router, prefix="/expenses", tags=["expenses"])
 app.include_router(auth.router, prefix="/auth", tags=["auth"])
 app.include_router(dept.router, prefix="/dept", tags=["dept"])
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics(db: Session = Depends(get_db)):
+    return Response(render_metrics(db), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,246 @@
+"""Prometheus metrics, served by ``GET /metrics``.
+
+``MetricsMiddleware`` counts the requests and observes their latency per
+route template, e.g. ``/groups/{group_id}``. Requests matching no route
+share the route label ``<unmatched>``. ``instrument_pool`` follows the
+connection pool of an engine, and the write endpoints count the expenses
+they create and the dept payments. The dept rows per group are counted
+in the database when the metrics are scraped.
+
+Metric values live in process memory. When uvicorn runs several
+workers, point PROMETHEUS_MULTIPROC_DIR at an empty directory before
+starting it. Every worker then writes its values to files there, and a
+scrape served by any worker adds them up.
+"""
+
+import os
+import time
+
+from prometheus_client import (
+    REGISTRY,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from prometheus_client.core import GaugeMetricFamily, HistogramMetricFamily
+from sqlalchemy import event, func
+from sqlalchemy.pool import QueuePool
+
+from app.models import Dept
+
+MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Buckets of the dept rows per group histogram
+DEPT_ROWS_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests by method, route and status",
+    ["method", "route", "status"],
+)
+LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency by method and route",
+    ["method", "route"],
+)
+IN_PROGRESS = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being served",
+    ["method"],
+    multiprocess_mode="livesum",
+)
+
+POOL_CHECKOUTS = Counter(
+    "db_pool_checkouts_total",
+    "Connections checked out of the pool",
+    ["engine"],
+)
+POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connections checked out of the pool now",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Checked out connections beyond the pool size",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+POOL_SIZE = Gauge(
+    "db_pool_size",
+    "Connections the pool keeps open",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+
+EXPENSES_CREATED = Counter(
+    "lazy_split_expenses_created_total", "Expenses created"
+)
+DEPT_PAYMENTS = Counter(
+    "lazy_split_dept_payments_total",
+    "Dept payments, settled when they paid the dept off",
+    ["outcome"],
+)
+DEPT_PAID = Counter("lazy_split_dept_paid_total", "Kopecks paid off depts")
+
+
+# (method, route, status) -> request counter and latency histogram.
+# .labels() takes a lock on every call, a dict lookup doesn't.
+_request_children = {}
+_in_progress_children = {}
+
+
+def _request_metrics(method, route, status):
+    key = (method, route, status)
+    children = _request_children.get(key)
+    if children is None:
+        children = _request_children[key] = (
+            REQUESTS.labels(method, route, status),
+            LATENCY.labels(method, route),
+        )
+    return children
+
+
+def _in_progress(method):
+    child = _in_progress_children.get(method)
+    if child is None:
+        child = _in_progress_children[method] = IN_PROGRESS.labels(method)
+    return child
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting and timing the requests."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        method = scope["method"]
+        in_progress = _in_progress(method)
+        in_progress.inc()
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_progress.dec()
+            route = getattr(scope.get("route"), "path", "<unmatched>")
+            requests, latency = _request_metrics(method, route, status)
+            requests.inc()
+            latency.observe(time.perf_counter() - start)
+
+
+def instrument_pool(engine, name):
+    """Follow the checkouts of ``engine``'s pool, labelled ``name``.
+
+    Pass ``async_engine.sync_engine`` for an async engine. Pools without
+    a size, such as the one of an in-memory SQLite database, are left
+    alone.
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return
+
+    POOL_SIZE.labels(name).set(pool.size())
+
+    def update(checked_out):
+        POOL_CHECKED_OUT.labels(name).set(checked_out)
+        POOL_OVERFLOW.labels(name).set(max(checked_out - pool.size(), 0))
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_CHECKOUTS.labels(name).inc()
+        update(pool.checkedout())
+
+    def on_checkin(dbapi_connection, connection_record):
+        # Fired before the connection is back in the pool
+        update(pool.checkedout() - 1)
+
+    event.listen(engine, "checkout", on_checkout)
+    event.listen(engine, "checkin", on_checkin)
+
+
+def mark_worker_dead():
+    """Drop the in-progress and pool gauges of this worker.
+
+    Called when the app shuts down. uvicorn workers end on a signal,
+    so atexit handlers don't run in them.
+    """
+    if MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid(), MULTIPROC_DIR)
+
+
+def count_expenses_created(count=1):
+    EXPENSES_CREATED.inc(count)
+
+
+def count_dept_payment(paid, settled):
+    DEPT_PAYMENTS.labels("settled" if settled else "partial").inc()
+    DEPT_PAID.inc(paid)
+
+
+class DeptRowsCollector:
+    """Dept rows per group, counted by the database on every scrape."""
+
+    def __init__(self, db):
+        self.db = db
+
+    def collect(self):
+        counts = [
+            count
+            for (count,) in self.db.query(func.count(Dept.dept_id)).group_by(
+                Dept.group_id
+            )
+        ]
+        buckets = [
+            (str(le), sum(1 for count in counts if count <= le))
+            for le in DEPT_ROWS_BUCKETS
+        ]
+        buckets.append(("+Inf", len(counts)))
+
+        yield HistogramMetricFamily(
+            "lazy_split_group_dept_rows",
+            "Dept rows per group with depts",
+            buckets=buckets,
+            sum_value=sum(counts),
+        )
+        yield GaugeMetricFamily(
+            "lazy_split_group_dept_rows_max",
+            "Dept rows of the group with the most depts",
+            value=max(counts, default=0),
+        )
+
+
+class _Collectors:
+    def __init__(self, *collectors):
+        self.collectors = collectors
+
+    def collect(self):
+        for collector in self.collectors:
+            yield from collector.collect()
+
+
+def render_metrics(db):
+    """The metrics in the Prometheus text format.
+
+    Adds up the values of all workers when PROMETHEUS_MULTIPROC_DIR is
+    set, ``db`` counts the dept rows.
+    """
+    if MULTIPROC_DIR:
+        values = multiprocess.MultiProcessCollector(None, MULTIPROC_DIR)
+    else:
+        values = REGISTRY
+    return generate_latest(_Collectors(values, DeptRowsCollector(db)))
@@ -0,0 +1,257 @@
+"""Bring an existing database up to date with ``app.models``.
+
+``Base.metadata.create_all`` only creates missing tables, so indexes
+added to tables that already exist are created here, money columns
+still stored as Float are converted to integer minor units, SQLite
+tables that should never reuse ids get AUTOINCREMENT and existing depts
+open the ledger and the member balances. Run it on an old
+``lazy_split.db`` with::
+
+    poetry run python -m app.migrate
+"""
+
+from sqlalchemy import Float, Integer, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+from app import models  # noqa: F401, registers the tables
+from app.balances import rebuild_member_balances
+from app.database import Base, engine
+from app.money import MINOR_UNITS
+
+
+def dedupe_group_memberships(conn):
+    # Keep the oldest membership of each (group_id, user_id) pair so the
+    # unique index on the pair can be created
+    conn.execute(
+        text(
+            "DELETE FROM group_memberships WHERE membership_id NOT IN ("
+            "SELECT MIN(membership_id) FROM group_memberships "
+            "GROUP BY group_id, user_id)"
+        )
+    )
+
+
+def dedupe_balance_snapshots(conn):
+    # Rows of one member and snapshot hold the same balance, keep one
+    conn.execute(
+        text(
+            "DELETE FROM balance_snapshots WHERE snapshot_id NOT IN ("
+            "SELECT MIN(snapshot_id) FROM balance_snapshots "
+            "GROUP BY group_id, last_entry_id, user_id)"
+        )
+    )
+
+
+# Data fixes that have to run before an index can be created
+BEFORE_INDEX = {
+    "ix_group_memberships_group_user": dedupe_group_memberships,
+    "ix_balance_snapshots_group_entry_user": dedupe_balance_snapshots,
+}
+
+# Indexes replaced by another one of the models
+REPLACED_INDEXES = ("ix_balance_snapshots_group_entry",)
+
+
+def drop_replaced_indexes(conn):
+    """Drop the REPLACED_INDEXES that exist, returns their names."""
+    inspector = inspect(conn)
+    existing = {
+        index["name"]
+        for table in inspector.get_table_names()
+        for index in inspector.get_indexes(table)
+    }
+    dropped = [name for name in REPLACED_INDEXES if name in existing]
+    for name in dropped:
+        conn.execute(text(f"DROP INDEX {name}"))
+    return dropped
+
+
+def create_missing_indexes(conn):
+    """Create the model indexes missing from the database.
+
+    Returns the names of the indexes that were created.
+    """
+    inspector = inspect(conn)
+    created = []
+
+    for table in Base.metadata.sorted_tables:
+        existing = {i["name"] for i in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name in existing:
+                continue
+            if index.name in BEFORE_INDEX:
+                BEFORE_INDEX[index.name](conn)
+            index.create(bind=conn)
+            created.append(index.name)
+
+    return created
+
+
+def float_money_columns(conn):
+    """Map each table to its money columns that are still Float.
+
+    A money column is one the models declare as an integer while the
+    database still has it as a float, i.e. it holds roubles.
+    """
+    inspector = inspect(conn)
+    found = {}
+
+    for table in Base.metadata.sorted_tables:
+        stored = {
+            c["name"]: c["type"] for c in inspector.get_columns(table.name)
+        }
+        names = [
+            column.name
+            for column in table.columns
+            if isinstance(column.type, Integer)
+            and isinstance(stored.get(column.name), Float)
+        ]
+        if names:
+            found[table] = names
+
+    return found
+
+
+def _rebuild_sqlite_table(conn, table, money=()):
+    # SQLite can't change a column type or add AUTOINCREMENT in place:
+    # copy the rows into a table created from the model, then swap it in
+    # for the old one
+    new_name = f"{table.name}_rebuild"
+    create = str(CreateTable(table).compile(dialect=conn.dialect))
+    conn.exec_driver_sql(
+        create.replace(f"TABLE {table.name} ", f"TABLE {new_name} ", 1)
+    )
+
+    stored = {c["name"] for c in inspect(conn).get_columns(table.name)}
+    names = [c.name for c in table.columns if c.name in stored]
+    values = [
+        (
+            f"CAST(ROUND({name} * {MINOR_UNITS}) AS INTEGER)"
+            if name in money
+            else name
+        )
+        for name in names
+    ]
+    conn.exec_driver_sql(
+        f"INSERT INTO {new_name} ({', '.join(names)}) "
+        f"SELECT {', '.join(values)} FROM {table.name}"
+    )
+
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {new_name} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(bind=conn)
+
+
+def convert_money_columns(conn):
+    """Convert Float money columns to integer minor units.
+
+    Returns the converted columns as ``table.column`` names. Converted
+    columns are integers afterwards, so running it again is a no-op.
+    """
+    converted = []
+
+    for table, money in float_money_columns(conn).items():
+        if conn.dialect.name == "sqlite":
+            _rebuild_sqlite_table(conn, table, money)
+        else:
+            for name in money:
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ALTER COLUMN {name} "
+                        f"TYPE BIGINT USING ROUND({name} * {MINOR_UNITS})"
+                    )
+                )
+        converted += [f"{table.name}.{name}" for name in money]
+
+    return converted
+
+
+def add_sqlite_autoincrement(conn):
+    """Rebuild the SQLite tables the models declare AUTOINCREMENT for.
+
+    Returns the names of the rebuilt tables. Other databases never reuse
+    the ids of deleted rows, there it is a no-op.
+    """
+    if conn.dialect.name != "sqlite":
+        return []
+
+    rebuilt = []
+    for table in Base.metadata.sorted_tables:
+        if not table.dialect_options["sqlite"]["autoincrement"]:
+            continue
+        create = conn.execute(
+            text("SELECT sql FROM sqlite_master WHERE name = :name"),
+            {"name": table.name},
+        ).scalar()
+        if "AUTOINCREMENT" not in create:
+            _rebuild_sqlite_table(conn, table)
+            rebuilt.append(table.name)
+
+    return rebuilt
+
+
+def open_ledger(conn):
+    """Open the ledger of a database that has depts but no ledger yet.
+
+    Every dept gets an "opening" entry, so the ledger balances match the
+    depts from then on. Returns the number of entries added.
+    """
+    if conn.execute(text("SELECT 1 FROM ledger_entries LIMIT 1")).first():
+        return 0
+
+    result = conn.execute(
+        text(
+            "INSERT INTO ledger_entries "
+            "(group_id, user_id, lender_id, amount, kind, dept_id, "
+            "created_at) "
+            "SELECT group_id, user_id, lender_id, amount, 'opening', "
+            "dept_id, created_at FROM dept ORDER BY dept_id"
+        )
+    )
+    return result.rowcount
+
+
+def backfill_member_balances(conn):
+    """Build the balances of groups that have depts but no balance rows.
+
+    Databases from before MemberBalance have none, and the writes only
+    add deltas to the rows that exist. Returns the ids of the groups.
+    """
+    group_ids = (
+        conn.execute(
+            text(
+                "SELECT DISTINCT group_id FROM dept WHERE NOT EXISTS ("
+                "SELECT 1 FROM member_balances "
+                "WHERE member_balances.group_id = dept.group_id) "
+                "ORDER BY group_id"
+            )
+        )
+        .scalars()
+        .all()
+    )
+    # The session joins the migration's transaction, flushing is enough
+    with Session(bind=conn) as db:
+        for group_id in group_ids:
+            rebuild_member_balances(db, group_id)
+        db.flush()
+    return group_ids
+
+
+def migrate(bind=engine):
+    """Run every migration step, returns the indexes that were created."""
+    Base.metadata.create_all(bind=bind)
+    with bind.begin() as conn:
+        created = create_missing_indexes(conn)
+        drop_replaced_indexes(conn)
+        convert_money_columns(conn)
+        add_sqlite_autoincrement(conn)
+        open_ledger(conn)
+        backfill_member_balances(conn)
+    return created
+
+
+if __name__ == "__main__":
+    for name in migrate():
+        print(f"created index {name}")
@@ -1,11 +1,13 @@
 from sqlalchemy import (
+    BigInteger,
     Column,
     Integer,
     String,
     DateTime,
     ForeignKey,
     Boolean,
-    Float,
+    Index,
+    Text,
 )
 from app.database import Base
 from datetime import datetime
@@ -23,6 +25,9 @@ class User(Base):
     groupmembers = relationship("GroupMembership", back_populates="user")
 
 
+# Money columns hold integer minor units, see app.money
+
+
 class Group(Base):
     __tablename__ = "groups"
 
@@ -31,7 +36,7 @@ class Group(Base):
     created_by = Column(Integer, ForeignKey("users.user_id"))
     created_at = Column(DateTime, default=datetime.now)
 
-    total_expenses = Column(Float, default=0)
+    total_expenses = Column(BigInteger, default=0)
     total_members = Column(Integer, default=1)
 
     groupmembers = relationship("GroupMembership", back_populates="group")
@@ -40,10 +45,18 @@ class Group(Base):
 
 class GroupMembership(Base):
     __tablename__ = "group_memberships"
+    __table_args__ = (
+        Index(
+            "ix_group_memberships_group_user",
+            "group_id",
+            "user_id",
+            unique=True,
+        ),
+    )
 
     membership_id = Column(Integer, primary_key=True, index=True)
     group_id = Column(Integer, ForeignKey("groups.group_id"))
-    user_id = Column(Integer, ForeignKey("users.user_id"))
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
     is_admin = Column(Boolean, default=False)
 
     group = relationship("Group", back_populates="groupmembers")
@@ -54,9 +67,9 @@ class Expense(Base):
     __tablename__ = "expenses"
 
     expense_id = Column(Integer, primary_key=True, index=True)
-    group_id = Column(Integer, ForeignKey("groups.group_id"))
+    group_id = Column(Integer, ForeignKey("groups.group_id"), index=True)
     description = Column(String)
-    amount = Column(Float)
+    amount = Column(BigInteger)
     created_by = Column(Integer, ForeignKey("users.user_id"))
     created_at = Column(DateTime, default=datetime.now)
     group = relationship("Group", back_populates="groupexpenses")
@@ -69,19 +82,103 @@ class ExpenseParticipant(Base):
     __tablename__ = "expense_participants"
 
     expense_participant_id = Column(Integer, primary_key=True, index=True)
-    expense_id = Column(Integer, ForeignKey("expenses.expense_id"))
-    user_id = Column(Integer, ForeignKey("users.user_id"))
-    amount_paid = Column(Float)
-    amount_owed = Column(Float)
+    expense_id = Column(Integer, ForeignKey("expenses.expense_id"), index=True)
+    user_id = Column(Integer, ForeignKey("users.user_id"), index=True)
+    amount_paid = Column(BigInteger)
+    amount_owed = Column(BigInteger)
     expense = relationship("Expense", back_populates="expense_participants")
 
 
 class Dept(Base):
     __tablename__ = "dept"
+    __table_args__ = (
+        Index("ix_dept_group_user", "group_id", "user_id"),
+        Index("ix_dept_group_lender", "group_id", "lender_id"),
+        # Ids of deleted depts stay in the ledger, they must not be reused
+        {"sqlite_autoincrement": True},
+    )
 
     dept_id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey("users.user_id"))
     lender_id = Column(Integer, ForeignKey("users.user_id"))
     group_id = Column(Integer, ForeignKey("groups.group_id"))
-    amount = Column(Float)
+    amount = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class MemberBalance(Base):
+    __tablename__ = "member_balances"
+    __table_args__ = (
+        Index(
+            "ix_member_balances_group_user", "group_id", "user_id", unique=True
+        ),
+    )
+
+    member_balance_id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.group_id"))
+    user_id = Column(Integer, ForeignKey("users.user_id"))
+    net_amount = Column(BigInteger, default=0)
+
+
+class LedgerEntry(Base):
+    """One append-only change to what ``user_id`` owes ``lender_id``.
+
+    Rows are never updated or deleted. ``expense_id`` and ``dept_id`` are
+    kept for reference only, without foreign keys, since the expense or
+    dept an entry came from may be deleted later.
+    """
+
+    __tablename__ = "ledger_entries"
+    __table_args__ = (
+        Index("ix_ledger_entries_group_entry", "group_id", "entry_id"),
+        Index("ix_ledger_entries_expense", "expense_id"),
+    )
+
+    entry_id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.group_id"))
+    user_id = Column(Integer, ForeignKey("users.user_id"))
+    lender_id = Column(Integer, ForeignKey("users.user_id"))
+    amount = Column(BigInteger)
+    kind = Column(String)
+    expense_id = Column(Integer)
+    dept_id = Column(Integer)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class BalanceSnapshot(Base):
+    """A member's net balance over the ledger up to ``last_entry_id``."""
+
+    __tablename__ = "balance_snapshots"
+    __table_args__ = (
+        # One row per member and snapshot, a duplicate would count twice
+        Index(
+            "ix_balance_snapshots_group_entry_user",
+            "group_id",
+            "last_entry_id",
+            "user_id",
+            unique=True,
+        ),
+    )
+
+    snapshot_id = Column(Integer, primary_key=True, index=True)
+    group_id = Column(Integer, ForeignKey("groups.group_id"))
+    last_entry_id = Column(Integer)
+    user_id = Column(Integer, ForeignKey("users.user_id"))
+    net_amount = Column(BigInteger)
+    created_at = Column(DateTime, default=datetime.now)
+
+
+class IdempotencyKey(Base):
+    """The response to a request made with an ``Idempotency-Key`` header.
+
+    ``fingerprint`` identifies the request the key was first used with,
+    see app.idempotency. Rows older than IDEMPOTENCY_TTL are deleted.
+    """
+
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_created_at", "created_at"),)
+
+    key = Column(String(255), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    response = Column(Text, nullable=False)
     created_at = Column(DateTime, default=datetime.now)
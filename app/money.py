@@ -0,0 +1,33 @@
+"""Money is stored and passed around as integer minor units (kopecks).
+
+Integers add up exactly, so totals, depts and balances can be summed
+and compared without rounding, and a split never loses or invents a
+kopeck.
+"""
+
+# Minor units per rouble
+MINOR_UNITS = 100
+
+
+def split_amount(total, member_ids, offset=0):
+    """Split ``total`` minor units between ``member_ids``.
+
+    Every member gets ``total // n``. The ``total % n`` units left over go
+    one each to the members that follow ``offset`` in user id order, so
+    the shares always add up to ``total``. Passing the expense id as
+    ``offset`` spreads the extra kopecks over the group instead of
+    charging them to the same member every time, and splitting the same
+    expense again gives the same shares.
+
+    Returns a dict of user id to share, empty when there are no members.
+    """
+    member_ids = sorted(member_ids)
+    if not member_ids:
+        return {}
+
+    base, remainder = divmod(total, len(member_ids))
+
+    shares = dict.fromkeys(member_ids, base)
+    for i in range(remainder):
+        shares[member_ids[(offset + i) % len(member_ids)]] += 1
+    return shares
@@ -0,0 +1,110 @@
+import base64
+import json
+
+from fastapi import HTTPException
+from sqlalchemy import func, inspect, select
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def check_limit(limit):
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"limit must be between 1 and {MAX_PAGE_SIZE}",
+        )
+
+
+def encode_cursor(*values):
+    """Opaque cursor holding the sort key of the last row of a page."""
+    data = json.dumps(values, default=str).encode()
+    return base64.urlsafe_b64encode(data).decode()
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def select_fields(model, schema, fields):
+    """Columns of ``model`` named in ``fields``, e.g. ``"user_id,email"``.
+
+    Only the columns the response model ``schema`` has can be selected,
+    all of them when ``fields`` is None. The primary key is always
+    selected, pages are keyed on it.
+    """
+    mapper = inspect(model)
+    columns = {
+        attr.key: getattr(model, attr.key)
+        for attr in mapper.column_attrs
+        if attr.key in schema.model_fields
+    }
+    key = mapper.primary_key[0].key
+    if fields is None:
+        return list(columns.values())
+
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = sorted(set(names) - set(columns))
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
+        )
+    names = [key] + [name for name in dict.fromkeys(names) if name != key]
+    return [columns[name] for name in names]
+
+
+def count_query(statement):
+    """COUNT(*) of the rows ``statement`` selects, for X-Total-Count."""
+    return select(func.count()).select_from(
+        statement.order_by(None).subquery()
+    )
+
+
+def after_cursor(statement, key, cursor):
+    """``statement`` ordered by ``key``, from the row after ``cursor``."""
+    if cursor is not None:
+        (after,) = decode_cursor(cursor, 1)
+        if not isinstance(after, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        statement = statement.where(key > after)
+    return statement.order_by(key)
+
+
+def page_query(statement, key, limit, cursor):
+    """``statement`` restricted to the page after ``cursor``.
+
+    Rows are ordered by ``key``, a unique integer column such as the
+    primary key. One row more than ``limit`` is selected, ``page_rows``
+    uses it to tell whether there is a next page.
+    """
+    check_limit(limit)
+    return after_cursor(statement, key, cursor).limit(limit + 1)
+
+
+def page_rows(rows, key, limit, response):
+    """The rows of a ``page_query`` page, setting X-Next-Cursor."""
+    if len(rows) > limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(
+            getattr(rows[limit - 1], key.key)
+        )
+    return [row._asdict() for row in rows[:limit]]
+
+
+def fetch_page(db, statement, key, response, limit, cursor, count):
+    """Run a keyset page of ``statement`` on the Session ``db``.
+
+    X-Total-Count is set unless ``count`` is false, it costs one more
+    COUNT(*) query over the same filters.
+    """
+    if count:
+        total = db.execute(count_query(statement)).scalar_one()
+        response.headers["X-Total-Count"] = str(total)
+    rows = db.execute(page_query(statement, key, limit, cursor)).all()
+    return page_rows(rows, key, limit, response)
@@ -0,0 +1,163 @@
+"""Recompute a group's depts and balances from its ledger with NumPy.
+
+Every change to a dept is a ledger entry, see ``app.ledger``, so the
+depts of a group are the entries summed per pair of members and netted
+in one direction. Rather than replaying the entries one row at a time
+like ``app.reconcile`` does for a single expense, the database sums the
+group's ledger per pair, and the sums are loaded as int64 columns and
+netted in a members x members matrix in one pass. That is what makes
+checking a group with hundreds of members and millions of entries
+affordable.
+
+``recompute_depts`` compares the result with the stored Dept and
+MemberBalance rows and can write it back.
+"""
+
+import itertools
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app.balances import rebuild_member_balances
+from app.models import Dept, LedgerEntry, MemberBalance
+
+
+def load_entries(db, group_id):
+    """The group's ledger as int64 columns, summed per pair of members.
+
+    Returns ``(user_ids, lender_ids, amounts, counts)`` with one row per
+    ``(user_id, lender_id)`` pair that has entries, ``counts`` being how
+    many. The database does the summing, so a group with millions of
+    entries loads at most members x members rows.
+    """
+    rows = db.execute(
+        select(
+            LedgerEntry.user_id,
+            LedgerEntry.lender_id,
+            func.sum(LedgerEntry.amount),
+            func.count(),
+        )
+        .where(LedgerEntry.group_id == group_id)
+        .group_by(LedgerEntry.user_id, LedgerEntry.lender_id)
+    ).all()
+    columns = np.fromiter(
+        itertools.chain.from_iterable(rows),
+        dtype=np.int64,
+        count=4 * len(rows),
+    ).reshape(-1, 4)
+    return tuple(columns.T)
+
+
+def dept_matrix(user_ids, lender_ids, amounts):
+    """Net depts between the users of a ledger.
+
+    Returns ``(members, owed)``: the sorted user ids and a matrix where
+    ``owed[i, j]`` is what ``members[j]`` owes ``members[i]``. At most
+    one of ``owed[i, j]`` and ``owed[j, i]`` is positive, the other is 0.
+    """
+    members, index = np.unique(
+        np.concatenate([lender_ids, user_ids]), return_inverse=True
+    )
+    n, count = len(members), len(amounts)
+    lenders, users = index[:count], index[count:]
+
+    # np.add.at sums repeated pairs exactly, in int64
+    owed = np.zeros(n * n, dtype=np.int64)
+    np.add.at(owed, lenders * n + users, amounts)
+    owed = owed.reshape(n, n)
+    return members, np.maximum(owed - owed.T, 0)
+
+
+def matrix_balances(members, owed):
+    """Net balance per user, positive when the user is owed."""
+    net = owed.sum(axis=1) - owed.sum(axis=0)
+    return dict(zip(members.tolist(), net.tolist()))
+
+
+def matrix_depts(members, owed):
+    """The depts in ``owed`` as ``{(lender_id, user_id): amount}``."""
+    lenders, users = np.nonzero(owed)
+    return dict(
+        zip(
+            zip(members[lenders].tolist(), members[users].tolist()),
+            owed[lenders, users].tolist(),
+        )
+    )
+
+
+def _mismatches(expected, stored):
+    # A stored dept of 0 is a mismatch too, settled depts are deleted
+    return [
+        {
+            "lender_id": key[0],
+            "user_id": key[1],
+            "expected": expected.get(key, 0),
+            "stored": stored.get(key, 0),
+        }
+        for key in sorted(set(expected) | set(stored))
+        if expected.get(key) != stored.get(key)
+    ]
+
+
+def _drift(expected, stored):
+    return [
+        {
+            "user_id": user_id,
+            "expected": expected.get(user_id, 0),
+            "stored": stored.get(user_id, 0),
+        }
+        for user_id in sorted(set(expected) | set(stored))
+        if expected.get(user_id, 0) != stored.get(user_id, 0)
+    ]
+
+
+def recompute_depts(db, group_id, persist=False):
+    """Check the group's Dept and MemberBalance rows against its ledger.
+
+    Returns the ``RecomputeResult`` fields. With ``persist`` the Dept
+    rows that differ are replaced and the balances rebuilt from them.
+    Nothing is committed, the caller holds the group's lock and commits.
+    """
+    user_ids, lender_ids, amounts, counts = load_entries(db, group_id)
+    members, owed = dept_matrix(user_ids, lender_ids, amounts)
+    expected = matrix_depts(members, owed)
+
+    depts = db.query(Dept).filter(Dept.group_id == group_id).all()
+    stored = {}
+    for dept in depts:
+        key = (dept.lender_id, dept.user_id)
+        stored[key] = stored.get(key, 0) + dept.amount
+    mismatches = _mismatches(expected, stored)
+
+    balances = dict(
+        db.query(MemberBalance.user_id, MemberBalance.net_amount).filter(
+            MemberBalance.group_id == group_id
+        )
+    )
+    drift = _drift(matrix_balances(members, owed), balances)
+
+    if persist and mismatches:
+        wrong = {(m["lender_id"], m["user_id"]) for m in mismatches}
+        for dept in depts:
+            if (dept.lender_id, dept.user_id) in wrong:
+                db.delete(dept)
+        db.add_all(
+            Dept(
+                user_id=user_id,
+                lender_id=lender_id,
+                group_id=group_id,
+                amount=expected[(lender_id, user_id)],
+            )
+            for lender_id, user_id in sorted(wrong & set(expected))
+        )
+        db.flush()
+    if persist:
+        rebuild_member_balances(db, group_id)
+
+    return {
+        "entries": int(counts.sum()),
+        "depts": len(expected),
+        "mismatches": mismatches,
+        "drift": drift,
+        "persisted": persist,
+    }
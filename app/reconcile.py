@@ -0,0 +1,61 @@
+"""Dept reconciliation of expenses, on plain dicts rather than rows.
+
+A group's depts are a mapping of ``(lender_id, user_id)`` to the amount
+``user_id`` owes ``lender_id``, in minor units. Between two members only
+one direction is ever kept: charging a member who is owed by the payer
+first pays that dept off, and only the rest becomes a dept the other
+way round. Pairs that come out even are dropped.
+
+Nothing here touches the database. The endpoints load the depts into
+such a mapping, run the functions below and write the changed keys back
+as Dept rows, see ``app.api.expenses``.
+"""
+
+from collections import defaultdict
+
+
+def new_deltas():
+    return defaultdict(int)
+
+
+def record_dept_change(deltas, user_id, lender_id, change):
+    """Record that ``user_id`` now owes ``lender_id`` ``change`` more."""
+    deltas[lender_id] += change
+    deltas[user_id] -= change
+
+
+def add_dept(amounts, user_id, lender_id, amount):
+    """Make ``user_id`` owe ``lender_id`` ``amount`` more in ``amounts``.
+
+    A negative ``amount`` makes ``lender_id`` owe ``user_id`` instead.
+    """
+    net = (
+        amounts.pop((lender_id, user_id), 0)
+        - amounts.pop((user_id, lender_id), 0)
+        + amount
+    )
+    if net > 0:
+        amounts[(lender_id, user_id)] = net
+    elif net < 0:
+        amounts[(user_id, lender_id)] = -net
+
+
+def split_expense(amounts, payer_id, shares, deltas, sign=1):
+    """Charge every member their share of an expense paid by ``payer_id``.
+
+    ``shares`` maps each member to their share, see ``split_amount``.
+    ``sign=-1`` undoes the expense, e.g. when it is deleted. Every
+    change is recorded in ``deltas`` for the member balances.
+
+    Returns the keys of ``amounts`` that were changed, added or removed.
+    """
+    changed = set()
+    for member_id, share in shares.items():
+        if member_id == payer_id or not share:
+            continue
+
+        add_dept(amounts, member_id, payer_id, sign * share)
+        record_dept_change(deltas, member_id, payer_id, sign * share)
+        changed.add((payer_id, member_id))
+        changed.add((member_id, payer_id))
+    return changed
@@ -0,0 +1,209 @@
+"""Response models of the API.
+
+Each model lists the columns a response carries, so serializing an ORM
+object reads exactly those attributes and never a relationship that
+wasn't loaded by the endpoint's query. Columns are nullable in the
+database and Optional here, list endpoints that take ``fields=`` leave
+out the ones that weren't selected.
+"""
+
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel, ConfigDict
+
+
+class ORMModel(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+
+class Message(BaseModel):
+    message: str
+
+
+class LoginResult(BaseModel):
+    status: str
+    user_id: int
+    email: Optional[str] = None
+
+
+class UserOut(ORMModel):
+    user_id: int
+    username: Optional[str] = None
+    email: Optional[str] = None
+
+
+class GroupOut(ORMModel):
+    group_id: int
+    group_name: Optional[str] = None
+    created_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+    total_expenses: Optional[int] = None
+    total_members: Optional[int] = None
+
+
+class MembershipOut(ORMModel):
+    membership_id: int
+    group_id: Optional[int] = None
+    user_id: Optional[int] = None
+    is_admin: Optional[bool] = None
+
+
+class ExpenseOut(ORMModel):
+    expense_id: int
+    group_id: Optional[int] = None
+    description: Optional[str] = None
+    amount: Optional[int] = None
+    created_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class ParticipantOut(ORMModel):
+    expense_participant_id: int
+    expense_id: Optional[int] = None
+    user_id: Optional[int] = None
+    amount_paid: Optional[int] = None
+    amount_owed: Optional[int] = None
+
+
+class ExpenseDetail(ExpenseOut):
+    expense_participants: List[ParticipantOut] = []
+
+
+class GroupDetail(GroupOut):
+    groupmembers: List[MembershipOut] = []
+    groupexpenses: List[ExpenseOut] = []
+
+
+class UserExpenseOut(BaseModel):
+    expense_participant_id: int
+    expense_id: int
+    user_id: int
+    amount_paid: Optional[int] = None
+    amount_owed: Optional[int] = None
+    expense_description: Optional[str] = None
+    expense_amount: Optional[int] = None
+    expense_created_at: Optional[datetime] = None
+
+
+class DeptOut(ORMModel):
+    dept_id: int
+    user_id: Optional[int] = None
+    lender_id: Optional[int] = None
+    group_id: Optional[int] = None
+    amount: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class BalanceOut(BaseModel):
+    user_id: int
+    net_amount: int
+
+
+class Drift(BaseModel):
+    user_id: int
+    expected: int
+    stored: int
+
+
+class RebuildResult(BaseModel):
+    drift: List[Drift]
+
+
+class DeptMismatch(BaseModel):
+    lender_id: int
+    user_id: int
+    expected: int
+    stored: int
+
+
+class RecomputeResult(BaseModel):
+    entries: int
+    depts: int
+    mismatches: List[DeptMismatch]
+    drift: List[Drift]
+    persisted: bool
+
+
+class LedgerEntryOut(ORMModel):
+    entry_id: int
+    group_id: Optional[int] = None
+    user_id: Optional[int] = None
+    lender_id: Optional[int] = None
+    amount: Optional[int] = None
+    kind: Optional[str] = None
+    expense_id: Optional[int] = None
+    dept_id: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class SnapshotResult(BaseModel):
+    last_entry_id: Optional[int] = None
+
+
+class DashboardMember(BaseModel):
+    user_id: Optional[int] = None
+    is_admin: Optional[bool] = None
+    username: Optional[str] = None
+
+
+class DashboardExpense(BaseModel):
+    expense_id: int
+    description: Optional[str] = None
+    amount: Optional[int] = None
+    created_by: Optional[int] = None
+    created_at: Optional[datetime] = None
+
+
+class DashboardDept(BaseModel):
+    dept_id: int
+    user_id: Optional[int] = None
+    username: Optional[str] = None
+    lender_id: Optional[int] = None
+    lender_username: Optional[str] = None
+    amount: Optional[int] = None
+
+
+class GroupDashboard(GroupOut):
+    members: List[DashboardMember]
+    expenses: List[DashboardExpense]
+    depts: List[DashboardDept]
+    balances: List[BalanceOut]
+
+
+class Transfer(BaseModel):
+    user_id: int
+    lender_id: int
+    amount: int
+
+
+class SimplifyResult(BaseModel):
+    depts_before: int
+    depts_after: int
+    persisted: bool
+    transfers: List[Transfer]
+
+
+class BatchError(BaseModel):
+    index: int
+    detail: str
+
+
+class BatchResult(BaseModel):
+    created: List[ExpenseOut]
+    errors: List[BatchError]
+
+
+class RowError(BaseModel):
+    row: int
+    detail: str
+
+
+class ImportProgress(BaseModel):
+    rows_read: int
+    imported: int
+    failed: int
+    chunks_committed: int
+    next_offset: int
+    complete: bool
+    errors: List[RowError]
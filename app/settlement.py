@@ -0,0 +1,46 @@
+import heapq
+from collections import defaultdict
+
+# Balances below this are treated as settled: one kopeck, see app.money
+MIN_AMOUNT = 1
+
+
+def net_balances(depts):
+    """Net amount per user over ``depts``, positive when the user is owed."""
+    balances = defaultdict(int)
+    for dept in depts:
+        balances[dept.lender_id] += dept.amount
+        balances[dept.user_id] -= dept.amount
+    return dict(balances)
+
+
+def simplify_debts(balances):
+    """Settle ``balances`` with as few transfers as the greedy rule allows.
+
+    The largest creditor is repeatedly matched with the largest debtor
+    (two max-heaps), which settles at least one of them per transfer, so
+    a group of n members never needs more than n - 1 transfers.
+
+    Returns ``(user_id, lender_id, amount)`` tuples where ``user_id``
+    owes ``lender_id``, the same orientation as a Dept row.
+    """
+    creditors = [(-b, u) for u, b in balances.items() if b >= MIN_AMOUNT]
+    debtors = [(b, u) for u, b in balances.items() if b <= -MIN_AMOUNT]
+    heapq.heapify(creditors)
+    heapq.heapify(debtors)
+
+    transfers = []
+    while creditors and debtors:
+        credit, lender_id = heapq.heappop(creditors)
+        debt, user_id = heapq.heappop(debtors)
+        credit, debt = -credit, -debt
+
+        amount = min(credit, debt)
+        transfers.append((user_id, lender_id, amount))
+
+        if credit - amount >= MIN_AMOUNT:
+            heapq.heappush(creditors, (amount - credit, lender_id))
+        if debt - amount >= MIN_AMOUNT:
+            heapq.heappush(debtors, (amount - debt, user_id))
+
+    return transfers
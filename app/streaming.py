@@ -0,0 +1,71 @@
+"""Stream list endpoints as NDJSON, one JSON object per line.
+
+A list endpoint asked for ``Accept: application/x-ndjson`` returns every
+row after ``cursor`` instead of a page. Rows are fetched ``yield_per`` at
+a time from a server-side cursor and written out batch by batch, so an
+export of a whole group holds one batch in memory rather than the
+result.
+
+The response is written after the endpoint has returned and its
+``get_db`` session is closed, so the generator opens a session of its
+own on the same engine and closes it once the last row is sent.
+"""
+
+import os
+
+import orjson
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from app.pagination import after_cursor
+
+NDJSON = "application/x-ndjson"
+
+# Rows fetched from the database and written out at a time
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+
+def wants_ndjson(accept):
+    """Whether the Accept header ``accept`` asks for NDJSON."""
+    return accept is not None and NDJSON in accept
+
+
+def stream_statement(statement, key, cursor):
+    return after_cursor(statement, key, cursor).execution_options(
+        yield_per=STREAM_BATCH_SIZE
+    )
+
+
+def ndjson_lines(rows):
+    return b"".join(orjson.dumps(row._asdict()) + b"\n" for row in rows)
+
+
+def stream_rows(db, statement, key, cursor):
+    """NDJSON response with the rows of ``statement`` after ``cursor``.
+
+    ``db`` is the request's Session, only its engine is used.
+    """
+    statement = stream_statement(statement, key, cursor)
+    bind = db.get_bind()
+
+    def lines():
+        with Session(bind) as session:
+            for rows in session.execute(statement).partitions():
+                yield ndjson_lines(rows)
+
+    return StreamingResponse(lines(), media_type=NDJSON)
+
+
+def stream_rows_async(db, statement, key, cursor):
+    """``stream_rows`` for the AsyncSession ``db``."""
+    statement = stream_statement(statement, key, cursor)
+    bind = db.bind
+
+    async def lines():
+        async with AsyncSession(bind) as session:
+            result = await session.stream(statement)
+            async for rows in result.partitions():
+                yield ndjson_lines(rows)
+
+    return StreamingResponse(lines(), media_type=NDJSON)
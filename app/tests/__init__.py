@@ -0,0 +1,11 @@
+import os
+import tempfile
+
+# app.main migrates DATABASE_URL when it is imported. The tests bring
+# their own engines, so point the app's at a throwaway database rather
+# than the tracked lazy_split.db (or whatever .env names).
+_database_dir = tempfile.TemporaryDirectory()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(
+    _database_dir.name, "lazy_split.db"
+)
+os.environ.pop("ASYNC_DATABASE_URL", None)
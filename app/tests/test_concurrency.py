@@ -0,0 +1,235 @@
+import os
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from unittest import mock
+
+from fastapi import HTTPException
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+from app.api.dept import DeptPaid, update_dept_amount
+from app.api.expenses import ExpenseCreate, create_expense, delete_expense
+from app.api.groups import add_group_member
+from app.database import Base, create_db_engine
+from app.ledger import ledger_balances
+from app.locks import KeyedLock
+from app.models import (
+    Dept,
+    Expense,
+    Group,
+    GroupMembership,
+    MemberBalance,
+    User,
+)
+from app.settlement import net_balances
+
+THREADS = 8
+ROUNDS = 15
+
+
+class TestKeyedLock(unittest.TestCase):
+    def test_serializes_one_key(self):
+        locks = KeyedLock()
+        inside, overlaps = [0], []
+
+        def work(_):
+            with locks.hold(1):
+                inside[0] += 1
+                overlaps.append(inside[0])
+                threading.Event().wait(0.001)
+                inside[0] -= 1
+
+        with ThreadPoolExecutor(THREADS) as pool:
+            list(pool.map(work, range(50)))
+
+        assert max(overlaps) == 1
+
+    def test_other_keys_run_concurrently(self):
+        locks = KeyedLock()
+        with locks.hold(1):
+            acquired = threading.Event()
+
+            def other():
+                with locks.hold(2):
+                    acquired.set()
+
+            thread = threading.Thread(target=other)
+            thread.start()
+            assert acquired.wait(5)
+            thread.join()
+
+    def test_drops_released_keys(self):
+        locks = KeyedLock()
+        with locks.hold(1):
+            assert len(locks) == 1
+        assert len(locks) == 0
+
+
+class TestGroupWriteStress(unittest.TestCase):
+    """Many threads writing to one group of a database file."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(self.tmp.name, "lazy_split.db")
+        self.engine = create_db_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=self.engine)
+        self.Session = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine
+        )
+
+        with self.Session() as db:
+            users = [
+                User(
+                    username=f"user{i}",
+                    email=f"user{i}@example.com",
+                    password="password",
+                )
+                for i in range(THREADS * 2)
+            ]
+            db.add_all(users)
+            db.flush()
+            group = Group(group_name="Stress", created_by=users[0].user_id)
+            db.add(group)
+            db.flush()
+            db.add_all(
+                GroupMembership(group_id=group.group_id, user_id=u.user_id)
+                for u in users[:THREADS]
+            )
+            group.total_members = THREADS
+            db.commit()
+            self.group_id = group.group_id
+            self.user_ids = [u.user_id for u in users]
+
+    def tearDown(self):
+        self.engine.dispose()
+        self.tmp.cleanup()
+
+    def hammer(self, worker):
+        barrier = threading.Barrier(THREADS)
+
+        def run(thread):
+            barrier.wait()
+            for i in range(ROUNDS):
+                with self.Session() as db:
+                    worker(db, thread, i)
+
+        with ThreadPoolExecutor(THREADS) as pool:
+            for future in [pool.submit(run, t) for t in range(THREADS)]:
+                future.result()
+
+    def create(self, db, thread, i):
+        return create_expense(
+            ExpenseCreate(
+                group_id=self.group_id,
+                description=f"expense {thread}-{i}",
+                amount=1000 + 7 * thread + i,
+                created_by=self.user_ids[(thread + i) % THREADS],
+            ),
+            db=db,
+        )
+
+    def assert_invariants(self):
+        with self.Session() as db:
+            group = db.get(Group, self.group_id)
+            total = (
+                db.query(func.sum(Expense.amount))
+                .filter(Expense.group_id == self.group_id)
+                .scalar()
+            )
+            members = (
+                db.query(GroupMembership)
+                .filter(GroupMembership.group_id == self.group_id)
+                .count()
+            )
+            depts = db.query(Dept).filter(Dept.group_id == self.group_id).all()
+            stored = {
+                row.user_id: row.net_amount
+                for row in db.query(MemberBalance).filter(
+                    MemberBalance.group_id == self.group_id
+                )
+                if row.net_amount
+            }
+            ledger = {
+                user_id: amount
+                for user_id, amount in ledger_balances(
+                    db, self.group_id
+                ).items()
+                if amount
+            }
+
+            assert group.total_expenses == (total or 0)
+            assert group.total_members == members
+            assert all(d.amount > 0 for d in depts)
+            # One dept per pair and direction at most
+            assert len({(d.user_id, d.lender_id) for d in depts}) == len(depts)
+            expected = {k: v for k, v in net_balances(depts).items() if v}
+            assert stored == expected
+            assert ledger == expected
+            assert sum(stored.values()) == 0
+
+    def test_concurrent_expenses(self):
+        self.hammer(self.create)
+        self.assert_invariants()
+
+        with self.Session() as db:
+            count = (
+                db.query(Expense)
+                .filter(Expense.group_id == self.group_id)
+                .count()
+            )
+        assert count == THREADS * ROUNDS
+
+    def test_concurrent_payments_across_processes(self):
+        with self.Session() as db:
+            self.create(db, 0, 0)
+            dept_id = db.query(Dept.dept_id).limit(1).scalar()
+            amount = db.get(Dept, dept_id).amount
+
+        def pay(db, thread, i):
+            update_dept_amount(
+                dept_id=dept_id, dept_paid=DeptPaid(amount=1), db=db
+            )
+
+        # Workers in other processes don't share group_locks, only the
+        # database can serialize them
+        with mock.patch.object(
+            KeyedLock, "hold", lambda self, key: nullcontext()
+        ):
+            self.hammer(pay)
+
+        with self.Session() as db:
+            assert db.get(Dept, dept_id).amount == amount - THREADS * ROUNDS
+        self.assert_invariants()
+
+    def test_concurrent_mixed_writes(self):
+        def worker(db, thread, i):
+            created = self.create(db, thread, i)
+            if i % 3 == 1:
+                delete_expense(expense_id=created["expense_id"], db=db)
+            elif i % 3 == 2:
+                dept_id = (
+                    db.query(Dept.dept_id)
+                    .filter(Dept.group_id == self.group_id)
+                    .order_by(Dept.dept_id)
+                    .limit(1)
+                    .scalar()
+                )
+                try:
+                    update_dept_amount(
+                        dept_id=dept_id, dept_paid=DeptPaid(amount=1), db=db
+                    )
+                except HTTPException as exc:
+                    # Paid off by another thread in the meantime
+                    assert exc.status_code == 404
+            if i == 0:
+                add_group_member(
+                    group_id=self.group_id,
+                    user_id=self.user_ids[THREADS + thread],
+                    db=db,
+                )
+
+        self.hammer(worker)
+        self.assert_invariants()
@@ -4,6 +4,8 @@ from sqlalchemy import create_engine, StaticPool
 from sqlalchemy.orm import sessionmaker
 from app.database import get_db, Base
 from app.main import app
+from app.money import split_amount
+from app.reconcile import add_dept, new_deltas, split_expense
 import unittest
 
 client = TestClient(app)
@@ -170,3 +172,81 @@ class TestExpenseFuzz(unittest.TestCase):
             },
         )
         assert response.status_code == 200 or response.status_code == 404
+
+
+def net_of(amounts):
+    balances = {}
+    for (lender_id, user_id), amount in amounts.items():
+        balances[lender_id] = balances.get(lender_id, 0) + amount
+        balances[user_id] = balances.get(user_id, 0) - amount
+    return {u: b for u, b in balances.items() if b}
+
+
+@st.composite
+def group_depts(draw):
+    """Members, a payer among them and depts built with ``add_dept``."""
+    members = draw(
+        st.lists(
+            st.integers(min_value=1, max_value=60),
+            min_size=1,
+            max_size=25,
+            unique=True,
+        )
+    )
+    payer_id = draw(st.sampled_from(members))
+    amounts = {}
+    member = st.sampled_from(members)
+    for user_id, lender_id, amount in draw(
+        st.lists(st.tuples(member, member, amount_strategy), max_size=40)
+    ):
+        if user_id != lender_id:
+            add_dept(amounts, user_id, lender_id, amount)
+    return members, payer_id, amounts
+
+
+class TestReconcileProperties(unittest.TestCase):
+    @given(
+        group=group_depts(),
+        total=st.integers(min_value=0, max_value=10**9),
+        offset=st.integers(min_value=0, max_value=1000),
+    )
+    def test_split_expense_conserves_money(self, group, total, offset):
+        members, payer_id, amounts = group
+        before = net_of(amounts)
+        shares = split_amount(total, members, offset)
+        deltas = new_deltas()
+
+        split_expense(amounts, payer_id, shares, deltas)
+
+        # The payer is owed what the others were charged, nothing more
+        assert sum(deltas.values()) == 0
+        assert deltas[payer_id] == total - shares[payer_id]
+        expected = dict(before)
+        for user_id, delta in deltas.items():
+            expected[user_id] = expected.get(user_id, 0) + delta
+        assert net_of(amounts) == {u: b for u, b in expected.items() if b}
+
+        # One positive dept per pair of members at most
+        assert all(amount > 0 for amount in amounts.values())
+        assert not any((user, lender) in amounts for lender, user in amounts)
+
+    @given(
+        group=group_depts(),
+        total=st.integers(min_value=0, max_value=10**9),
+    )
+    def test_split_expense_undone(self, group, total):
+        members, payer_id, amounts = group
+        before = dict(amounts)
+        shares = split_amount(total, members)
+        deltas = new_deltas()
+
+        changed = split_expense(amounts, payer_id, shares, deltas)
+        assert {
+            key
+            for key in set(before) | set(amounts)
+            if before.get(key) != amounts.get(key)
+        } <= changed
+
+        split_expense(amounts, payer_id, shares, deltas, sign=-1)
+        assert amounts == before
+        assert not any(deltas.values())
@@ -0,0 +1,266 @@
+import unittest
+
+import pytest
+from sqlalchemy import and_, create_engine, inspect, or_, select, StaticPool
+from sqlalchemy.exc import IntegrityError
+
+from app.database import Base
+from app.migrate import migrate
+from app.models import (
+    Dept,
+    Expense,
+    ExpenseParticipant,
+    Group,
+    GroupMembership,
+    LedgerEntry,
+    BalanceSnapshot,
+    MemberBalance,
+)
+
+DATABASE_URL = "sqlite:///:memory:"
+
+# The queries issued on every expense write and dept read
+HOT_QUERIES = {
+    "membership check": select(GroupMembership).where(
+        and_(GroupMembership.user_id == 1, GroupMembership.group_id == 1)
+    ),
+    "group members": select(GroupMembership.user_id).where(
+        GroupMembership.group_id == 1
+    ),
+    "user groups": select(Group)
+    .join(Group.groupmembers)
+    .where(GroupMembership.user_id == 1),
+    "group depts": select(Dept).where(Dept.group_id == 1),
+    "user depts": select(Dept).where(
+        Dept.group_id == 1, or_(Dept.user_id == 1, Dept.lender_id == 1)
+    ),
+    "group expenses": select(Expense).where(Expense.group_id == 1),
+    "expense participants": select(ExpenseParticipant).where(
+        ExpenseParticipant.expense_id == 1
+    ),
+    "user participations": select(ExpenseParticipant).where(
+        ExpenseParticipant.user_id == 1
+    ),
+    "member balances": select(MemberBalance).where(
+        MemberBalance.group_id == 1, MemberBalance.user_id.in_([1, 2])
+    ),
+    "ledger tail": select(LedgerEntry).where(
+        LedgerEntry.group_id == 1, LedgerEntry.entry_id > 10
+    ),
+    "expense entries": select(LedgerEntry).where(
+        LedgerEntry.expense_id == 1, LedgerEntry.kind == "expense"
+    ),
+    "latest snapshot": select(BalanceSnapshot).where(
+        BalanceSnapshot.group_id == 1, BalanceSnapshot.last_entry_id == 10
+    ),
+}
+
+# The tables as created before the indexes were added
+OLD_SCHEMA = [
+    "CREATE TABLE group_memberships (membership_id INTEGER NOT NULL, "
+    "group_id INTEGER, user_id INTEGER, is_admin BOOLEAN, "
+    "PRIMARY KEY (membership_id))",
+    "CREATE TABLE dept (dept_id INTEGER NOT NULL, user_id INTEGER, "
+    "lender_id INTEGER, group_id INTEGER, amount FLOAT, "
+    "created_at DATETIME, PRIMARY KEY (dept_id))",
+    "INSERT INTO group_memberships (group_id, user_id, is_admin) "
+    "VALUES (1, 1, 1), (1, 1, 0), (1, 2, 0)",
+]
+
+
+class TestQueryPlan(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine(DATABASE_URL, poolclass=StaticPool)
+        Base.metadata.create_all(bind=self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_hot_queries_use_index(self):
+        with self.engine.connect() as conn:
+            for name, query in HOT_QUERIES.items():
+                sql = query.compile(
+                    self.engine, compile_kwargs={"literal_binds": True}
+                )
+                plan = [
+                    row[-1]
+                    for row in conn.exec_driver_sql(
+                        f"EXPLAIN QUERY PLAN {sql}"
+                    )
+                ]
+                for step in plan:
+                    with self.subTest(query=name, step=step):
+                        assert step.startswith("SEARCH"), plan
+
+
+class TestMigrate(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_engine(DATABASE_URL, poolclass=StaticPool)
+        with self.engine.begin() as conn:
+            for statement in OLD_SCHEMA:
+                conn.exec_driver_sql(statement)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_migrate_creates_indexes(self):
+        created = migrate(self.engine)
+
+        assert "ix_group_memberships_group_user" in created
+        assert "ix_dept_group_user" in created
+        assert "ix_dept_group_lender" in created
+
+        indexes = inspect(self.engine).get_indexes("dept")
+        assert {"ix_dept_group_user", "ix_dept_group_lender"} <= {
+            i["name"] for i in indexes
+        }
+
+    def test_migrate_removes_duplicate_memberships(self):
+        migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT membership_id, group_id, user_id "
+                "FROM group_memberships ORDER BY membership_id"
+            ).all()
+
+        assert [tuple(r) for r in rows] == [(1, 1, 1), (3, 1, 2)]
+
+    def test_migrate_converts_money_to_minor_units(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO dept (user_id, lender_id, group_id, amount) "
+                "VALUES (2, 1, 1, 12.5), (3, 1, 1, 33.333333)"
+            )
+
+        migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT amount, typeof(amount) FROM dept ORDER BY dept_id"
+            ).all()
+        columns = {
+            c["name"]: c for c in inspect(self.engine).get_columns("dept")
+        }
+        indexes = {i["name"] for i in inspect(self.engine).get_indexes("dept")}
+
+        assert [tuple(r) for r in rows] == [
+            (1250, "integer"),
+            (3333, "integer"),
+        ]
+        assert str(columns["amount"]["type"]) == "BIGINT"
+        assert {"ix_dept_group_user", "ix_dept_group_lender"} <= indexes
+
+    def test_migrate_opens_ledger_from_depts(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO dept (user_id, lender_id, group_id, amount) "
+                "VALUES (2, 1, 1, 12.5), (3, 2, 1, 1)"
+            )
+
+        migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT user_id, lender_id, amount, kind, dept_id "
+                "FROM ledger_entries ORDER BY entry_id"
+            ).all()
+
+        assert [tuple(r) for r in rows] == [
+            (2, 1, 1250, "opening", 1),
+            (3, 2, 100, "opening", 2),
+        ]
+
+    def test_migrate_adds_sqlite_autoincrement(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO dept (user_id, lender_id, group_id, amount) "
+                "VALUES (2, 1, 1, 1), (3, 1, 1, 2)"
+            )
+
+        migrate(self.engine)
+
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql("DELETE FROM dept WHERE dept_id = 2")
+            conn.exec_driver_sql(
+                "INSERT INTO dept (user_id, lender_id, group_id, amount) "
+                "VALUES (3, 1, 1, 3)"
+            )
+            rows = conn.exec_driver_sql(
+                "SELECT dept_id, amount FROM dept ORDER BY dept_id"
+            ).all()
+
+        # The deleted dept's id isn't reused
+        assert [tuple(r) for r in rows] == [(1, 100), (3, 3)]
+
+    def test_migrate_backfills_member_balances(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO dept (user_id, lender_id, group_id, amount) "
+                "VALUES (2, 1, 1, 12.5), (3, 2, 1, 1), (2, 1, 2, 5)"
+            )
+
+        migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT group_id, user_id, net_amount FROM member_balances "
+                "ORDER BY group_id, user_id"
+            ).all()
+
+        assert [tuple(r) for r in rows] == [
+            (1, 1, 1250),
+            (1, 2, -1150),
+            (1, 3, -100),
+            (2, 1, 500),
+            (2, 2, -500),
+        ]
+
+    def test_migrate_dedupes_balance_snapshots(self):
+        with self.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "CREATE TABLE balance_snapshots (snapshot_id INTEGER NOT "
+                "NULL, group_id INTEGER, last_entry_id INTEGER, user_id "
+                "INTEGER, net_amount BIGINT, created_at DATETIME, "
+                "PRIMARY KEY (snapshot_id))"
+            )
+            conn.exec_driver_sql(
+                "CREATE INDEX ix_balance_snapshots_group_entry "
+                "ON balance_snapshots (group_id, last_entry_id)"
+            )
+            # Two requests took the same snapshot
+            conn.exec_driver_sql(
+                "INSERT INTO balance_snapshots "
+                "(group_id, last_entry_id, user_id, net_amount) "
+                "VALUES (1, 4, 1, 50), (1, 4, 2, -50), "
+                "(1, 4, 1, 50), (1, 4, 2, -50)"
+            )
+
+        migrate(self.engine)
+
+        with self.engine.connect() as conn:
+            rows = conn.exec_driver_sql(
+                "SELECT snapshot_id, user_id FROM balance_snapshots "
+                "ORDER BY snapshot_id"
+            ).all()
+        indexes = {
+            i["name"]: i["unique"]
+            for i in inspect(self.engine).get_indexes("balance_snapshots")
+        }
+
+        assert [tuple(r) for r in rows] == [(1, 1), (2, 2)]
+        assert "ix_balance_snapshots_group_entry" not in indexes
+        assert indexes["ix_balance_snapshots_group_entry_user"]
+
+        with pytest.raises(IntegrityError):
+            with self.engine.begin() as conn:
+                conn.exec_driver_sql(
+                    "INSERT INTO balance_snapshots "
+                    "(group_id, last_entry_id, user_id, net_amount) "
+                    "VALUES (1, 4, 1, 50)"
+                )
+
+    def test_migrate_is_idempotent(self):
+        migrate(self.engine)
+
+        assert migrate(self.engine) == []
@@ -1,7 +1,12 @@
+import asyncio
 import unittest
+from datetime import datetime
+from unittest.mock import patch
+
 import pytest
 
-from fastapi import HTTPException, status
+from fastapi import HTTPException, Response, status
+from fastapi.routing import serialize_response
 
 from app.api.auth import UserLogin, login
 from app.api.users import (
@@ -14,6 +19,12 @@ from app.api.users import (
 from app.api.groups import (
     GroupCreate,
     get_group,
+    get_group_balances,
+    get_group_dashboard,
+    get_group_ledger,
+    get_group_ledger_balances,
+    rebuild_group_balances,
+    snapshot_group_ledger,
     create_group,
     add_group_member,
 )
@@ -22,17 +33,38 @@ from app.api.expenses import (
     create_expense,
     delete_expense,
     create_expense_participant,
+    create_expenses_batch,
+    ExpenseBatch,
     ExpenseCreate,
     CreateExpenseParticipant,
 )
+from app.api.dept import (
+    delete_dept,
+    simplify_group_depts,
+    update_dept_amount,
+    DeptPaid,
+)
 from app.models import (
+    Dept,
     User,
     Group,
     GroupMembership,
     Expense,
     ExpenseParticipant,
+    BalanceSnapshot,
+    IdempotencyKey,
+    LedgerEntry,
+    MemberBalance,
 )
-from sqlalchemy import create_engine, StaticPool
+from app.api import auth as auth_router
+from app.api import dept as dept_router
+from app.api import expenses as expenses_router
+from app.api import groups as groups_router
+from app.api import users as users_router
+from app.settlement import net_balances
+from app.pagination import encode_cursor
+from sqlalchemy import create_engine, event, StaticPool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 from sqlalchemy.orm import sessionmaker
 from app.database import Base
@@ -50,6 +82,10 @@ TestingSessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine
 )
 
+async_engine = create_async_engine(
+    "sqlite+aiosqlite:///:memory:", poolclass=StaticPool
+)
+
 
 class TestAuthAPI(unittest.TestCase):
     def setUp(self):
@@ -236,7 +272,7 @@ class TestUserAPI(unittest.TestCase):
 
     def test_get_user_expenses_no_user(self):
         with pytest.raises(HTTPException) as exc_info:
-            get_user_expenses(user_id=1, db=self.db)
+            get_user_expenses(user_id=1, response=Response(), db=self.db)
 
         assert exc_info.value.status_code == 404
         assert "User not found" in str(exc_info.value.detail)
@@ -261,7 +297,7 @@ class TestUserAPI(unittest.TestCase):
         self.db.add_all([expense_participant, expense, user])
         self.db.commit()
 
-        data = get_user_expenses(user_id=1, db=self.db)
+        data = get_user_expenses(user_id=1, response=Response(), db=self.db)
 
         assert data[0]["expense_description"] == expense.description
         assert data[0]["expense_amount"] == expense.amount
@@ -274,6 +310,89 @@ class TestUserAPI(unittest.TestCase):
         assert data[0]["expense_id"] == expense_participant.expense_id
         assert data[0]["user_id"] == expense_participant.user_id
 
+    def test_get_user_expenses_pages(self):
+        self.db.add(
+            User(
+                user_id=1,
+                username="Test User",
+                email="test@example.com",
+                password="password",
+            )
+        )
+        for i in range(1, 6):
+            self.db.add(
+                Expense(
+                    expense_id=i,
+                    group_id=1,
+                    amount=10 * i,
+                    description=f"desc {i}",
+                    created_at=datetime(2024, 1, 6 - i),
+                )
+            )
+            self.db.add(
+                ExpenseParticipant(
+                    expense_id=i, user_id=1, amount_paid=i, amount_owed=0
+                )
+            )
+        self.db.commit()
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        pages, cursor = [], None
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            while True:
+                response = Response()
+                pages.append(
+                    get_user_expenses(
+                        user_id=1,
+                        response=response,
+                        limit=2,
+                        cursor=cursor,
+                        db=self.db,
+                    )
+                )
+                cursor = response.headers.get("X-Next-Cursor")
+                if cursor is None:
+                    break
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+        # One user lookup and one joined query per page, however many
+        # expenses the user takes part in
+        assert len(statements) == 2 * len(pages)
+        assert [[e["expense_id"] for e in page] for page in pages] == [
+            [5, 4],
+            [3, 2],
+            [1],
+        ]
+
+    def test_get_user_expenses_bad_cursor(self):
+        self.db.add(
+            User(
+                user_id=1,
+                username="Test User",
+                email="test@example.com",
+                password="password",
+            )
+        )
+        self.db.commit()
+
+        for cursor in (
+            "nope",
+            encode_cursor("2024-01-01T00:00:00", "1", 1),
+            encode_cursor("2024-01-01T00:00:00", 1, None),
+        ):
+            with pytest.raises(HTTPException) as exc_info:
+                get_user_expenses(
+                    user_id=1, response=Response(), cursor=cursor, db=self.db
+                )
+
+            assert exc_info.value.status_code == 400
+
 
 class TestGroupAPI(unittest.TestCase):
     def setUp(self):
@@ -416,6 +535,88 @@ class TestGroupAPI(unittest.TestCase):
         assert group.total_members == 2
 
 
+class TestGroupDashboardAPI(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        async with async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        self.db = AsyncSession(async_engine, expire_on_commit=False)
+
+    async def asyncTearDown(self):
+        async with async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.drop_all)
+        await self.db.close()
+
+    async def test_get_group_dashboard_not_found(self):
+        with pytest.raises(HTTPException) as exc_info:
+            await get_group_dashboard(group_id=1, db=self.db)
+
+        assert exc_info.value.status_code == 404
+        assert "Group not found" in str(exc_info.value.detail)
+
+    async def test_get_group_dashboard(self):
+        def populate(db):
+            db.add_all(
+                [
+                    User(user_id=1, username="alice", email="a@example.com"),
+                    User(user_id=2, username="bob", email="b@example.com"),
+                    Group(
+                        group_id=1,
+                        group_name="Test Group",
+                        created_by=1,
+                        total_members=2,
+                    ),
+                    GroupMembership(group_id=1, user_id=1, is_admin=True),
+                    GroupMembership(group_id=1, user_id=2, is_admin=False),
+                ]
+            )
+            db.commit()
+            for amount in (10, 20, 30):
+                create_expense(
+                    ExpenseCreate(
+                        group_id=1,
+                        created_by=1,
+                        description="d",
+                        amount=amount,
+                    ),
+                    db=db,
+                )
+
+        # The write handlers are sync, run them on the same connection
+        await self.db.run_sync(populate)
+
+        statements = []
+
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(async_engine.sync_engine, "before_cursor_execute", count)
+        try:
+            data = await get_group_dashboard(
+                group_id=1, expenses_limit=2, db=self.db
+            )
+        finally:
+            event.remove(
+                async_engine.sync_engine, "before_cursor_execute", count
+            )
+
+        assert len(statements) == 5
+        assert data["group_name"] == "Test Group"
+        assert data["total_expenses"] == 60
+        assert data["members"] == [
+            {"user_id": 1, "is_admin": True, "username": "alice"},
+            {"user_id": 2, "is_admin": False, "username": "bob"},
+        ]
+        assert [e["amount"] for e in data["expenses"]] == [30, 20]
+        assert len(data["depts"]) == 1
+        assert data["depts"][0]["username"] == "bob"
+        assert data["depts"][0]["lender_username"] == "alice"
+        assert data["depts"][0]["amount"] == 30
+        assert data["balances"] == [
+            {"user_id": 1, "net_amount": 30},
+            {"user_id": 2, "net_amount": -30},
+        ]
+
+
 class TestExpenseAPI(unittest.TestCase):
     def setUp(self):
         Base.metadata.create_all(bind=engine)
@@ -512,6 +713,219 @@ class TestExpenseAPI(unittest.TestCase):
 
         assert group.total_expenses == expense_create_data.amount
 
+    def create_batch_group(self):
+        group = Group(
+            group_id=1, group_name="Test Group", created_by=1, total_members=2
+        )
+        self.db.add_all(
+            [
+                group,
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+            ]
+        )
+        self.db.commit()
+        return group
+
+    def test_create_expenses_batch_no_group(self):
+        with pytest.raises(HTTPException) as exc_info:
+            create_expenses_batch(
+                ExpenseBatch(group_id=1, expenses=[]), db=self.db
+            )
+
+        assert exc_info.value.status_code == 404
+        assert "Group not found" in str(exc_info.value.detail)
+
+    def test_create_expenses_batch_success(self):
+        group = self.create_batch_group()
+
+        batch = ExpenseBatch(
+            group_id=1,
+            expenses=[
+                ExpenseCreate(
+                    group_id=1, created_by=1, description="a", amount=100
+                ),
+                ExpenseCreate(
+                    group_id=1, created_by=2, description="b", amount=40
+                ),
+                ExpenseCreate(
+                    group_id=1, created_by=1, description="c", amount=20
+                ),
+            ],
+        )
+        data = create_expenses_batch(batch, db=self.db)
+
+        assert data["errors"] == []
+        assert [e["description"] for e in data["created"]] == ["a", "b", "c"]
+        assert self.db.query(Expense).count() == 3
+
+        self.db.refresh(group)
+        assert group.total_expenses == 160
+
+        dept = self.db.query(Dept).one()
+        assert dept.lender_id == 1
+        assert dept.user_id == 2
+        assert dept.amount == 40
+
+    def test_create_expenses_batch_partial(self):
+        self.create_batch_group()
+
+        batch = ExpenseBatch(
+            group_id=1,
+            expenses=[
+                ExpenseCreate(
+                    group_id=1, created_by=3, description="a", amount=100
+                ),
+                ExpenseCreate(
+                    group_id=2, created_by=1, description="b", amount=100
+                ),
+                ExpenseCreate(
+                    group_id=1, created_by=1, description="c", amount=100
+                ),
+            ],
+        )
+        data = create_expenses_batch(batch, db=self.db)
+
+        assert data["errors"] == [
+            {"index": 0, "detail": "User not in Group"},
+            {"index": 1, "detail": "Wrong group"},
+        ]
+        assert len(data["created"]) == 1
+        assert self.db.query(Expense).count() == 1
+
+    def test_create_expenses_batch_atomic(self):
+        self.create_batch_group()
+
+        batch = ExpenseBatch(
+            group_id=1,
+            atomic=True,
+            expenses=[
+                ExpenseCreate(
+                    group_id=1, created_by=1, description="a", amount=100
+                ),
+                ExpenseCreate(
+                    group_id=1, created_by=3, description="b", amount=100
+                ),
+            ],
+        )
+        with pytest.raises(HTTPException) as exc_info:
+            create_expenses_batch(batch, db=self.db)
+
+        assert exc_info.value.status_code == 400
+        assert exc_info.value.detail == [
+            {"index": 1, "detail": "User not in Group"}
+        ]
+        assert self.db.query(Expense).count() == 0
+
+    def test_expense_member_balances(self):
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=3,
+                ),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+                GroupMembership(group_id=1, user_id=3, is_admin=False),
+            ]
+        )
+        self.db.commit()
+
+        create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=1, description="a", amount=90
+            ),
+            db=self.db,
+        )
+        create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=2, description="b", amount=90
+            ),
+            db=self.db,
+        )
+
+        balances = get_group_balances(group_id=1, db=self.db)
+        assert sorted((b["user_id"], b["net_amount"]) for b in balances) == [
+            (1, 30),
+            (2, 30),
+            (3, -60),
+        ]
+        assert rebuild_group_balances(group_id=1, db=self.db) == {"drift": []}
+
+        delete_expense(expense_id=1, db=self.db)
+        delete_expense(expense_id=2, db=self.db)
+
+        assert rebuild_group_balances(group_id=1, db=self.db) == {"drift": []}
+        balances = get_group_balances(group_id=1, db=self.db)
+        assert all(b["net_amount"] == 0 for b in balances)
+
+    def test_create_expense_splits_exactly(self):
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=3,
+                ),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+                GroupMembership(group_id=1, user_id=3, is_admin=False),
+            ]
+        )
+        self.db.commit()
+
+        # 10.00 between three: 3.34 + 3.33 + 3.33, the extra kopeck goes
+        # to the member after the expense id
+        create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=1, description="a", amount=1000
+            ),
+            db=self.db,
+        )
+
+        depts = self.db.query(Dept).order_by(Dept.user_id).all()
+        assert [(d.user_id, d.lender_id, d.amount) for d in depts] == [
+            (2, 1, 334),
+            (3, 1, 333),
+        ]
+
+        delete_expense(expense_id=1, db=self.db)
+
+        assert rebuild_group_balances(group_id=1, db=self.db) == {"drift": []}
+        assert self.db.query(Dept).count() == 0
+
+    def test_delete_expense_after_member_joined(self):
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=2,
+                ),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+            ]
+        )
+        self.db.commit()
+        create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=1, description="a", amount=1000
+            ),
+            db=self.db,
+        )
+        self.db.add(GroupMembership(group_id=1, user_id=3, is_admin=False))
+        self.db.commit()
+
+        # Only the members the expense was split between are refunded
+        delete_expense(expense_id=1, db=self.db)
+
+        assert rebuild_group_balances(group_id=1, db=self.db) == {"drift": []}
+        assert self.db.query(Dept).count() == 0
+
     def test_delete_expense_no_expense(self):
         with pytest.raises(HTTPException) as exc_info:
             delete_expense(expense_id=1, db=self.db)
@@ -551,6 +965,34 @@ class TestExpenseAPI(unittest.TestCase):
 
         assert group.total_expenses == 0
 
+    def test_delete_expense_many_participants(self):
+        group = Group(
+            group_id=1,
+            group_name="Test Group",
+            created_by=1,
+            total_members=1,
+            total_expenses=100,
+        )
+        expense = Expense(
+            expense_id=1, group_id=1, amount=100, description="desc"
+        )
+        self.db.add_all([group, expense])
+        self.db.add_all(
+            ExpenseParticipant(
+                expense_id=1, user_id=i, amount_paid=1, amount_owed=0
+            )
+            for i in range(1, 51)
+        )
+        self.db.commit()
+
+        with patch.object(self.db, "commit", wraps=self.db.commit) as commit:
+            data = delete_expense(expense_id=1, db=self.db)
+
+        assert data == {"message": "Expense deleted successfully"}
+        commit.assert_called_once()
+        assert self.db.query(ExpenseParticipant).count() == 0
+        assert self.db.query(Expense).count() == 0
+
     def test_create_expense_participant_no_expense(self):
         group = Group(
             group_id=1, group_name="Test Group", created_by=1, total_members=1
@@ -578,7 +1020,14 @@ class TestExpenseAPI(unittest.TestCase):
         group = Group(
             group_id=1, group_name="Test Group", created_by=1, total_members=2
         )
-        self.db.add_all([group, expense])
+        self.db.add_all(
+            [
+                group,
+                expense,
+                GroupMembership(group_id=1, user_id=1),
+                GroupMembership(group_id=1, user_id=2),
+            ]
+        )
         self.db.commit()
 
         expense_create_data = CreateExpenseParticipant(
@@ -600,3 +1049,489 @@ class TestExpenseAPI(unittest.TestCase):
             expense_participant.amount_paid == expense_create_data.amount_paid
         )
         assert expense_participant.amount_owed == 50
+
+
+class TestDeptAPI(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def test_simplify_group_depts_no_group(self):
+        with pytest.raises(HTTPException) as exc_info:
+            simplify_group_depts(group_id=1, db=self.db)
+
+        assert exc_info.value.status_code == 404
+        assert "Group not found" in str(exc_info.value.detail)
+
+    def create_cycle(self):
+        group = Group(
+            group_id=1, group_name="Test Group", created_by=1, total_members=3
+        )
+        self.db.add_all(
+            [
+                group,
+                Dept(user_id=1, lender_id=2, group_id=1, amount=30),
+                Dept(user_id=2, lender_id=3, group_id=1, amount=30),
+                Dept(user_id=3, lender_id=1, group_id=1, amount=10),
+            ]
+        )
+        self.db.commit()
+
+    def test_simplify_group_depts_preview(self):
+        self.create_cycle()
+
+        data = simplify_group_depts(group_id=1, db=self.db)
+
+        assert data["depts_before"] == 3
+        assert data["depts_after"] == 1
+        assert data["persisted"] is False
+        assert data["transfers"] == [
+            {"user_id": 1, "lender_id": 3, "amount": 20}
+        ]
+        assert self.db.query(Dept).count() == 3
+
+    def test_simplify_group_depts_persist(self):
+        self.create_cycle()
+
+        simplify_group_depts(group_id=1, persist=True, db=self.db)
+
+        dept = self.db.query(Dept).one()
+        assert dept.user_id == 1
+        assert dept.lender_id == 3
+        assert dept.amount == 20
+
+        # The new dept gets a fresh id, the ledger closes the old ones
+        assert dept.dept_id == 4
+        entries = (
+            self.db.query(LedgerEntry.dept_id, LedgerEntry.amount)
+            .filter(LedgerEntry.kind == "simplify")
+            .order_by(LedgerEntry.dept_id)
+            .all()
+        )
+        assert [tuple(e) for e in entries] == [
+            (1, -30),
+            (2, -30),
+            (3, -10),
+            (4, 20),
+        ]
+
+    def create_dept(self):
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=2,
+                ),
+                Dept(dept_id=1, user_id=2, lender_id=1, group_id=1, amount=50),
+                MemberBalance(group_id=1, user_id=1, net_amount=50),
+                MemberBalance(group_id=1, user_id=2, net_amount=-50),
+            ]
+        )
+        self.db.commit()
+
+    def test_update_dept_amount_balances(self):
+        self.create_dept()
+
+        update_dept_amount(
+            dept_id=1, dept_paid=DeptPaid(amount=20), db=self.db
+        )
+        assert get_group_balances(group_id=1, db=self.db) == [
+            {"user_id": 1, "net_amount": 30},
+            {"user_id": 2, "net_amount": -30},
+        ]
+
+        update_dept_amount(
+            dept_id=1, dept_paid=DeptPaid(amount=40), db=self.db
+        )
+        assert get_group_balances(group_id=1, db=self.db) == [
+            {"user_id": 1, "net_amount": 0},
+            {"user_id": 2, "net_amount": 0},
+        ]
+
+    def test_delete_dept_balances(self):
+        self.create_dept()
+
+        delete_dept(dept_id=1, db=self.db)
+
+        assert rebuild_group_balances(group_id=1, db=self.db) == {"drift": []}
+        assert self.db.query(Dept).count() == 0
+
+    def test_rebuild_group_balances_drift(self):
+        self.create_dept()
+        self.db.query(MemberBalance).filter(
+            MemberBalance.user_id == 2
+        ).delete()
+        self.db.commit()
+
+        data = rebuild_group_balances(group_id=1, db=self.db)
+
+        assert data == {
+            "drift": [{"user_id": 2, "expected": -50, "stored": 0}]
+        }
+        assert get_group_balances(group_id=1, db=self.db) == [
+            {"user_id": 1, "net_amount": 50},
+            {"user_id": 2, "net_amount": -50},
+        ]
+
+    def test_rebuild_group_balances_no_group(self):
+        with pytest.raises(HTTPException) as exc_info:
+            rebuild_group_balances(group_id=1, db=self.db)
+
+        assert exc_info.value.status_code == 404
+
+
+class TestLedgerAPI(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=3,
+                ),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+                GroupMembership(group_id=1, user_id=3, is_admin=False),
+            ]
+        )
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def create_expenses(self, *amounts):
+        for index, amount in enumerate(amounts):
+            create_expense(
+                ExpenseCreate(
+                    group_id=1,
+                    created_by=index % 3 + 1,
+                    description="d",
+                    amount=amount,
+                ),
+                db=self.db,
+            )
+
+    def assert_balances_match_depts(self):
+        depts = self.db.query(Dept).filter(Dept.group_id == 1).all()
+        expected = {u: b for u, b in net_balances(depts).items() if b}
+        ledger = {
+            b["user_id"]: b["net_amount"]
+            for b in get_group_ledger_balances(group_id=1, db=self.db)
+            if b["net_amount"]
+        }
+        assert ledger == expected
+
+    def test_ledger_follows_writes(self):
+        self.create_expenses(1000, 500, 301)
+        delete_expense(expense_id=2, db=self.db)
+        dept = self.db.query(Dept).first()
+        update_dept_amount(
+            dept_id=dept.dept_id, dept_paid=DeptPaid(amount=7), db=self.db
+        )
+        simplify_group_depts(group_id=1, persist=True, db=self.db)
+
+        kinds = [e.kind for e in self.db.query(LedgerEntry)]
+        assert kinds.count("expense") == 6
+        assert kinds.count("expense_deleted") == 2
+        assert kinds.count("payment") == 1
+        self.assert_balances_match_depts()
+
+    def test_snapshot_and_tail(self):
+        self.create_expenses(900, 600)
+
+        data = snapshot_group_ledger(group_id=1, db=self.db)
+        assert data == {"last_entry_id": 4}
+        assert self.db.query(BalanceSnapshot).count() == 3
+
+        self.create_expenses(300)
+        self.assert_balances_match_depts()
+
+        snapshot_group_ledger(group_id=1, db=self.db)
+        # Nothing new since the last snapshot
+        snapshot_group_ledger(group_id=1, db=self.db)
+        assert self.db.query(BalanceSnapshot).count() == 6
+        self.assert_balances_match_depts()
+
+    def test_snapshot_when_due(self):
+        with patch("app.ledger.SNAPSHOT_INTERVAL", 4):
+            self.create_expenses(900, 900, 900)
+
+        snapshots = self.db.query(BalanceSnapshot.last_entry_id).distinct()
+        assert [s.last_entry_id for s in snapshots] == [4]
+        self.assert_balances_match_depts()
+
+    def test_snapshot_no_group(self):
+        with pytest.raises(HTTPException) as exc_info:
+            snapshot_group_ledger(group_id=2, db=self.db)
+
+        assert exc_info.value.status_code == 404
+
+    def test_get_group_ledger_pages(self):
+        self.create_expenses(900, 600)
+
+        response = Response()
+        page = get_group_ledger(
+            group_id=1, response=response, limit=3, db=self.db
+        )
+        assert [e.entry_id for e in page] == [1, 2, 3]
+
+        cursor = response.headers["X-Next-Cursor"]
+        response = Response()
+        page = get_group_ledger(
+            group_id=1, response=response, limit=3, cursor=cursor, db=self.db
+        )
+        assert [e.entry_id for e in page] == [4]
+        assert "X-Next-Cursor" not in response.headers
+
+
+class TestIdempotency(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+        self.db.add_all(
+            [
+                Group(
+                    group_id=1,
+                    group_name="Test Group",
+                    created_by=1,
+                    total_members=2,
+                ),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+            ]
+        )
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def create(self, key, amount=1000):
+        return create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=1, description="d", amount=amount
+            ),
+            idempotency_key=key,
+            db=self.db,
+        )
+
+    def pay(self, key, dept_id, amount):
+        return update_dept_amount(
+            dept_id=dept_id,
+            dept_paid=DeptPaid(amount=amount),
+            idempotency_key=key,
+            db=self.db,
+        )
+
+    def test_create_expense_replays(self):
+        first = self.create("key-1")
+        second = self.create("key-1")
+
+        assert second["expense_id"] == first["expense_id"]
+        assert self.db.query(Expense).count() == 1
+        assert self.db.query(LedgerEntry).count() == 1
+        assert self.db.get(Group, 1).total_expenses == 1000
+        assert self.db.query(Dept).one().amount == 500
+
+    def test_create_expense_new_key(self):
+        self.create("key-1")
+        self.create("key-2")
+        self.create(None)
+
+        assert self.db.query(Expense).count() == 3
+
+    def test_key_reused_for_another_request(self):
+        self.create("key-1")
+        with pytest.raises(HTTPException) as exc_info:
+            self.create("key-1", amount=2000)
+
+        assert exc_info.value.status_code == 422
+        assert self.db.query(Expense).count() == 1
+
+    def test_failed_request_is_not_stored(self):
+        with pytest.raises(HTTPException):
+            create_expense(
+                ExpenseCreate(
+                    group_id=1, created_by=3, description="d", amount=1000
+                ),
+                idempotency_key="key-1",
+                db=self.db,
+            )
+
+        assert self.db.query(IdempotencyKey).count() == 0
+
+    def test_expired_key_runs_again(self):
+        self.create("key-1")
+        with patch("app.idempotency.IDEMPOTENCY_TTL", -1):
+            self.create("key-1")
+
+        assert self.db.query(Expense).count() == 2
+        assert self.db.query(IdempotencyKey).count() == 1
+
+    def test_pay_dept_replays(self):
+        self.create(None)
+        dept = self.db.query(Dept).one()
+
+        first = self.pay("pay-1", dept.dept_id, 200)
+        second = self.pay("pay-1", dept.dept_id, 200)
+
+        assert first == second
+        assert self.db.query(Dept).one().amount == 300
+
+    def test_pay_dept_replays_after_settling(self):
+        self.create(None)
+        dept_id = self.db.query(Dept).one().dept_id
+
+        first = self.pay("pay-1", dept_id, 500)
+        second = self.pay("pay-1", dept_id, 500)
+
+        assert (
+            first == second == {"message": "Dept completely paid successfully"}
+        )
+        assert self.db.query(LedgerEntry).count() == 2
+
+
+ROUTERS = (
+    auth_router.router,
+    dept_router.router,
+    expenses_router.router,
+    groups_router.router,
+    users_router.router,
+)
+
+
+def route_of(endpoint):
+    return next(
+        route
+        for router in ROUTERS
+        for route in router.routes
+        if route.endpoint is endpoint
+    )
+
+
+class TestResponseModels(unittest.TestCase):
+    """Serializing a response must not go back to the database."""
+
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+        self.db.add_all(
+            [
+                User(user_id=1, username="u1", email="u1@example.com"),
+                User(user_id=2, username="u2", email="u2@example.com"),
+                Group(group_id=1, group_name="Test Group", created_by=1),
+                GroupMembership(group_id=1, user_id=1, is_admin=True),
+                GroupMembership(group_id=1, user_id=2, is_admin=False),
+            ]
+        )
+        self.db.commit()
+        create_expense(
+            ExpenseCreate(
+                group_id=1, created_by=1, description="d", amount=1000
+            ),
+            db=self.db,
+        )
+        self.statements = []
+
+    def tearDown(self):
+        # setUp commits, the tables are dropped rather than invalidated
+        self.db.close()
+        Base.metadata.drop_all(bind=engine)
+
+    def serialize(self, endpoint, result):
+        route = route_of(endpoint)
+
+        def count(conn, cursor, statement, *args):
+            self.statements.append(statement)
+
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            content = asyncio.run(
+                serialize_response(
+                    field=route.response_field,
+                    response_content=result,
+                    exclude_unset=route.response_model_exclude_unset,
+                    is_coroutine=True,
+                )
+            )
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
+        assert self.statements == []
+        return content
+
+    def test_every_route_has_a_response_model(self):
+        for router in ROUTERS:
+            for route in router.routes:
+                assert route.response_model is not None, route.path
+
+    def test_get_group(self):
+        content = self.serialize(get_group, get_group(group_id=1, db=self.db))
+
+        assert [m["user_id"] for m in content["groupmembers"]] == [1, 2]
+        assert [e["amount"] for e in content["groupexpenses"]] == [1000]
+
+    def test_get_expense(self):
+        create_expense_participant(
+            CreateExpenseParticipant(expense_id=1, user_id=2, amount_paid=0),
+            db=self.db,
+        )
+        content = self.serialize(
+            get_expense, get_expense(expense_id=1, db=self.db)
+        )
+
+        assert content["expense_participants"][0]["amount_owed"] == -500
+
+    def test_users(self):
+        content = self.serialize(get_user, get_user(user_id=1, db=self.db))
+        assert content == {
+            "user_id": 1,
+            "username": "u1",
+            "email": "u1@example.com",
+        }
+
+        content = self.serialize(
+            get_user_groups, get_user_groups(user_id=2, db=self.db)
+        )
+        assert [g["group_name"] for g in content] == ["Test Group"]
+
+    def test_writes(self):
+        self.db.add(User(user_id=3, username="u3", email="u3@example.com"))
+        self.db.commit()
+
+        membership = add_group_member(group_id=1, user_id=3, db=self.db)
+        content = self.serialize(add_group_member, membership)
+        assert content["user_id"] == 3
+
+        group = create_group(
+            GroupCreate(group_name="Other", created_by=3), db=self.db
+        )
+        content = self.serialize(create_group, group)
+        assert content["group_name"] == "Other"
+
+    def test_get_group_ledger(self):
+        entries = get_group_ledger(group_id=1, response=Response(), db=self.db)
+        content = self.serialize(get_group_ledger, entries)
+
+        assert [(e["kind"], e["amount"]) for e in content] == [
+            ("expense", 500)
+        ]
+
+    def test_lazy_load_is_detected(self):
+        self.db.expunge_all()
+        group = self.db.get(Group, 1)
+
+        # Without get_group's joinedload the members are loaded lazily
+        with pytest.raises(AssertionError):
+            self.serialize(get_group, group)
+        assert self.statements
@@ -0,0 +1,175 @@
+"""End-to-end run of the API against PostgreSQL.
+
+Skipped unless TEST_DATABASE_URL points at a throwaway database, e.g.
+``postgresql+psycopg://postgres@localhost/lazy_split_test``. Every table
+in that database is dropped.
+"""
+
+import os
+import unittest
+
+from fastapi.testclient import TestClient
+from sqlalchemy import NullPool
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import sessionmaker
+
+from app.database import (
+    Base,
+    async_database_url,
+    create_async_db_engine,
+    create_db_engine,
+    get_async_db,
+    get_db,
+)
+from app.main import app
+from app.migrate import migrate
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+client = TestClient(app)
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL is not set")
+class TestPostgres(unittest.TestCase):
+    def setUp(self):
+        self.engine = create_db_engine(TEST_DATABASE_URL)
+        Base.metadata.drop_all(bind=self.engine)
+        migrate(self.engine)
+        self.Session = sessionmaker(
+            autocommit=False, autoflush=False, bind=self.engine
+        )
+        # No pool, the connections close with each request's session
+        self.async_engine = create_async_db_engine(
+            async_database_url(TEST_DATABASE_URL), poolclass=NullPool
+        )
+
+        def get_test_db():
+            db = self.Session()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        async def get_test_async_db():
+            async with AsyncSession(self.async_engine) as db:
+                yield db
+
+        self.previous = dict(app.dependency_overrides)
+        app.dependency_overrides[get_db] = get_test_db
+        app.dependency_overrides[get_async_db] = get_test_async_db
+
+    def tearDown(self):
+        app.dependency_overrides.clear()
+        app.dependency_overrides.update(self.previous)
+        Base.metadata.drop_all(bind=self.engine)
+        self.engine.dispose()
+
+    def create_user(self, name):
+        response = client.post(
+            "/users/",
+            json={
+                "username": name,
+                "password": "password",
+                "email": f"{name}@example.com",
+            },
+        )
+        assert response.status_code == 200
+        return response.json()["user_id"]
+
+    def test_expense_flow(self):
+        alice, bob, carol = map(self.create_user, ("alice", "bob", "carol"))
+
+        response = client.post(
+            "/groups/", json={"group_name": "trip", "created_by": alice}
+        )
+        group_id = response.json()["group_id"]
+        for user_id in (bob, carol):
+            response = client.post(f"/groups/{group_id}/add_member/{user_id}")
+            assert response.status_code == 200
+
+        response = client.post(
+            "/expenses/",
+            json={
+                "group_id": group_id,
+                "description": "hotel",
+                "amount": 300,
+                "created_by": alice,
+            },
+        )
+        assert response.status_code == 200
+        expense_id = response.json()["expense_id"]
+
+        response = client.post(
+            "/expenses/batch",
+            json={
+                "group_id": group_id,
+                "expenses": [
+                    {
+                        "group_id": group_id,
+                        "description": "dinner",
+                        "amount": 90,
+                        "created_by": bob,
+                    },
+                    {
+                        "group_id": group_id,
+                        "description": "taxi",
+                        "amount": 30,
+                        "created_by": carol,
+                    },
+                ],
+            },
+        )
+        assert len(response.json()["created"]) == 2
+
+        content = f"description,amount,created_by\nfuel,60,{bob}\n".encode()
+        response = client.post(
+            f"/expenses/import?group_id={group_id}",
+            files={"file": ("expenses.csv", content)},
+        )
+        assert response.json()["imported"] == 1
+
+        response = client.post(
+            "/expenses/participant",
+            json={"expense_id": expense_id, "user_id": bob, "amount_paid": 1},
+        )
+        assert response.status_code == 200
+
+        response = client.get(f"/groups/{group_id}/dashboard")
+        dashboard = response.json()
+        assert dashboard["total_expenses"] == 480
+        assert len(dashboard["members"]) == 3
+        assert len(dashboard["expenses"]) == 4
+
+        response = client.get(f"/users/{bob}/expenses", params={"limit": 1})
+        assert response.status_code == 200
+        assert len(response.json()) == 1
+
+        response = client.get("/users/", params={"ids": f"{alice},{bob}"})
+        assert len(response.json()) == 2
+
+        response = client.get(f"/dept/{group_id}/{alice}")
+        dept = response.json()[0]
+        response = client.patch(f"/dept/{dept['dept_id']}", json={"amount": 1})
+        assert response.status_code == 200
+
+        response = client.delete(f"/expenses/{expense_id}")
+        assert response.status_code == 200
+
+        response = client.post(
+            f"/dept/{group_id}/simplify", params={"persist": True}
+        )
+        assert response.status_code == 200
+
+        response = client.post(f"/groups/{group_id}/balances/rebuild")
+        assert response.json() == {"drift": []}
+
+        response = client.get(f"/groups/{group_id}/balances")
+        balances = response.json()
+        assert sum(b["net_amount"] for b in balances) == 0
+
+        response = client.post(f"/groups/{group_id}/ledger/snapshot")
+        assert response.status_code == 200
+        response = client.get(f"/groups/{group_id}/ledger/balances")
+        assert [b for b in response.json() if b["net_amount"]] == [
+            b for b in balances if b["net_amount"]
+        ]
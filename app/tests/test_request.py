@@ -1,18 +1,39 @@
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine, StaticPool
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, func, NullPool, StaticPool
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 
 from sqlalchemy.orm import sessionmaker
 from app.main import app
-from app.models import User, Group, GroupMembership, Expense
-from app.database import get_db, Base
-
+from app.models import (
+    Dept,
+    User,
+    Group,
+    GroupMembership,
+    Expense,
+    ExpenseParticipant,
+    MemberBalance,
+)
+from app.database import get_async_db, get_db, Base
+from app.metrics import render_metrics
+from app.pagination import encode_cursor
+from app.timing import instrument_engine
+
+import json
+import os
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
 
 # Setup the TestClient
 client = TestClient(app)
 
-# Setup the in-memory SQLite database for testing
-DATABASE_URL = "sqlite:///:memory:"
+# Setup the in-memory SQLite database for testing. The cache is shared so
+# that the async endpoints see the same database; it lives as long as the
+# sync engine's connection.
+DATABASE_URL = "sqlite:///file:test_request?mode=memory&cache=shared&uri=true"
 engine = create_engine(
     DATABASE_URL,
     connect_args={
@@ -24,6 +45,21 @@ TestingSessionLocal = sessionmaker(
     autocommit=False, autoflush=False, bind=engine
 )
 
+async_engine = create_async_engine(
+    DATABASE_URL.replace("sqlite://", "sqlite+aiosqlite://"),
+    poolclass=NullPool,
+)
+
+
+async def get_test_async_db():
+    async with AsyncSession(async_engine) as db:
+        yield db
+
+
+app.dependency_overrides[get_async_db] = get_test_async_db
+instrument_engine(engine)
+instrument_engine(async_engine.sync_engine)
+
 test_users = [
     {
         "username": "testuser1",
@@ -105,6 +141,63 @@ class TestUser(unittest.TestCase):
         assert response.status_code == 200
         assert len(response.json()) >= len(test_users)
 
+    def test_get_users_by_ids(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(
+                    username=f"idsuser{i}",
+                    password="password",
+                    email=f"idsuser{i}@example.com",
+                )
+                for i in range(3)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        response = client.get(
+            "/users/", params={"ids": f"{user_ids[0]},{user_ids[2]}"}
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert sorted(u["user_id"] for u in data) == [
+            user_ids[0],
+            user_ids[2],
+        ]
+
+        response = client.get("/users/", params={"ids": "1,x"})
+        assert response.status_code == 400
+
+    def test_get_users_by_many_ids(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(
+                    username=f"manyids{i}",
+                    password="password",
+                    email=f"manyids{i}@example.com",
+                )
+                for i in range(60)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        # More ids than the default page size still come back at once
+        response = client.get(
+            "/users/", params={"ids": ",".join(map(str, user_ids))}
+        )
+        assert response.status_code == 200
+        assert [u["user_id"] for u in response.json()] == user_ids
+        assert response.headers["X-Total-Count"] == "60"
+        assert "X-Next-Cursor" not in response.headers
+
+        response = client.get(
+            "/users/",
+            params={"ids": ",".join(map(str, user_ids)), "limit": 50},
+        )
+        assert len(response.json()) == 50
+        assert "X-Next-Cursor" in response.headers
+
     def test_get_single_user(self):
         user = User(
             username="testuser3",
@@ -309,6 +402,191 @@ class TestGroup(unittest.TestCase):
         assert data["user_id"] == user.user_id
         assert "membership_id" in data
 
+    def test_get_group_dashboard(self):
+        user = User(
+            username="testuser14",
+            password="testpass14",
+            email="test14@example.com",
+        )
+        with TestingSessionLocal() as session:
+            session.add(user)
+            session.commit()
+            session.refresh(user)
+
+        response = client.post(
+            "/groups/",
+            json={"group_name": "TestGroup9", "created_by": user.user_id},
+        )
+        group_id = response.json()["group_id"]
+
+        response = client.get(f"/groups/{group_id}/dashboard")
+
+        assert response.status_code == 200
+        data = response.json()
+        assert data["group_name"] == "TestGroup9"
+        assert data["members"] == [
+            {
+                "user_id": user.user_id,
+                "is_admin": True,
+                "username": "testuser14",
+            }
+        ]
+        assert data["expenses"] == []
+        assert data["depts"] == []
+
+    def test_get_group_balances(self):
+        with TestingSessionLocal() as session:
+            group = Group(group_name="TestGroup8", created_by=1)
+            session.add(group)
+            session.commit()
+            session.add(
+                MemberBalance(
+                    group_id=group.group_id, user_id=1, net_amount=10
+                )
+            )
+            session.commit()
+            group_id = group.group_id
+
+        response = client.get(f"/groups/{group_id}/balances")
+
+        assert response.status_code == 200
+        assert response.json() == [{"user_id": 1, "net_amount": 10}]
+
+    def test_group_ledger(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(username=f"ledger{i}", email=f"ledger{i}@example.com")
+                for i in range(2)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        response = client.post(
+            "/groups/",
+            json={"group_name": "LedgerGroup", "created_by": user_ids[0]},
+        )
+        group_id = response.json()["group_id"]
+        client.post(f"/groups/{group_id}/add_member/{user_ids[1]}")
+        client.post(
+            "/expenses/",
+            json={
+                "group_id": group_id,
+                "description": "a",
+                "amount": 100,
+                "created_by": user_ids[0],
+            },
+        )
+
+        response = client.get(f"/groups/{group_id}/ledger")
+        assert response.status_code == 200
+        assert [(e["amount"], e["kind"]) for e in response.json()] == [
+            (50, "expense")
+        ]
+
+        response = client.post(f"/groups/{group_id}/ledger/snapshot")
+        assert response.status_code == 200
+
+        response = client.get(f"/groups/{group_id}/ledger/balances")
+        assert response.json() == [
+            {"user_id": user_ids[0], "net_amount": 50},
+            {"user_id": user_ids[1], "net_amount": -50},
+        ]
+
+        response = client.get(
+            f"/groups/{group_id}/ledger", params={"cursor": "bad"}
+        )
+        assert response.status_code == 400
+
+    def test_recompute_group_depts(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(username=f"recompute{i}", email=f"recompute{i}@e.com")
+                for i in range(3)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        group_id = client.post(
+            "/groups/",
+            json={"group_name": "RecomputeGroup", "created_by": user_ids[0]},
+        ).json()["group_id"]
+        for user_id in user_ids[1:]:
+            client.post(f"/groups/{group_id}/add_member/{user_id}")
+        for amount, payer in ((300, 0), (90, 1), (600, 2)):
+            client.post(
+                "/expenses/",
+                json={
+                    "group_id": group_id,
+                    "description": "recomputed",
+                    "amount": amount,
+                    "created_by": user_ids[payer],
+                },
+            )
+        depts = client.get(f"/dept/{group_id}").json()
+        client.patch(f"/dept/{depts[0]['dept_id']}", json={"amount": 20})
+
+        url = f"/groups/{group_id}/depts/recompute"
+        response = client.post(url)
+        assert response.status_code == 200
+        data = response.json()
+        assert data["entries"] == 7
+        assert data["depts"] == 3
+        assert data["mismatches"] == data["drift"] == []
+
+        def pairs():
+            return {
+                (d["lender_id"], d["user_id"]): d["amount"]
+                for d in client.get(f"/dept/{group_id}").json()
+            }
+
+        before = pairs()
+        balances = {
+            b["user_id"]: b["net_amount"]
+            for b in client.get(f"/groups/{group_id}/balances").json()
+        }
+
+        # Break a dept and a balance behind the ledger's back
+        with TestingSessionLocal() as session:
+            dept = session.get(Dept, depts[0]["dept_id"])
+            dept.amount += 5
+            session.query(MemberBalance).filter(
+                MemberBalance.group_id == group_id,
+                MemberBalance.user_id == user_ids[2],
+            ).delete()
+            session.commit()
+            key = (dept.lender_id, dept.user_id)
+
+        data = client.post(url).json()
+        assert data["mismatches"] == [
+            {
+                "lender_id": key[0],
+                "user_id": key[1],
+                "expected": before[key],
+                "stored": before[key] + 5,
+            }
+        ]
+        assert data["drift"] == [
+            {
+                "user_id": user_ids[2],
+                "expected": balances[user_ids[2]],
+                "stored": 0,
+            }
+        ]
+        assert data["persisted"] is False
+        assert pairs()[key] == before[key] + 5
+
+        data = client.post(url, params={"persist": True}).json()
+        assert data["persisted"] is True
+        assert len(data["mismatches"]) == 1
+        assert pairs() == before
+        data = client.post(url).json()
+        assert data["mismatches"] == data["drift"] == []
+
+        response = client.post("/groups/999999/depts/recompute")
+        assert response.status_code == 404
+
 
 class TestExpenses(unittest.TestCase):
     def setUp(self):
@@ -362,13 +640,74 @@ class TestExpenses(unittest.TestCase):
     def test_get_expenses(self):
         response = client.get("/expenses/")
         assert response.status_code == 200
-        cur = len(response.json())
+        cur = int(response.headers["X-Total-Count"])
 
         TestExpenses.create_test_expense()
         response = client.get("/expenses/")
         assert response.status_code == 200
-        data = response.json()
-        assert len(data) == cur + 1
+        assert int(response.headers["X-Total-Count"]) == cur + 1
+
+    def test_get_expenses_pages(self):
+        for _ in range(3):
+            TestExpenses.create_test_expense()
+
+        seen, cursor = [], None
+        while True:
+            params = {"limit": 2, "fields": "amount"}
+            if cursor is not None:
+                params["cursor"] = cursor
+            response = client.get("/expenses/", params=params)
+            assert response.status_code == 200
+            assert {tuple(e) for e in response.json()} <= {
+                ("expense_id", "amount")
+            }
+            seen += [e["expense_id"] for e in response.json()]
+            cursor = response.headers.get("X-Next-Cursor")
+            if cursor is None:
+                break
+
+        assert seen == sorted(seen)
+        assert len(seen) == int(response.headers["X-Total-Count"])
+
+        response = client.get("/expenses/", params={"fields": "nope"})
+        assert response.status_code == 400
+        response = client.get("/expenses/", params={"limit": 0})
+        assert response.status_code == 400
+
+    def test_get_expenses_ndjson(self):
+        for _ in range(3):
+            TestExpenses.create_test_expense()
+        paged = client.get("/expenses/", params={"limit": 500}).json()
+
+        response = client.get(
+            "/expenses/", headers={"Accept": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.iter_lines()]
+        assert lines == paged
+
+        # The cursor resumes an export, limit doesn't apply
+        first = client.get("/expenses/", params={"limit": 1})
+        cursor = first.headers["X-Next-Cursor"]
+        response = client.get(
+            "/expenses/",
+            params={"limit": 1, "cursor": cursor, "fields": "amount"},
+            headers={"Accept": "application/x-ndjson"},
+        )
+        lines = [json.loads(line) for line in response.iter_lines()]
+        assert lines == [
+            {"expense_id": e["expense_id"], "amount": e["amount"]}
+            for e in paged[1:]
+        ]
+
+        response = client.get(
+            "/expenses/",
+            params={"group_id": 1},
+            headers={"Accept": "application/x-ndjson"},
+        )
+        lines = [json.loads(line) for line in response.iter_lines()]
+        assert lines == [e for e in paged if e["group_id"] == 1]
 
     def test_get_expense(self):
         expense_id = TestExpenses.create_test_expense()
@@ -409,3 +748,490 @@ class TestExpenses(unittest.TestCase):
         data = response.json()
         assert data["expense_id"] == expense_id
         assert data["user_id"] == user_id
+
+    @staticmethod
+    def create_test_member(username):
+        with TestingSessionLocal() as session:
+            user = User(
+                username=username,
+                password="password",
+                email=f"{username}@example.com",
+            )
+            session.add(user)
+            session.commit()
+
+            group = Group(group_name="TestGroup7", created_by=user.user_id)
+            session.add(group)
+            session.commit()
+
+            session.add(
+                GroupMembership(
+                    group_id=group.group_id,
+                    user_id=user.user_id,
+                    is_admin=True,
+                )
+            )
+            session.commit()
+            return user.user_id, group.group_id
+
+    def test_create_expenses_batch(self):
+        user_id, group_id = TestExpenses.create_test_member("testuser11")
+
+        expense = {
+            "group_id": group_id,
+            "description": "Batch Expense",
+            "amount": 10,
+            "created_by": user_id,
+        }
+        response = client.post(
+            "/expenses/batch",
+            json={"group_id": group_id, "expenses": [expense, expense]},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert len(data["created"]) == 2
+        assert data["errors"] == []
+
+    def test_create_expenses_batch_reverses_new_dept(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(username=f"reverse{i}", email=f"reverse{i}@example.com")
+                for i in range(2)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        group_id = client.post(
+            "/groups/",
+            json={"group_name": "ReverseGroup", "created_by": user_ids[0]},
+        ).json()["group_id"]
+        client.post(f"/groups/{group_id}/add_member/{user_ids[1]}")
+
+        # The second expense pays off and reverses the dept the first one
+        # created, before either is flushed
+        expenses = [
+            {
+                "group_id": group_id,
+                "description": "reversed",
+                "amount": amount,
+                "created_by": payer,
+            }
+            for amount, payer in ((100, user_ids[0]), (300, user_ids[1]))
+        ]
+        response = client.post(
+            "/expenses/batch",
+            json={"group_id": group_id, "expenses": expenses},
+        )
+        assert response.status_code == 200
+        assert response.json()["errors"] == []
+
+        depts = client.get(f"/dept/{group_id}").json()
+        assert [
+            (d["lender_id"], d["user_id"], d["amount"]) for d in depts
+        ] == [(user_ids[1], user_ids[0], 100)]
+
+    def test_create_expense_idempotency_key(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(username=f"retry{i}", email=f"retry{i}@example.com")
+                for i in range(2)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        group_id = client.post(
+            "/groups/",
+            json={"group_name": "RetryGroup", "created_by": user_ids[0]},
+        ).json()["group_id"]
+        client.post(f"/groups/{group_id}/add_member/{user_ids[1]}")
+
+        expense = {
+            "group_id": group_id,
+            "description": "retried",
+            "amount": 100,
+            "created_by": user_ids[0],
+        }
+        headers = {"Idempotency-Key": "retried-expense"}
+        first = client.post("/expenses/", json=expense, headers=headers)
+        second = client.post("/expenses/", json=expense, headers=headers)
+
+        assert first.status_code == second.status_code == 200
+        assert second.json() == first.json()
+        depts = client.get(f"/dept/{group_id}").json()
+        assert [d["amount"] for d in depts] == [50]
+
+        response = client.post(
+            "/expenses/",
+            json={**expense, "amount": 200},
+            headers=headers,
+        )
+        assert response.status_code == 422
+
+        response = client.post(
+            "/expenses/", json=expense, headers={"Idempotency-Key": "k" * 256}
+        )
+        assert response.status_code == 422
+
+    def test_import_expenses_csv(self):
+        user_id, group_id = TestExpenses.create_test_member("testuser12")
+
+        rows = ["description,amount,created_by"]
+        rows += [f"row {i},{i + 1},{user_id}" for i in range(4)]
+        rows.insert(3, "bad row,not a number,1")
+        content = "\n".join(rows).encode()
+
+        response = client.post(
+            f"/expenses/import?group_id={group_id}&chunk_size=2",
+            files={"file": ("expenses.csv", content, "text/csv")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["rows_read"] == 5
+        assert data["imported"] == 4
+        assert data["failed"] == 1
+        assert data["chunks_committed"] == 2
+        assert data["next_offset"] == 5
+        assert data["complete"] is True
+        assert data["errors"] == [{"row": 3, "detail": "Invalid row"}]
+
+        # Resuming from an offset skips the rows already imported
+        response = client.post(
+            f"/expenses/import?group_id={group_id}&offset=4",
+            files={"file": ("expenses.csv", content, "text/csv")},
+        )
+        data = response.json()
+        assert data["rows_read"] == 1
+        assert data["imported"] == 1
+        assert data["next_offset"] == 5
+
+    def test_import_expenses_ndjson(self):
+        user_id, group_id = TestExpenses.create_test_member("testuser13")
+
+        content = (
+            f'{{"description": "a", "amount": 5, "created_by": {user_id}}}\n'
+            "\n"
+            "{not json\n"
+            f'{{"description": "b", "amount": 5, "created_by": {user_id}}}\n'
+        ).encode()
+
+        response = client.post(
+            f"/expenses/import?group_id={group_id}",
+            files={"file": ("expenses.ndjson", content)},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["rows_read"] == 3
+        assert data["imported"] == 2
+        assert data["errors"] == [{"row": 2, "detail": "Invalid row"}]
+
+    def test_import_expenses_unreadable_file(self):
+        user_id, group_id = TestExpenses.create_test_member("testuser14")
+
+        rows = ["description,amount,created_by"]
+        rows += [f"row {i},{i + 1},{user_id}" for i in range(3)]
+        content = "\n".join(rows).encode() + b"\nbad \xff,1,1\nlast,1,1\n"
+
+        response = client.post(
+            f"/expenses/import?group_id={group_id}&chunk_size=2",
+            files={"file": ("expenses.csv", content, "text/csv")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        # The rows before the invalid byte are kept, the open chunk too
+        assert data["imported"] == 3
+        assert data["chunks_committed"] == 2
+        assert data["next_offset"] == 3
+        assert data["complete"] is False
+        assert data["errors"] == [{"row": 4, "detail": "Invalid UTF-8"}]
+
+        # A field over the csv module's size limit
+        content = b"description,amount,created_by\n" + b"a" * 200000
+        response = client.post(
+            f"/expenses/import?group_id={group_id}",
+            files={"file": ("expenses.csv", content, "text/csv")},
+        )
+        assert response.status_code == 200
+        data = response.json()
+        assert data["complete"] is False
+        assert data["errors"][0]["row"] == 1
+        assert data["errors"][0]["detail"].startswith("Invalid CSV")
+
+    def test_import_expenses_chunk_size_limit(self):
+        response = client.post(
+            "/expenses/import?group_id=1&chunk_size=100000",
+            files={"file": ("expenses.csv", b"")},
+        )
+        assert response.status_code == 400
+
+    def test_import_expenses_unsupported_file(self):
+        response = client.post(
+            "/expenses/import?group_id=1",
+            files={"file": ("expenses.xlsx", b"")},
+        )
+        assert response.status_code == 400
+
+
+class TestDept(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+
+        app.dependency_overrides[get_db] = lambda: self.db
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def test_list_depts(self):
+        with TestingSessionLocal() as session:
+            session.add_all(
+                [
+                    Dept(user_id=2, lender_id=1, group_id=1, amount=10),
+                    Dept(user_id=3, lender_id=2, group_id=1, amount=5),
+                    Dept(user_id=2, lender_id=1, group_id=2, amount=7),
+                ]
+            )
+            session.commit()
+
+        response = client.get("/dept/1")
+        assert response.status_code == 200
+        assert [d["amount"] for d in response.json()] == [10, 5]
+        assert response.headers["X-Total-Count"] == "2"
+
+        response = client.get(
+            "/dept/1", params={"limit": 1, "fields": "amount", "count": False}
+        )
+        assert [d["amount"] for d in response.json()] == [10]
+        assert "X-Total-Count" not in response.headers
+        response = client.get(
+            "/dept/1",
+            params={"limit": 1, "cursor": response.headers["X-Next-Cursor"]},
+        )
+        assert [d["amount"] for d in response.json()] == [5]
+        assert "X-Next-Cursor" not in response.headers
+        last_id = max(d["dept_id"] for d in client.get("/dept/1").json())
+        response = client.get(
+            "/dept/1", params={"cursor": encode_cursor(last_id)}
+        )
+        assert response.json() == []
+
+        response = client.get(
+            "/dept/1",
+            params={"fields": "amount"},
+            headers={"Accept": "application/x-ndjson"},
+        )
+        assert response.headers["content-type"] == "application/x-ndjson"
+        lines = [json.loads(line) for line in response.iter_lines()]
+        assert [d["amount"] for d in lines] == [10, 5]
+
+        response = client.get("/dept/1/3")
+        assert response.status_code == 200
+        assert [d["user_id"] for d in response.json()] == [3]
+
+        response = client.get("/dept/1/4")
+        assert response.status_code == 404
+
+        response = client.get("/dept/3")
+        assert response.json() == {}
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+
+        app.dependency_overrides[get_db] = lambda: self.db
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def add_expenses(self, user_id, count):
+        with TestingSessionLocal() as session:
+            for i in range(count):
+                expense = Expense(
+                    group_id=1, description=f"timed {i}", amount=100
+                )
+                session.add(expense)
+                session.flush()
+                session.add(
+                    ExpenseParticipant(
+                        expense_id=expense.expense_id,
+                        user_id=user_id,
+                        amount_paid=0,
+                        amount_owed=100,
+                    )
+                )
+            session.commit()
+
+    def test_headers(self):
+        response = client.get("/groups/", params={"count": False})
+        assert response.headers["X-Query-Count"] == "1"
+        app_timing, db_timing = response.headers["Server-Timing"].split(", ")
+        assert app_timing.startswith("app;dur=")
+        assert db_timing.startswith("db;dur=")
+        assert db_timing.endswith('desc="queries: 1"')
+
+        # Async endpoints are counted too
+        response = client.get("/dept/1", params={"count": False})
+        assert response.headers["X-Query-Count"] == "1"
+
+    def test_user_expenses_query_count_is_constant(self):
+        with TestingSessionLocal() as session:
+            user = User(
+                username="timeduser",
+                password="password",
+                email="timed@example.com",
+            )
+            session.add(user)
+            session.commit()
+            user_id = user.user_id
+
+        counts = []
+        for _ in range(2):
+            self.add_expenses(user_id, 5)
+            response = client.get(f"/users/{user_id}/expenses")
+            counts.append(response.headers["X-Query-Count"])
+        assert len(response.json()) == 10
+        assert counts[0] == counts[1]
+
+    def test_logs(self):
+        with self.assertLogs("app.timing", "INFO") as logs:
+            with mock.patch("app.timing.SLOW_QUERY_MS", 0):
+                client.get("/groups/1", params={"count": False})
+
+        slow, request = logs.output
+        assert slow.startswith("WARNING:app.timing:Slow query (")
+        assert ") in GET /groups/{group_id}: SELECT" in slow
+        assert request.startswith("INFO:app.timing:GET /groups/{group_id} ")
+
+
+def sample(name, labels=None):
+    return REGISTRY.get_sample_value(name, labels or {}) or 0
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        Base.metadata.create_all(bind=engine)
+        self.db = TestingSessionLocal()
+
+        app.dependency_overrides[get_db] = lambda: self.db
+
+    def tearDown(self):
+        self.db.invalidate()
+        self.db.close()
+
+    def test_request_metrics(self):
+        labels = {
+            "method": "GET",
+            "route": "/groups/{group_id}",
+            "status": "404",
+        }
+        before = sample("http_requests_total", labels)
+        client.get("/groups/999999")
+        client.get("/no/such/route")
+
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/plain")
+        assert sample("http_requests_total", labels) == before + 1
+        assert (
+            'http_requests_total{method="GET",route="<unmatched>",'
+            'status="404"}' in response.text
+        )
+        assert (
+            'http_request_duration_seconds_count{method="GET",'
+            'route="/groups/{group_id}"}' in response.text
+        )
+
+    def test_domain_metrics(self):
+        with TestingSessionLocal() as session:
+            users = [
+                User(username=f"metrics{i}", email=f"metrics{i}@example.com")
+                for i in range(2)
+            ]
+            session.add_all(users)
+            session.commit()
+            user_ids = [u.user_id for u in users]
+
+        group_id = client.post(
+            "/groups/",
+            json={"group_name": "MetricsGroup", "created_by": user_ids[0]},
+        ).json()["group_id"]
+        client.post(f"/groups/{group_id}/add_member/{user_ids[1]}")
+
+        created = sample("lazy_split_expenses_created_total")
+        expense = {
+            "group_id": group_id,
+            "description": "counted",
+            "amount": 100,
+            "created_by": user_ids[0],
+        }
+        headers = {"Idempotency-Key": "counted-expense"}
+        client.post("/expenses/", json=expense, headers=headers)
+        # A replay creates nothing
+        client.post("/expenses/", json=expense, headers=headers)
+        client.post(
+            "/expenses/batch",
+            json={"group_id": group_id, "expenses": [expense, expense]},
+        )
+        assert sample("lazy_split_expenses_created_total") == created + 3
+
+        partial = {"outcome": "partial"}
+        settled = {"outcome": "settled"}
+        before = [
+            sample("lazy_split_dept_payments_total", partial),
+            sample("lazy_split_dept_payments_total", settled),
+            sample("lazy_split_dept_paid_total"),
+        ]
+        (dept,) = client.get(f"/dept/{group_id}").json()
+        client.patch(f"/dept/{dept['dept_id']}", json={"amount": 50})
+        client.patch(f"/dept/{dept['dept_id']}", json={"amount": 500})
+        assert [
+            sample("lazy_split_dept_payments_total", partial),
+            sample("lazy_split_dept_payments_total", settled),
+            sample("lazy_split_dept_paid_total"),
+        ] == [before[0] + 1, before[1] + 1, before[2] + dept["amount"]]
+
+    def test_dept_rows(self):
+        with TestingSessionLocal() as session:
+            session.add_all(
+                Dept(user_id=2, lender_id=1, group_id=999, amount=i + 1)
+                for i in range(3)
+            )
+            session.commit()
+            groups = (
+                session.query(func.count(func.distinct(Dept.group_id)))
+                .select_from(Dept)
+                .scalar()
+            )
+
+        text = client.get("/metrics").text
+        assert f"lazy_split_group_dept_rows_count {groups}.0" in text
+        assert 'lazy_split_group_dept_rows_bucket{le="+Inf"}' in text
+        assert "lazy_split_group_dept_rows_max " in text
+        self.db.query(Dept).filter(Dept.group_id == 999).delete()
+        self.db.commit()
+
+    def test_multiprocess(self):
+        # Two workers count expenses, a scrape adds them up
+        with tempfile.TemporaryDirectory() as path:
+            script = (
+                "import sys\n"
+                "from app.metrics import count_expenses_created\n"
+                "count_expenses_created(int(sys.argv[1]))\n"
+            )
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=path)
+            for count in (2, 3):
+                subprocess.run(
+                    [sys.executable, "-c", script, str(count)],
+                    env=env,
+                    check=True,
+                )
+
+            with mock.patch("app.metrics.MULTIPROC_DIR", path):
+                text = render_metrics(self.db).decode()
+
+        assert "lazy_split_expenses_created_total 5.0" in text
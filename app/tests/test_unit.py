@@ -30,6 +30,11 @@ from app.api.dept import (
     update_dept_amount,
     DeptPaid,
 )
+from app.money import split_amount
+from app.pagination import encode_cursor
+from app.reconcile import add_dept, new_deltas, split_expense
+from app.recompute import dept_matrix, matrix_balances, matrix_depts
+from app.settlement import net_balances, simplify_debts
 from app.models import (
     Dept,
     User,
@@ -38,9 +43,39 @@ from app.models import (
     Expense,
     ExpenseParticipant,
 )
-from unittest.mock import MagicMock
+import asyncio
+import random
+from collections import namedtuple
+from datetime import datetime
+from unittest.mock import AsyncMock, MagicMock
+
+from fastapi import HTTPException, Response
+import numpy as np
 import pytest
 
+UserExpenseRow = namedtuple(
+    "UserExpenseRow",
+    [
+        "expense_participant_id",
+        "expense_id",
+        "user_id",
+        "amount_paid",
+        "amount_owed",
+        "expense_description",
+        "expense_amount",
+        "expense_created_at",
+    ],
+)
+
+UserRow = namedtuple("UserRow", ["user_id", "username", "email"])
+GroupRow = namedtuple("GroupRow", ["group_id", "group_name", "created_by"])
+ExpenseRow = namedtuple(
+    "ExpenseRow", ["expense_id", "description", "amount", "created_by"]
+)
+DeptRow = namedtuple(
+    "DeptRow", ["dept_id", "user_id", "lender_id", "group_id", "amount"]
+)
+
 
 class TestAuthAPI:
     @pytest.fixture
@@ -70,26 +105,39 @@ class TestUserAPI:
         return MagicMock()
 
     def test_get_users(self, mock_db):
-        mock_db.query().all.return_value = [
-            User(
-                user_id=1,
-                username="User 1",
-                email="test1@example.com",
-                password="password1",
-            ),
-            User(
-                user_id=2,
-                username="User 2",
-                email="test2@example.com",
-                password="password2",
-            ),
+        mock_db.execute().scalar_one.return_value = 2
+        mock_db.execute().all.return_value = [
+            UserRow(user_id=1, username="User 1", email="test1@example.com"),
+            UserRow(user_id=2, username="User 2", email="test2@example.com"),
         ]
 
-        data = get_users(db=mock_db)
+        response = Response()
+        data = get_users(response=response, db=mock_db)
 
         assert len(data) == 2
-        assert data[0].username == "User 1"
-        assert data[1].username == "User 2"
+        assert data[0]["username"] == "User 1"
+        assert data[1]["username"] == "User 2"
+        assert response.headers["X-Total-Count"] == "2"
+        assert "X-Next-Cursor" not in response.headers
+
+    def test_get_users_next_page(self, mock_db):
+        mock_db.execute().all.return_value = [
+            UserRow(user_id=i, username=f"User {i}", email=f"{i}@example.com")
+            for i in (1, 2, 3)
+        ]
+
+        response = Response()
+        data = get_users(response=response, limit=2, count=False, db=mock_db)
+
+        assert [u["user_id"] for u in data] == [1, 2]
+        assert response.headers["X-Next-Cursor"] == encode_cursor(2)
+        assert "X-Total-Count" not in response.headers
+
+    def test_get_users_unknown_field(self, mock_db):
+        with pytest.raises(HTTPException) as exc_info:
+            get_users(response=Response(), fields="user_id,nope", db=mock_db)
+
+        assert exc_info.value.status_code == 400
 
     def test_get_user(self, mock_db):
         user = User(
@@ -141,28 +189,34 @@ class TestUserAPI:
         assert data[0].total_members == group.total_members
 
     def test_get_user_expenses(self, mock_db):
-        mock_user = MagicMock()
-        mock_db.user_id = 1
-        mock_db.query().filter().first.return_value = mock_user
-
-        mock_expense_participant = MagicMock()
-        mock_expense_participant.expense_id = 1
-        mock_expense_participant.participant_info = "info"
-        mock_db.query().filter().all.return_value = [mock_expense_participant]
+        mock_db.query().filter().first.return_value = MagicMock()
 
-        mock_expense = MagicMock()
-        mock_expense.description = "Test expense"
-        mock_expense.amount = 100
-        mock_db.query().filter().first.return_value = mock_expense
+        row = UserExpenseRow(
+            expense_participant_id=1,
+            expense_id=1,
+            user_id=1,
+            amount_paid=100,
+            amount_owed=0,
+            expense_description="Test expense",
+            expense_amount=100,
+            expense_created_at=datetime(2024, 1, 1),
+        )
+        mock_db.query().join().filter().order_by().limit().all.return_value = [
+            row
+        ]
 
-        expenses_with_details = get_user_expenses(user_id=1, db=mock_db)
+        response = Response()
+        expenses_with_details = get_user_expenses(
+            user_id=1, response=response, db=mock_db
+        )
 
         assert len(expenses_with_details) == 1
-        assert expenses_with_details[0]["participant_info"] == "info"
+        assert expenses_with_details[0]["expense_participant_id"] == 1
         assert (
             expenses_with_details[0]["expense_description"] == "Test expense"
         )
         assert expenses_with_details[0]["expense_amount"] == 100
+        assert "X-Next-Cursor" not in response.headers
 
 
 class TestGroupAPI:
@@ -171,16 +225,16 @@ class TestGroupAPI:
         return MagicMock()
 
     def test_get_groups(self, mock_db):
-        mock_db.query().all.return_value = [
-            Group(group_id=1, group_name="Group 1", created_by=1),
-            Group(group_id=2, group_name="Group 2", created_by=2),
+        mock_db.execute().all.return_value = [
+            GroupRow(group_id=1, group_name="Group 1", created_by=1),
+            GroupRow(group_id=2, group_name="Group 2", created_by=2),
         ]
 
-        data = get_groups(db=mock_db)
+        data = get_groups(response=Response(), db=mock_db)
 
         assert len(data) == 2
-        assert data[0].group_name == "Group 1"
-        assert data[1].group_name == "Group 2"
+        assert data[0]["group_name"] == "Group 1"
+        assert data[1]["group_name"] == "Group 2"
 
     def test_get_group(self, mock_db):
         group = Group(group_id=1, group_name="Test Group", created_by=1)
@@ -215,7 +269,8 @@ class TestGroupAPI:
             email="test@example.com",
             password="password",
         )
-        mock_db.query().filter().first.side_effect = [user, group, None]
+        mock_db.query().filter().first.side_effect = [user, None]
+        mock_db.query().filter().with_for_update().first.return_value = group
 
         data = add_group_member(group_id=1, user_id=1, db=mock_db)
 
@@ -227,24 +282,22 @@ class TestGroupAPI:
 class TestExpenseAPI:
     @pytest.fixture
     def mock_db(self):
-        return MagicMock()
+        db = MagicMock()
+        # An empty ledger tail, no snapshot is due
+        db.query().filter().limit().count.return_value = 0
+        return db
 
     def test_get_expenses(self, mock_db):
-        expense = Expense(
-            expense_id=1,
-            group_id=1,
-            description="Test Expense",
-            amount=100,
-            created_by=1,
+        expense = ExpenseRow(
+            expense_id=1, description="Test Expense", amount=100, created_by=1
         )
-        mock_db.query().all.return_value = [expense]
+        mock_db.execute().all.return_value = [expense]
 
-        data = get_expenses(db=mock_db)
+        data = get_expenses(response=Response(), db=mock_db)
 
-        assert isinstance(data[0], Expense)
-        assert data[0].description == expense.description
-        assert data[0].amount == expense.amount
-        assert data[0].created_by == expense.created_by
+        assert data[0]["description"] == expense.description
+        assert data[0]["amount"] == expense.amount
+        assert data[0]["created_by"] == expense.created_by
 
     def test_get_expense(self, mock_db):
         expense = Expense(
@@ -286,6 +339,7 @@ class TestExpenseAPI:
         assert data["description"] == expense.description
         assert data["amount"] == expense.amount
         assert data["created_by"] == expense.created_by
+        mock_db.commit.assert_called_once()
 
     def test_delete_expense(self, mock_db):
         expense = Expense(
@@ -302,7 +356,9 @@ class TestExpenseAPI:
             total_members=1,
             total_expenses=100,
         )
-        mock_db.query().filter().first.side_effect = [expense, group]
+        mock_db.query().filter().scalar.return_value = expense.group_id
+        mock_db.query().filter().first.return_value = expense
+        mock_db.query().filter().with_for_update().first.return_value = group
 
         data = delete_expense(expense_id=1, db=mock_db)
 
@@ -316,10 +372,8 @@ class TestExpenseAPI:
             amount=100,
             created_by=1,
         )
-        group = Group(
-            group_id=1, group_name="Test Group", created_by=1, total_members=1
-        )
-        mock_db.query().filter().first.side_effect = [expense, group]
+        mock_db.query().filter().first.side_effect = [expense]
+        mock_db.query().filter().all.return_value = [MagicMock(user_id=1)]
 
         expense_create_data = {
             "expense_id": 1,
@@ -340,10 +394,13 @@ class TestExpenseAPI:
 class TestDeptAPI:
     @pytest.fixture
     def mock_db(self):
-        return MagicMock()
+        db = MagicMock()
+        # An empty ledger tail, no snapshot is due
+        db.query().filter().limit().count.return_value = 0
+        return db
 
     def test_list_group_depts(self, mock_db):
-        dept_instance = Dept(
+        dept_row = DeptRow(
             dept_id=1,
             user_id=1,
             lender_id=2,
@@ -351,17 +408,17 @@ class TestDeptAPI:
             amount=100,
         )
 
-        mock_db.query.return_value.filter.return_value.all.return_value = [
-            dept_instance
-        ]
-        data = list_group_depts(group_id=1, db=mock_db)
+        rows = MagicMock()
+        rows.all.return_value = [dept_row]
+        mock_db.execute = AsyncMock(return_value=rows)
+        mock_db.scalar = AsyncMock(return_value=1)
+        response = Response()
+        data = asyncio.run(
+            list_group_depts(group_id=1, response=response, db=mock_db)
+        )
 
-        assert isinstance(data[0], Dept)
-        assert data[0].group_id == 1
-        assert data[0].user_id == 1
-        assert data[0].lender_id == 2
-        assert data[0].amount == 100
-        assert data[0].dept_id == 1
+        assert data[0] == dept_row._asdict()
+        assert response.headers["X-Total-Count"] == "1"
 
     def test_list_user_depts(self, mock_db):
         dept_instance = Dept(
@@ -372,11 +429,13 @@ class TestDeptAPI:
             amount=100,
         )
 
-        mock_db.query.return_value.filter.return_value.all.return_value = [
-            dept_instance
-        ]
+        depts = MagicMock()
+        depts.all.return_value = [dept_instance]
+        mock_db.scalars = AsyncMock(return_value=depts)
 
-        result = list_user_depts(group_id=1, user_id=1, db=mock_db)
+        result = asyncio.run(
+            list_user_depts(group_id=1, user_id=1, db=mock_db)
+        )
 
         assert isinstance(result[0], Dept)
         assert result[0].dept_id == 1
@@ -419,3 +478,129 @@ class TestDeptAPI:
         assert response == {
             "message": "Dept updated successfully, amount left: 50"
         }
+
+
+class TestSettlement:
+    def test_net_balances(self):
+        depts = [
+            Dept(user_id=1, lender_id=2, amount=30),
+            Dept(user_id=2, lender_id=3, amount=20),
+        ]
+
+        assert net_balances(depts) == {1: -30, 2: 10, 3: 20}
+
+    def test_simplify_debts_chain(self):
+        transfers = simplify_debts({1: -30, 2: 10, 3: 20})
+
+        assert sorted(transfers) == [(1, 2, 10), (1, 3, 20)]
+
+    def test_simplify_debts_conserves_balances(self):
+        balances = {1: 50, 2: -20, 3: -20, 4: -10, 5: 0}
+
+        transfers = simplify_debts(balances)
+
+        settled = dict.fromkeys(balances, 0)
+        for user_id, lender_id, amount in transfers:
+            settled[user_id] -= amount
+            settled[lender_id] += amount
+        assert settled == balances
+        assert len(transfers) <= len(balances) - 1
+
+    def test_simplify_debts_ignores_dust(self):
+        assert simplify_debts({1: 0.001, 2: -0.001}) == []
+
+
+class TestReconcile:
+    def test_add_dept_pays_off_reverse_dept(self):
+        amounts = {(1, 2): 30}
+
+        add_dept(amounts, 1, 2, 10)
+        assert amounts == {(1, 2): 20}
+
+        add_dept(amounts, 1, 2, 50)
+        assert amounts == {(2, 1): 30}
+
+        add_dept(amounts, 1, 2, -30)
+        assert amounts == {}
+
+    def test_split_expense(self):
+        amounts = {(2, 1): 10, (1, 3): 5}
+        deltas = new_deltas()
+
+        changed = split_expense(amounts, 1, {1: 30, 2: 30, 3: 30}, deltas)
+
+        assert amounts == {(1, 2): 20, (1, 3): 35}
+        assert deltas == {1: 60, 2: -30, 3: -30}
+        assert changed == {(1, 2), (2, 1), (1, 3), (3, 1)}
+
+    def test_split_expense_undo(self):
+        amounts = {(1, 2): 20, (1, 3): 35}
+        deltas = new_deltas()
+
+        split_expense(amounts, 1, {1: 30, 2: 30, 3: 30}, deltas, sign=-1)
+
+        assert amounts == {(2, 1): 10, (1, 3): 5}
+        assert deltas == {1: -60, 2: 30, 3: 30}
+
+
+class TestRecompute:
+    def test_dept_matrix(self):
+        user_ids = np.array([2, 3, 1, 2])
+        lender_ids = np.array([1, 1, 2, 1])
+        amounts = np.array([30, 20, 50, -10])
+
+        members, owed = dept_matrix(user_ids, lender_ids, amounts)
+
+        assert members.tolist() == [1, 2, 3]
+        assert matrix_depts(members, owed) == {(2, 1): 30, (1, 3): 20}
+        assert matrix_balances(members, owed) == {1: -10, 2: 30, 3: -20}
+
+    def test_dept_matrix_matches_add_dept(self):
+        rng = random.Random(0)
+        entries = [
+            (*rng.sample(range(1, 30), 2), rng.randint(-500, 1000))
+            for _ in range(2000)
+        ]
+        amounts = {}
+        for user_id, lender_id, amount in entries:
+            add_dept(amounts, user_id, lender_id, amount)
+
+        members, owed = dept_matrix(*np.array(entries).T)
+
+        assert matrix_depts(members, owed) == amounts
+
+    def test_dept_matrix_empty(self):
+        empty = np.array([], dtype=np.int64)
+
+        members, owed = dept_matrix(empty, empty, empty)
+
+        assert matrix_depts(members, owed) == {}
+        assert matrix_balances(members, owed) == {}
+
+
+class TestMoney:
+    def test_split_amount_even(self):
+        assert split_amount(900, [3, 1, 2]) == {1: 300, 2: 300, 3: 300}
+
+    def test_split_amount_remainder(self):
+        assert split_amount(1000, [1, 2, 3]) == {1: 334, 2: 333, 3: 333}
+        assert split_amount(1000, [1, 2, 3], offset=1) == {
+            1: 333,
+            2: 334,
+            3: 333,
+        }
+        assert split_amount(1001, [1, 2, 3], offset=2) == {
+            1: 334,
+            2: 333,
+            3: 334,
+        }
+
+    def test_split_amount_sums_to_total(self):
+        for total in range(0, 200):
+            for count in range(1, 8):
+                shares = split_amount(total, range(count), offset=total)
+                assert sum(shares.values()) == total
+                assert max(shares.values()) - min(shares.values()) <= 1
+
+    def test_split_amount_no_members(self):
+        assert split_amount(100, []) == {}
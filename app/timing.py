@@ -0,0 +1,138 @@
+"""Time each request and count the SQL it runs.
+
+``TimingMiddleware`` measures the wall time of a request and adds two
+response headers::
+
+    Server-Timing: app;dur=12.3, db;dur=4.5;desc="queries: 3"
+    X-Query-Count: 3
+
+The queries are counted by cursor hooks on the engines passed to
+``instrument_engine``, into the stats of the request that is running
+them, found through a context variable. Each request is logged on the
+``app.timing`` logger with its route template, e.g. ``GET
+/groups/{group_id}``, and a statement that takes SLOW_QUERY_MS or more
+is logged as a warning with the route that ran it.
+
+Rows a streamed response reads after its headers are sent are logged
+with the request but are missing from the headers.
+"""
+
+import logging
+import os
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+# Statements taking this many milliseconds or more are logged
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+
+_current = ContextVar("request_stats", default=None)
+
+
+class RequestStats:
+    """Wall time and SQL of one request."""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+
+    @property
+    def route(self):
+        """Method and path template, the raw path before routing."""
+        route = self.scope.get("route")
+        path = getattr(route, "path", self.scope["path"])
+        return f"{self.scope['method']} {path}"
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def server_timing(self):
+        return (
+            f"app;dur={self.elapsed() * 1000:.1f}, "
+            f"db;dur={self.db_time * 1000:.1f};"
+            f'desc="queries: {self.queries}"'
+        )
+
+
+def current_stats():
+    """Stats of the request being served, None outside of a request."""
+    return _current.get()
+
+
+def _before_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    context._query_start = time.perf_counter()
+
+
+def _after_cursor_execute(
+    conn, cursor, statement, parameters, context, executemany
+):
+    elapsed = time.perf_counter() - context._query_start
+    stats = _current.get()
+    if stats is not None:
+        stats.queries += 1
+        stats.db_time += elapsed
+
+    if elapsed * 1000 >= SLOW_QUERY_MS:
+        logger.warning(
+            "Slow query (%.1f ms) in %s: %s",
+            elapsed * 1000,
+            stats.route if stats is not None else "no request",
+            statement,
+        )
+
+
+def instrument_engine(engine):
+    """Count and time the statements ``engine`` runs.
+
+    Pass ``async_engine.sync_engine`` for an async engine.
+    """
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+class TimingMiddleware:
+    """ASGI middleware adding Server-Timing and X-Query-Count."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _current.set(stats)
+        status = None
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers += [
+                    (b"server-timing", stats.server_timing().encode()),
+                    (b"x-query-count", str(stats.queries).encode()),
+                ]
+                message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current.reset(token)
+            logger.info(
+                "%s %s %.1f ms, %d queries in %.1f ms",
+                stats.route,
+                status,
+                stats.elapsed() * 1000,
+                stats.queries,
+                stats.db_time * 1000,
+            )
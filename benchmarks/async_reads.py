@@ -0,0 +1,170 @@
+"""Concurrent dashboard requests, worker threadpool against async.
+
+Run with::
+
+    poetry run python -m benchmarks.async_reads --requests 2000
+
+The same ``get_group_dashboard`` queries are served twice: once from a
+sync ``def`` route on a plain Session, which holds a worker thread for
+every database round trip, and once from the async route on the
+aiosqlite engine. Requests go through the ASGI app in process, so the
+numbers compare the request paths rather than the network. ``--url``
+runs against another database, e.g. an empty PostgreSQL one.
+"""
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+
+from app.api.expenses import ExpenseCreate, create_expense
+from app.api.groups import get_group_dashboard
+from app.database import (
+    Base,
+    async_database_url,
+    create_async_db_engine,
+    create_db_engine,
+)
+from benchmarks.create_expense import seed
+
+
+class BlockingSession:
+    """The AsyncSession methods the dashboard uses, run on a Session."""
+
+    def __init__(self, db):
+        self.db = db
+
+    async def get(self, *args):
+        return self.db.get(*args)
+
+    async def execute(self, statement):
+        return self.db.execute(statement)
+
+
+def run_blocking(coroutine):
+    # BlockingSession never suspends, the coroutine finishes in one step
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+    raise RuntimeError("coroutine suspended")
+
+
+def build_app(path):
+    SessionLocal = sessionmaker(
+        autocommit=False, autoflush=False, bind=create_db_engine(path)
+    )
+    async_engine = create_async_db_engine(async_database_url(path))
+
+    def get_db():
+        with SessionLocal() as db:
+            yield db
+
+    async def get_async_db():
+        async with AsyncSession(async_engine) as db:
+            yield db
+
+    bench = FastAPI()
+
+    @bench.get("/threadpool/{group_id}")
+    def threadpool_dashboard(group_id: int, db: Session = Depends(get_db)):
+        return run_blocking(
+            get_group_dashboard(group_id=group_id, db=BlockingSession(db))
+        )
+
+    @bench.get("/async/{group_id}")
+    async def async_dashboard(
+        group_id: int, db: AsyncSession = Depends(get_async_db)
+    ):
+        return await get_group_dashboard(group_id=group_id, db=db)
+
+    return bench
+
+
+async def load(bench, url, requests, concurrency):
+    transport = httpx.ASGITransport(app=bench)
+    latencies = []
+    queue = asyncio.Queue()
+    for _ in range(requests):
+        queue.put_nowait(url)
+
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://bench"
+    ) as client:
+
+        async def worker():
+            while not queue.empty():
+                target = queue.get_nowait()
+                start = time.perf_counter()
+                response = await client.get(target)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        "rps": requests / elapsed,
+        "p95": latencies[int(len(latencies) * 0.95)] * 1000,
+    }
+
+
+async def compare(bench, group_id, requests, concurrencies):
+    for concurrency in concurrencies:
+        for name in ("threadpool", "async"):
+            result = await load(
+                bench, f"/{name}/{group_id}", requests, concurrency
+            )
+            print(
+                f"{name} x{concurrency}: {result['rps']:.1f} req/sec "
+                f"(p95 {result['p95']:.1f} ms)"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument(
+        "--concurrency", type=int, nargs="+", default=[10, 50, 200]
+    )
+    parser.add_argument("--members", type=int, default=10)
+    parser.add_argument("--expenses", type=int, default=100)
+    parser.add_argument(
+        "--url",
+        help="empty database to seed, a temporary SQLite file if unset",
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = args.url or f"sqlite:///{os.path.join(tmp, 'lazy_split.db')}"
+        engine = create_db_engine(url)
+        Base.metadata.create_all(bind=engine)
+        with sessionmaker(bind=engine)() as session:
+            group_id, user_ids = seed(session, args.members)
+            for i in range(args.expenses):
+                create_expense(
+                    ExpenseCreate(
+                        group_id=group_id,
+                        description=f"expense {i}",
+                        amount=100,
+                        created_by=user_ids[i % len(user_ids)],
+                    ),
+                    db=session,
+                )
+        engine.dispose()
+
+        asyncio.run(
+            compare(build_app(url), group_id, args.requests, args.concurrency)
+        )
+
+
+if __name__ == "__main__":
+    main()
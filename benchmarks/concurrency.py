@@ -0,0 +1,145 @@
+"""Read throughput while writes are in flight, per SQLite journal mode.
+
+Run with::
+
+    poetry run python -m benchmarks.concurrency --readers 4 --seconds 5
+
+A writer process keeps creating expenses while reader processes load
+the group's depts, like separate uvicorn workers sharing one database
+file. It runs once with the rollback journal and once with the pragmas
+from app.database.
+"""
+
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from app.api.expenses import ExpenseCreate, create_expense
+from app.database import SQLITE_PRAGMAS, Base, create_db_engine
+from app.models import Dept
+from benchmarks.create_expense import seed
+
+CONFIGS = {
+    "rollback journal": {"journal_mode": "DELETE", "synchronous": "FULL"},
+    "app.database pragmas": SQLITE_PRAGMAS,
+}
+
+
+def sessionmaker_for(path, pragmas):
+    engine = create_db_engine(f"sqlite:///{path}", pragmas=pragmas)
+    return sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+
+def writer(path, pragmas, group_id, user_ids, stop, results):
+    Session = sessionmaker_for(path, pragmas)
+    writes = errors = 0
+    while not stop.is_set():
+        try:
+            with Session() as session:
+                create_expense(
+                    ExpenseCreate(
+                        group_id=group_id,
+                        description=f"expense {writes}",
+                        amount=100,
+                        created_by=user_ids[writes % len(user_ids)],
+                    ),
+                    db=session,
+                )
+            writes += 1
+        except OperationalError:
+            errors += 1
+    results.put(("writer", writes, errors))
+
+
+def reader(path, pragmas, group_id, stop, results):
+    Session = sessionmaker_for(path, pragmas)
+    latencies, errors = [], 0
+    while not stop.is_set():
+        start = time.perf_counter()
+        try:
+            with Session() as session:
+                session.query(Dept).filter(Dept.group_id == group_id).all()
+            latencies.append(time.perf_counter() - start)
+        except OperationalError:
+            errors += 1
+    results.put(("reader", latencies, errors))
+
+
+def run(pragmas, readers, seconds, members, path):
+    engine = create_db_engine(f"sqlite:///{path}", pragmas=pragmas)
+    Base.metadata.create_all(bind=engine)
+    with sessionmaker(bind=engine)() as session:
+        group_id, user_ids = seed(session, members)
+    engine.dispose()
+
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [
+        multiprocessing.Process(
+            target=writer,
+            args=(path, pragmas, group_id, user_ids, stop, results),
+        )
+    ]
+    processes += [
+        multiprocessing.Process(
+            target=reader, args=(path, pragmas, group_id, stop, results)
+        )
+        for _ in range(readers)
+    ]
+
+    for process in processes:
+        process.start()
+    time.sleep(seconds)
+    stop.set()
+
+    latencies, writes, errors = [], 0, 0
+    for _ in processes:
+        kind, value, failed = results.get()
+        if kind == "writer":
+            writes = value
+        else:
+            latencies += value
+        errors += failed
+    for process in processes:
+        process.join()
+
+    latencies.sort()
+    return {
+        "reads": len(latencies) / seconds,
+        "writes": writes / seconds,
+        "p99": latencies[int(len(latencies) * 0.99)] * 1000,
+        "errors": errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--members", type=int, default=10)
+    args = parser.parse_args()
+
+    for name, pragmas in CONFIGS.items():
+        with tempfile.TemporaryDirectory() as tmp:
+            result = run(
+                pragmas,
+                args.readers,
+                args.seconds,
+                args.members,
+                os.path.join(tmp, "lazy_split.db"),
+            )
+        print(
+            f"{name}: {result['reads']:.1f} reads/sec "
+            f"(p99 {result['p99']:.1f} ms), "
+            f"{result['writes']:.1f} writes/sec, "
+            f"{result['errors']} lock errors"
+        )
+
+
+if __name__ == "__main__":
+    main()
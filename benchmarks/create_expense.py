@@ -0,0 +1,95 @@
+"""Throughput of ``expenses.create_expense`` on a file-backed database.
+
+Run with::
+
+    poetry run python -m benchmarks.create_expense --expenses 500 --members 10
+
+Every call gets its own session, like a request does, so the numbers
+include the commit (and fsync) cost of the endpoint.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app.api.expenses import ExpenseCreate, create_expense
+from app.database import Base
+from app.models import Group, GroupMembership, User
+
+
+def seed(session, members):
+    users = [
+        User(
+            username=f"bench_user_{i}",
+            password="password",
+            email=f"bench_user_{i}@example.com",
+        )
+        for i in range(members)
+    ]
+    session.add_all(users)
+    session.flush()
+
+    group = Group(
+        group_name="bench group",
+        created_by=users[0].user_id,
+        total_members=members,
+    )
+    session.add(group)
+    session.flush()
+
+    session.add_all(
+        GroupMembership(group_id=group.group_id, user_id=u.user_id)
+        for u in users
+    )
+    session.commit()
+    return group.group_id, [u.user_id for u in users]
+
+
+def run(expenses, members, path):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    with Session() as session:
+        group_id, user_ids = seed(session, members)
+
+    start = time.perf_counter()
+    for i in range(expenses):
+        with Session() as session:
+            create_expense(
+                ExpenseCreate(
+                    group_id=group_id,
+                    description=f"expense {i}",
+                    amount=100 + i,
+                    created_by=user_ids[i % len(user_ids)],
+                ),
+                db=session,
+            )
+    elapsed = time.perf_counter() - start
+    engine.dispose()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--expenses", type=int, default=500)
+    parser.add_argument("--members", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        elapsed = run(
+            args.expenses, args.members, os.path.join(tmp, "lazy_split.db")
+        )
+
+    print(
+        f"{args.expenses} expenses, {args.members} members: "
+        f"{elapsed:.2f}s, {args.expenses / elapsed:.1f} expenses/sec"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,456 @@
+"""Load test of the API with realistic request mixes.
+
+Run with::
+
+    poetry run python -m benchmarks.load
+    poetry run python -m benchmarks.load --scenario settlement --requests 500
+    poetry run python -m benchmarks.load --save benchmarks/baseline.json
+    poetry run python -m benchmarks.load --compare benchmarks/baseline.json
+
+A temporary SQLite database is seeded with ``--users`` users and
+``--groups`` groups of ``--members`` members, each with ``--expenses``
+expenses. Then ``--concurrency`` clients run ``--requests`` operations
+of a scenario's mix against ``app.main.app`` in process, through its
+middleware, routers and threadpool, without any network. Every
+scenario starts from a copy of the same seeded database.
+
+``--compare`` runs with the settings recorded in a baseline file and
+flags a drop in throughput or a rise in p95 latency larger than
+``--tolerance``, a rise in p99 latency larger than twice that, or new
+errors. It exits with status 1 when anything
+regressed.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+import httpx
+
+# Operation weights of every scenario
+SCENARIOS = {
+    "create_expense_heavy": {
+        "create_expense": 80,
+        "dashboard": 15,
+        "balances": 5,
+    },
+    "dashboard_read_heavy": {
+        "dashboard": 60,
+        "group_depts": 15,
+        "balances": 10,
+        "user_expenses": 10,
+        "create_expense": 5,
+    },
+    "settlement": {
+        "pay_dept": 45,
+        "simplify": 15,
+        "simplify_persist": 5,
+        "balances": 15,
+        "create_expense": 20,
+    },
+}
+
+DEFAULTS = {
+    "users": 200,
+    "groups": 20,
+    "members": 8,
+    "expenses": 50,
+    "requests": 1000,
+    "concurrency": 10,
+    "warmup": 50,
+    "seed": 0,
+}
+
+# Metrics compared against a baseline: whether higher is better, and the
+# multiple of --tolerance they may move by. p99 is only a handful of the
+# slowest requests, those that waited longest for SQLite's write lock.
+COMPARED = {"rps": (True, 1), "p95_ms": (False, 1), "p99_ms": (False, 2)}
+
+
+def load_app(url):
+    """Import ``app.main`` with its engines pointed at ``url``.
+
+    app.database reads DATABASE_URL when it is first imported, so no
+    app module may be imported before this is called.
+    """
+    os.environ["DATABASE_URL"] = url
+    os.environ.pop("ASYNC_DATABASE_URL", None)
+    from app import database, main
+
+    # Writers queueing on SQLite's lock would be logged as slow queries
+    logging.getLogger("app.timing").setLevel(logging.ERROR)
+
+    return main.app, database
+
+
+def seed(database, config):
+    """Fill the database, returns ``{group_id: member ids}``."""
+    from sqlalchemy import insert
+
+    from app.api.expenses import ExpenseCreate, _create_expenses
+    from app.models import Group, GroupMembership, User
+
+    rng = random.Random(config["seed"])
+    groups = {}
+    with database.SessionLocal() as db:
+        db.execute(
+            insert(User),
+            [
+                {
+                    "username": f"load_user_{i}",
+                    "password": "password",
+                    "email": f"load_user_{i}@example.com",
+                }
+                for i in range(config["users"])
+            ],
+        )
+        user_ids = [user_id for (user_id,) in db.query(User.user_id)]
+
+        for i in range(config["groups"]):
+            members = rng.sample(user_ids, config["members"])
+            group = Group(
+                group_name=f"load group {i}",
+                created_by=members[0],
+                total_members=len(members),
+            )
+            db.add(group)
+            db.flush()
+            db.add_all(
+                GroupMembership(
+                    group_id=group.group_id,
+                    user_id=user_id,
+                    is_admin=user_id == members[0],
+                )
+                for user_id in members
+            )
+            # The batch endpoint's path, so the depts, balances and
+            # ledger are consistent
+            items = [
+                ExpenseCreate(
+                    group_id=group.group_id,
+                    description=f"seeded {k}",
+                    amount=rng.randint(100, 100000),
+                    created_by=rng.choice(members),
+                )
+                for k in range(config["expenses"])
+            ]
+            _create_expenses(db, group, members, items)
+            db.commit()
+            groups[group.group_id] = members
+    return groups
+
+
+class Run:
+    """The client of a scenario and the latencies it recorded."""
+
+    def __init__(self, client, groups):
+        self.client = client
+        self.groups = groups
+        self.group_ids = sorted(groups)
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.recording = False
+
+    async def request(self, name, method, url, ok=(200,), **kwargs):
+        start = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - start
+        if self.recording:
+            self.latencies[name].append(elapsed)
+            if response.status_code not in ok:
+                self.errors += 1
+        return response
+
+    def group(self, rng):
+        group_id = rng.choice(self.group_ids)
+        return group_id, self.groups[group_id]
+
+
+async def create_expense(run, rng):
+    group_id, members = run.group(rng)
+    await run.request(
+        "create_expense",
+        "POST",
+        "/expenses/",
+        json={
+            "group_id": group_id,
+            "description": "load",
+            "amount": rng.randint(100, 100000),
+            "created_by": rng.choice(members),
+        },
+    )
+
+
+async def dashboard(run, rng):
+    group_id, _ = run.group(rng)
+    await run.request("dashboard", "GET", f"/groups/{group_id}/dashboard")
+
+
+async def balances(run, rng):
+    group_id, _ = run.group(rng)
+    await run.request("balances", "GET", f"/groups/{group_id}/balances")
+
+
+async def group_depts(run, rng):
+    group_id, _ = run.group(rng)
+    return await run.request(
+        "group_depts", "GET", f"/dept/{group_id}", params={"count": False}
+    )
+
+
+async def user_expenses(run, rng):
+    _, members = run.group(rng)
+    user_id = rng.choice(members)
+    await run.request("user_expenses", "GET", f"/users/{user_id}/expenses")
+
+
+async def pay_dept(run, rng):
+    # An empty group's depts are {}, not a list
+    depts = (await group_depts(run, rng)).json()
+    if not depts:
+        return
+    dept = rng.choice(depts)
+    # 404 when another client paid it off in the meantime
+    await run.request(
+        "pay_dept",
+        "PATCH",
+        f"/dept/{dept['dept_id']}",
+        ok=(200, 404),
+        json={"amount": rng.randint(1, dept["amount"])},
+    )
+
+
+async def simplify(run, rng):
+    group_id, _ = run.group(rng)
+    await run.request("simplify", "POST", f"/dept/{group_id}/simplify")
+
+
+async def simplify_persist(run, rng):
+    group_id, _ = run.group(rng)
+    await run.request(
+        "simplify_persist",
+        "POST",
+        f"/dept/{group_id}/simplify",
+        params={"persist": True},
+    )
+
+
+OPERATIONS = {
+    "create_expense": create_expense,
+    "dashboard": dashboard,
+    "balances": balances,
+    "group_depts": group_depts,
+    "user_expenses": user_expenses,
+    "pay_dept": pay_dept,
+    "simplify": simplify,
+    "simplify_persist": simplify_persist,
+}
+
+
+async def drive(run, mix, operations, concurrency, seed):
+    names, weights = list(mix), list(mix.values())
+    remaining = operations
+
+    async def client(index):
+        nonlocal remaining
+        rng = random.Random(seed * 1000 + index)
+        while remaining > 0:
+            remaining -= 1
+            (name,) = rng.choices(names, weights)
+            await OPERATIONS[name](run, rng)
+
+    await asyncio.gather(*(client(i) for i in range(concurrency)))
+
+
+def percentile(ordered, p):
+    """Nearest-rank percentile of the sorted list ``ordered``."""
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def summary(latencies):
+    ordered = sorted(latency * 1000 for latency in latencies)
+    return {
+        "requests": len(ordered),
+        "p50_ms": round(percentile(ordered, 50), 2),
+        "p95_ms": round(percentile(ordered, 95), 2),
+        "p99_ms": round(percentile(ordered, 99), 2),
+    }
+
+
+async def run_scenario(app, database, groups, mix, config):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://load"
+    ) as client:
+        run = Run(client, groups)
+        await drive(
+            run, mix, config["warmup"], config["concurrency"], config["seed"]
+        )
+        run.recording = True
+        start = time.perf_counter()
+        await drive(
+            run,
+            mix,
+            config["requests"],
+            config["concurrency"],
+            config["seed"] + 1,
+        )
+        elapsed = time.perf_counter() - start
+
+    # The aiosqlite connections belong to this event loop
+    await database.async_engine.dispose()
+    database.engine.dispose()
+
+    everything = [t for times in run.latencies.values() for t in times]
+    result = summary(everything)
+    result.update(
+        errors=run.errors,
+        seconds=round(elapsed, 2),
+        rps=round(len(everything) / elapsed, 2),
+        operations={
+            name: summary(times)
+            for name, times in sorted(run.latencies.items())
+        },
+    )
+    return result
+
+
+def restore(template, path):
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.copyfile(template, path)
+
+
+def run(directory, config, scenarios):
+    path = os.path.join(directory, "lazy_split.db")
+    template = os.path.join(directory, "seeded.db")
+    app, database = load_app(f"sqlite:///{path}")
+
+    groups = seed(database, config)
+    database.engine.dispose()
+    shutil.copyfile(path, template)
+
+    results = {}
+    for name in scenarios:
+        restore(template, path)
+        results[name] = asyncio.run(
+            run_scenario(app, database, groups, SCENARIOS[name], config)
+        )
+        report(name, results[name])
+    return results
+
+
+def report(name, result):
+    print(
+        f"{name}: {result['requests']} requests in {result['seconds']}s, "
+        f"{result['rps']} req/s, p50 {result['p50_ms']} ms, "
+        f"p95 {result['p95_ms']} ms, p99 {result['p99_ms']} ms, "
+        f"{result['errors']} errors"
+    )
+    for operation, stats in result["operations"].items():
+        print(
+            f"  {operation:<18} {stats['requests']:>6}  "
+            f"p50 {stats['p50_ms']:>8} ms  p95 {stats['p95_ms']:>8} ms  "
+            f"p99 {stats['p99_ms']:>8} ms"
+        )
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(baseline, results, tolerance):
+    """Print the changes against ``baseline``, returns the regressions."""
+    regressions = []
+    print(f"\ncompared with the baseline, tolerance {tolerance:.0%}:")
+    for name, before in baseline["scenarios"].items():
+        after = results[name]
+        for metric, (higher_is_better, scale) in COMPARED.items():
+            change = after[metric] / before[metric] - 1
+            worse = -change if higher_is_better else change
+            flag = ""
+            if worse > tolerance * scale:
+                flag = "  REGRESSION"
+                regressions.append((name, metric))
+            print(
+                f"  {name:<22} {metric:<7} {before[metric]:>9} -> "
+                f"{after[metric]:>9} ({change:+.1%}){flag}"
+            )
+        if after["errors"] > before["errors"]:
+            print(
+                f"  {name:<22} errors  {before['errors']} -> {after['errors']}"
+                "  REGRESSION"
+            )
+            regressions.append((name, "errors"))
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    for name, default in DEFAULTS.items():
+        parser.add_argument(f"--{name}", type=int, default=default)
+    parser.add_argument(
+        "--scenario", nargs="+", choices=list(SCENARIOS), default=None
+    )
+    parser.add_argument("--save", help="write the results to this file")
+    parser.add_argument(
+        "--compare",
+        help="baseline file, its settings replace the ones above",
+    )
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    config = {name: getattr(args, name) for name in DEFAULTS}
+    scenarios = args.scenario or list(SCENARIOS)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        config = baseline["config"]
+        scenarios = list(baseline["scenarios"])
+        if baseline["environment"] != environment():
+            print(f"baseline environment: {baseline['environment']}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        results = run(tmp, config, scenarios)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "config": config,
+                    "environment": environment(),
+                    "scenarios": results,
+                },
+                f,
+                indent=2,
+            )
+            f.write("\n")
+
+    if baseline is not None and compare(baseline, results, args.tolerance):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+"""Recomputing a group's depts from its ledger: NumPy against row by row.
+
+Run with::
+
+    poetry run python -m benchmarks.recompute --members 200 --expenses 5000
+
+Seeds a file-backed SQLite database with the ledger of one group, where
+``--expenses`` expenses by random payers are split between ``--members``
+members, then recomputes the group's depts and balances twice:
+
+- row by row, fetching the entries and netting each with
+  ``app.reconcile.add_dept``, like the endpoints do for one expense
+- with ``app.recompute``, loading the entries summed per pair by the
+  database as columns and netting them in the members x members matrix
+
+Both results are checked to be equal. Loading and computing are timed
+separately.
+"""
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy import create_engine, insert, select
+from sqlalchemy.orm import sessionmaker
+
+from app.balances import new_deltas, record_dept_change
+from app.database import Base
+from app.models import LedgerEntry
+from app.money import split_amount
+from app.reconcile import add_dept
+from app.recompute import (
+    dept_matrix,
+    load_entries,
+    matrix_balances,
+    matrix_depts,
+)
+
+GROUP_ID = 1
+
+
+def seed(session, members, expenses, seed):
+    rng = random.Random(seed)
+    member_ids = range(1, members + 1)
+    for expense_id in range(1, expenses + 1):
+        payer_id = rng.choice(member_ids)
+        shares = split_amount(
+            rng.randint(100, 1000000), member_ids, expense_id
+        )
+        session.execute(
+            insert(LedgerEntry),
+            [
+                {
+                    "group_id": GROUP_ID,
+                    "user_id": member_id,
+                    "lender_id": payer_id,
+                    "amount": share,
+                    "kind": "expense",
+                    "expense_id": expense_id,
+                }
+                for member_id, share in shares.items()
+                if member_id != payer_id and share
+            ],
+        )
+    session.commit()
+
+
+def row_by_row(session):
+    start = time.perf_counter()
+    rows = session.execute(
+        select(
+            LedgerEntry.user_id, LedgerEntry.lender_id, LedgerEntry.amount
+        ).where(LedgerEntry.group_id == GROUP_ID)
+    ).all()
+    loaded = time.perf_counter()
+
+    amounts, deltas = {}, new_deltas()
+    for user_id, lender_id, amount in rows:
+        add_dept(amounts, user_id, lender_id, amount)
+        record_dept_change(deltas, user_id, lender_id, amount)
+    done = time.perf_counter()
+    return len(rows), amounts, dict(deltas), loaded - start, done - loaded
+
+
+def vectorized(session):
+    start = time.perf_counter()
+    user_ids, lender_ids, sums, counts = load_entries(session, GROUP_ID)
+    loaded = time.perf_counter()
+
+    members, owed = dept_matrix(user_ids, lender_ids, sums)
+    amounts = matrix_depts(members, owed)
+    balances = matrix_balances(members, owed)
+    done = time.perf_counter()
+    return int(counts.sum()), amounts, balances, loaded - start, done - loaded
+
+
+def run(members, expenses, path, seed_value):
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    with Session() as session:
+        seed(session, members, expenses, seed_value)
+
+    results = {}
+    for name, method in (("row by row", row_by_row), ("numpy", vectorized)):
+        with Session() as session:
+            results[name] = method(session)
+    engine.dispose()
+
+    (entries, amounts, balances, _, _), numpy_result = results.values()
+    assert numpy_result[0] == entries, "entries differ"
+    assert numpy_result[1] == amounts, "depts differ"
+    assert {u: b for u, b in numpy_result[2].items() if b} == {
+        u: b for u, b in balances.items() if b
+    }, "balances differ"
+    return entries, len(amounts), results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=200)
+    parser.add_argument("--expenses", type=int, default=5000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        entries, depts, results = run(
+            args.members,
+            args.expenses,
+            os.path.join(tmp, "lazy_split.db"),
+            args.seed,
+        )
+
+    print(
+        f"{args.members} members, {args.expenses} expenses: "
+        f"{entries} ledger entries, {depts} depts"
+    )
+    for name, (_, _, _, load, compute) in results.items():
+        print(
+            f"  {name:<10}  load {load:.3f}s  compute {compute:.3f}s  "
+            f"total {load + compute:.3f}s"
+        )
+
+
+if __name__ == "__main__":
+    main()
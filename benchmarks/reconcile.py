@@ -0,0 +1,71 @@
+"""Micro-benchmark of the dept reconciliation in ``app.reconcile``.
+
+Run with::
+
+    poetry run python -m benchmarks.reconcile
+    poetry run python -m benchmarks.reconcile --members 10 100 1000 5000
+
+Times ``split_expense`` on its own, without the app or a database, for
+one expense in groups of each ``--members`` size. The payer starts out
+owing some members, owed by others and even with the rest, so every
+branch of the netting runs. Each round charges the expense and undoes
+it, which leaves the depts as they were for the next round.
+"""
+
+import argparse
+import random
+import statistics
+import timeit
+
+from app.money import split_amount
+from app.reconcile import add_dept, new_deltas, split_expense
+
+
+def group_depts(members, rng):
+    amounts = {}
+    for member_id in range(2, members + 1):
+        # Owes the payer, is owed by the payer, or even
+        direction = rng.choice((1, -1, 0))
+        if direction:
+            add_dept(amounts, member_id, 1, direction * rng.randint(1, 10000))
+    return amounts
+
+
+def run(members, repeat, seed):
+    rng = random.Random(seed)
+    amounts = group_depts(members, rng)
+    shares = split_amount(rng.randint(1, 10**7), range(1, members + 1))
+    deltas = new_deltas()
+
+    def round_trip():
+        split_expense(amounts, 1, shares, deltas)
+        split_expense(amounts, 1, shares, deltas, sign=-1)
+
+    timer = timeit.Timer(round_trip)
+    number, _ = timer.autorange()
+    # Two expenses per round
+    times = [t / number / 2 for t in timer.repeat(repeat, number)]
+    return min(times), statistics.mean(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--members", type=int, nargs="+", default=[10, 100, 1000]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for members in args.members:
+        best, mean = run(members, args.repeat, args.seed)
+        print(
+            f"{members} members: min {best * 1e6:.1f} us, "
+            f"mean {mean * 1e6:.1f} us per expense, "
+            f"{1 / best:.0f} expenses/sec, "
+            f"{best / members * 1e9:.0f} ns per member"
+        )
+
+
+if __name__ == "__main__":
+    main()
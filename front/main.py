@@ -1,10 +1,45 @@
+import uuid
+
 import streamlit as st
 import requests
-import math
 
 # Base URL for the FastAPI server
 BASE_URL = "http://localhost:8000"
 
+# The API takes and returns money in kopecks, the pages use roubles
+KOPECKS = 100
+
+
+def to_kopecks(roubles):
+    return round(roubles * KOPECKS)
+
+
+def format_roubles(kopecks):
+    return f"{kopecks / KOPECKS:.2f}₽"
+
+
+def idempotency_key(form):
+    # One random key per form, kept across reruns until the form goes
+    # through. A double-click or a retry after an error sends the same key
+    # and the API runs it once.
+    keys = st.session_state.setdefault("idempotency_keys", {})
+    if form not in keys:
+        keys[form] = str(uuid.uuid4())
+    return keys[form]
+
+
+def renew_idempotency_key(form):
+    # The next submission of the form is a new request
+    st.session_state.setdefault("idempotency_keys", {}).pop(form, None)
+
+
+def settle_idempotency_key(form, response):
+    # Only a conflict with a concurrent duplicate and server errors are
+    # worth retrying with the key. Any other answer is final, including
+    # the 422 for a key whose first response never reached us.
+    if response.status_code != 409 and response.status_code < 500:
+        renew_idempotency_key(form)
+
 
 def register(email, username, password):
     endpoint = f"{BASE_URL}/users"
@@ -65,14 +100,8 @@ def get_user(user_id):
     return response.json()
 
 
-def get_group(group_id):
-    endpoint = f"{BASE_URL}/groups/{group_id}"
-    response = requests.get(endpoint)
-    return response.json()
-
-
-def get_group_depts(group_id):
-    endpoint = f"{BASE_URL}/dept/{group_id}"
+def get_group_dashboard(group_id):
+    endpoint = f"{BASE_URL}/groups/{group_id}/dashboard"
     response = requests.get(endpoint)
     return response.json()
 
@@ -101,15 +130,17 @@ def create_expense(group_id, created_by, amount, description):
         st.error("Amount should be a positive number")
         return
     endpoint = f"{BASE_URL}/expenses"
+    data = {
+        "group_id": group_id,
+        "created_by": created_by,
+        "amount": to_kopecks(amount),
+        "description": description,
+    }
+    form = f"expense/{group_id}"
     response = requests.post(
-        endpoint,
-        json={
-            "group_id": group_id,
-            "created_by": created_by,
-            "amount": amount,
-            "description": description,
-        },
+        endpoint, json=data, headers={"Idempotency-Key": idempotency_key(form)}
     )
+    settle_idempotency_key(form, response)
     if response.status_code != 200:
         st.error("Couldn't create expense")
         return
@@ -134,9 +165,7 @@ def members_display(group):
     )
     st.write("<br>", unsafe_allow_html=True)
     st.subheader("Members")
-    members = [
-        get_user(m["user_id"])["username"] for m in group["groupmembers"]
-    ]
+    members = [m["username"] for m in group["members"]]
     ul_markdown = "\n".join([f"- {item}" for item in members])
     st.write(ul_markdown, unsafe_allow_html=True)
 
@@ -149,7 +178,7 @@ def pay_expense_fn(expense_id, user_id, amount_paid):
             json={
                 "expense_id": expense_id,
                 "user_id": user_id,
-                "amount_paid": amount_paid,
+                "amount_paid": to_kopecks(amount_paid),
             },
         )
         if response.status_code != 200:
@@ -165,12 +194,15 @@ def pay_expense_fn(expense_id, user_id, amount_paid):
 def pay_dept_fn(amount_paid, dept):
     def callback():
         endpoint = f"{BASE_URL}/dept/{dept['dept_id']}"
+        form = f"pay/{dept['dept_id']}"
         response = requests.patch(
             endpoint,
             json={
-                "amount": amount_paid,
+                "amount": to_kopecks(amount_paid),
             },
+            headers={"Idempotency-Key": idempotency_key(form)},
         )
+        settle_idempotency_key(form, response)
         if response.status_code != 200:
             st.error("FAIL")
             return {}
@@ -181,6 +213,24 @@ def pay_dept_fn(amount_paid, dept):
     return callback
 
 
+def simplify_depts_fn(group_id):
+    def callback():
+        endpoint = f"{BASE_URL}/dept/{group_id}/simplify"
+        response = requests.post(endpoint, params={"persist": True})
+        if response.status_code != 200:
+            st.error("Couldn't simplify depts")
+            return {}
+
+        st.success(
+            "Depts simplified to {} payments".format(
+                response.json()["depts_after"]
+            )
+        )
+        return {}
+
+    return callback
+
+
 def delete_expense_fn(expense_id):
     def x():
         endpoint = f"{BASE_URL}/expenses/{expense_id}"
@@ -216,13 +266,16 @@ def name_columns(columns, column_names):
 
 
 def expenses_display(group):
-    st.subheader(f"Total expenses: {group['total_expenses']}₽")
-    amount = st.number_input("Amount (₽)", placeholder="₽", step=1)
+    st.subheader(f"Total expenses: {format_roubles(group['total_expenses'])}")
+    amount = st.number_input("Amount (₽)", placeholder="₽", step=0.01)
     desc = st.text_input("Description", placeholder="some description")
     st.button(
         "Create",
         on_click=lambda: create_expense(
-            group["group_id"], st.session_state.user_id, amount, desc
+            group["group_id"],
+            st.session_state.user_id,
+            amount,
+            desc,
         ),
         key="expense_create_btn",
     )
@@ -232,11 +285,11 @@ def expenses_display(group):
         st.columns([0.15, 0.7, 0.15]),
         ["amount", "description", "delete"],
     )
-    for e in group["groupexpenses"]:
+    for e in group["expenses"]:
         st.write("<hr style='margin: 0;'>", unsafe_allow_html=True)
         amount_col, desc_col, del_col = st.columns([0.15, 0.7, 0.15])
         with amount_col:
-            st.markdown(f"**{e['amount']}₽**")
+            st.markdown(f"**{format_roubles(e['amount'])}**")
 
         with desc_col:
             st.text(e["description"])
@@ -252,7 +305,12 @@ def expenses_display(group):
 def depts_display(group):
     st.subheader("Depts")
 
-    depts = get_group_depts(group["group_id"])
+    depts = group["depts"]
+    st.button(
+        "Simplify",
+        key="simplify_depts_btn",
+        on_click=simplify_depts_fn(group["group_id"]),
+    )
 
     name_columns(
         st.columns([0.15, 0.25, 0.25, 0.35]),
@@ -265,22 +323,20 @@ def depts_display(group):
         )
 
         with amount_col:
-            st.markdown(f"**{math.ceil(dept['amount'])}₽**")
+            st.markdown(f"**{format_roubles(dept['amount'])}**")
 
         with user_col:
-            user = get_user(dept["user_id"])
-            st.text(user["username"])
+            st.text(dept["username"])
 
         with lender_col:
-            lender = get_user(dept["lender_id"])
-            st.text(lender["username"])
+            st.text(dept["lender_username"])
 
         with pay_col:
             input_col, btn_col = st.columns(2)
             with input_col:
                 amount_paid = st.number_input(
                     "Amount (₽)",
-                    step=1,
+                    step=0.01,
                     key=f"user_{dept['user_id']}_lender_{dept['lender_id']}",
                     placeholder="₽",
                 )
@@ -293,7 +349,8 @@ def depts_display(group):
 
 
 def a_group_display(group):
-    group = get_group(group["group_id"])
+    # One request renders every tab of the group
+    group = get_group_dashboard(group["group_id"])
     st.title(group["group_name"])
 
     mode = st.radio(
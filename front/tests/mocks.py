@@ -63,8 +63,8 @@ def get_user_by_username_mock():
 
 
 @pytest.fixture
-def get_group_mock():
-    with patch("front.main.get_group") as mock:
+def get_group_dashboard_mock():
+    with patch("front.main.get_group_dashboard") as mock:
         yield mock
 
 
@@ -98,6 +98,24 @@ def st_session_state_mock():
         yield mock
 
 
+@pytest.fixture
+def session_state():
+    with patch("front.main.st.session_state", {}) as state:
+        yield state
+
+
+@pytest.fixture
+def idempotency_key_mock():
+    with patch("front.main.idempotency_key") as mock:
+        yield mock
+
+
+@pytest.fixture
+def renew_idempotency_key_mock():
+    with patch("front.main.renew_idempotency_key") as mock:
+        yield mock
+
+
 @pytest.fixture
 def profile_display_mock():
     with patch("front.main.profile_display") as mock:
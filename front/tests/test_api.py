@@ -6,11 +6,15 @@ from front.main import (
     get_user_expenses,
     get_user_by_username,
     get_user,
-    get_group,
+    get_group_dashboard,
     pay_dept_fn,
+    simplify_depts_fn,
     name_columns,
-    get_group_depts,
     get_user_depts,
+    to_kopecks,
+    format_roubles,
+    idempotency_key,
+    renew_idempotency_key,
     BASE_URL,
 )
 
@@ -83,21 +87,24 @@ def test_get_user(requests_mock):
     assert user == response_json
 
 
-def test_get_group(requests_mock):
+def test_get_group_dashboard(requests_mock):
     group_id = 1
-    response_json = {"group_id": 1, "name": "Group 1"}
+    response_json = {"group_id": 1, "members": [], "depts": []}
     requests_mock.get.return_value.json.return_value = response_json
 
-    group = get_group(group_id)
+    dashboard = get_group_dashboard(group_id)
 
-    requests_mock.get.assert_called_once_with(f"{BASE_URL}/groups/{group_id}")
+    requests_mock.get.assert_called_once_with(
+        f"{BASE_URL}/groups/{group_id}/dashboard"
+    )
 
-    assert group == response_json
+    assert dashboard == response_json
 
 
-def test_pay_dept_fn_success(requests_mock, st_success_mock):
+def test_pay_dept_fn_success(requests_mock, st_success_mock, session_state):
     amount_paid = 100
-    dept = {"dept_id": 123}
+    dept = {"dept_id": 123, "amount": 50000}
+    key = idempotency_key("pay/123")
 
     requests_mock.patch.return_value.status_code = 200
 
@@ -105,16 +112,21 @@ def test_pay_dept_fn_success(requests_mock, st_success_mock):
     result = callback()
 
     requests_mock.patch.assert_called_once_with(
-        f"{BASE_URL}/dept/123", json={"amount": amount_paid}
+        f"{BASE_URL}/dept/123",
+        json={"amount": amount_paid * 100},
+        headers={"Idempotency-Key": key},
     )
     st_success_mock.assert_called_once_with("OK")
+    # The next payment is a new request
+    assert idempotency_key("pay/123") != key
 
     assert result == {}
 
 
-def test_pay_dept_fn_failure(requests_mock, st_error_mock):
+def test_pay_dept_fn_failure(requests_mock, st_error_mock, session_state):
     amount_paid = 100
-    dept = {"dept_id": 123}
+    dept = {"dept_id": 123, "amount": 50000}
+    key = idempotency_key("pay/123")
 
     requests_mock.patch.return_value.status_code = 500
 
@@ -122,10 +134,49 @@ def test_pay_dept_fn_failure(requests_mock, st_error_mock):
     result = callback()
 
     requests_mock.patch.assert_called_once_with(
-        f"{BASE_URL}/dept/123", json={"amount": amount_paid}
+        f"{BASE_URL}/dept/123",
+        json={"amount": amount_paid * 100},
+        headers={"Idempotency-Key": key},
     )
 
     st_error_mock.assert_called_once_with("FAIL")
+    # A retry sends the same key
+    assert idempotency_key("pay/123") == key
+    assert result == {}
+
+
+def test_pay_dept_fn_key_reused(requests_mock, st_error_mock, session_state):
+    key = idempotency_key("pay/123")
+
+    requests_mock.patch.return_value.status_code = 422
+
+    pay_dept_fn(100, {"dept_id": 123, "amount": 50000})()
+
+    st_error_mock.assert_called_once_with("FAIL")
+    assert idempotency_key("pay/123") != key
+
+
+def test_simplify_depts_fn_success(requests_mock, st_success_mock):
+    group_id = 1
+    requests_mock.post.return_value.status_code = 200
+    requests_mock.post.return_value.json.return_value = {"depts_after": 2}
+
+    result = simplify_depts_fn(group_id)()
+
+    requests_mock.post.assert_called_once_with(
+        f"{BASE_URL}/dept/{group_id}/simplify", params={"persist": True}
+    )
+    st_success_mock.assert_called_once_with("Depts simplified to 2 payments")
+
+    assert result == {}
+
+
+def test_simplify_depts_fn_failure(requests_mock, st_error_mock):
+    requests_mock.post.return_value.status_code = 404
+
+    result = simplify_depts_fn(1)()
+
+    st_error_mock.assert_called_once_with("Couldn't simplify depts")
     assert result == {}
 
 
@@ -148,24 +199,6 @@ def test_name_columns(st_text_mock):
     assert st_text_mock.call_count == len(column_names)
 
 
-def test_get_group_depts(requests_mock):
-    group_id = 123
-    response_data = [
-        {"dept_id": 1, "amount": 100},
-        {"dept_id": 2, "amount": 200},
-    ]
-    expected_response = response_data
-
-    requests_mock.get.return_value.status_code = 200
-    requests_mock.get.return_value.json.return_value = response_data
-
-    result = get_group_depts(group_id)
-
-    requests_mock.get.assert_called_once_with(f"{BASE_URL}/dept/{group_id}")
-
-    assert result == expected_response
-
-
 def test_get_user_depts(requests_mock):
     group_id = 123
     user_id = 456
@@ -185,3 +218,23 @@ def test_get_user_depts(requests_mock):
     )
 
     assert result == expected_response
+
+
+def test_to_kopecks():
+    assert to_kopecks(12.34) == 1234
+    assert to_kopecks(0.1 + 0.2) == 30
+
+
+def test_format_roubles():
+    assert format_roubles(1234) == "12.34₽"
+    assert format_roubles(5) == "0.05₽"
+
+
+def test_idempotency_key(session_state):
+    key = idempotency_key("pay/1")
+
+    assert idempotency_key("pay/1") == key
+    assert idempotency_key("pay/2") != key
+
+    renew_idempotency_key("pay/1")
+    assert idempotency_key("pay/1") != key
@@ -45,7 +45,7 @@ def test_pay_expense_fn_success(requests_mock, st_success_mock):
         json={
             "expense_id": expense_id,
             "user_id": user_id,
-            "amount_paid": amount_paid,
+            "amount_paid": amount_paid * 100,
         },
     )
 
@@ -68,7 +68,7 @@ def test_pay_expense_fn_error(requests_mock, st_error_mock):
         json={
             "expense_id": expense_id,
             "user_id": user_id,
-            "amount_paid": amount_paid,
+            "amount_paid": amount_paid * 100,
         },
     )
 
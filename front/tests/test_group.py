@@ -2,6 +2,7 @@ from front.main import (
     add_member,
     create_expense,
     create_group,
+    idempotency_key,
     a_group_display,
     BASE_URL,
 )
@@ -51,7 +52,11 @@ def test_add_member_error_response(
 
 
 def test_create_expense_success(
-    requests_mock, st_success_mock, st_session_state_mock
+    requests_mock,
+    st_success_mock,
+    st_session_state_mock,
+    idempotency_key_mock,
+    renew_idempotency_key_mock,
 ):
     group_id = 1
     created_by = 1
@@ -63,17 +68,22 @@ def test_create_expense_success(
     requests_mock.post.return_value.json.return_value = response_json
     st_session_state_mock.username = username
 
+    idempotency_key_mock.return_value = "key"
+
     create_expense(group_id, created_by, amount, description)
 
+    idempotency_key_mock.assert_called_once_with(f"expense/{group_id}")
     requests_mock.post.assert_called_once_with(
         f"{BASE_URL}/expenses",
         json={
             "group_id": group_id,
             "created_by": created_by,
-            "amount": amount,
+            "amount": amount * 100,
             "description": description,
         },
+        headers={"Idempotency-Key": "key"},
     )
+    renew_idempotency_key_mock.assert_called_once_with(f"expense/{group_id}")
 
     st_success_mock.assert_called_once_with(
         f"Expense with {amount} roubles by {username} was created"
@@ -99,6 +109,24 @@ def test_create_expense_error_response(requests_mock, st_error_mock):
     st_error_mock.assert_called_once_with("Couldn't create expense")
 
 
+def test_create_expense_key_reused(
+    requests_mock, st_error_mock, session_state
+):
+    key = idempotency_key("expense/1")
+    # The key went through before, but its response was lost and the
+    # amount was edited since
+    requests_mock.post.return_value.status_code = 422
+
+    create_expense(1, 1, 200, "Test expense")
+
+    assert requests_mock.post.call_args.kwargs["headers"] == {
+        "Idempotency-Key": key
+    }
+    st_error_mock.assert_called_once_with("Couldn't create expense")
+    # The next submit is sent with a new key
+    assert idempotency_key("expense/1") != key
+
+
 def test_create_group_success(requests_mock):
 
     group_name = "Test Group"
@@ -131,11 +159,14 @@ def test_create_group_error_response(requests_mock):
 
 
 def test_a_group_display_members(
-    get_group_mock, st_radio_mock, members_display_mock, expenses_display_mock
+    get_group_dashboard_mock,
+    st_radio_mock,
+    members_display_mock,
+    expenses_display_mock,
 ):
     group_id = 123
     group_data = {"group_id": group_id, "group_name": "Test Group"}
-    get_group_mock.return_value = group_data
+    get_group_dashboard_mock.return_value = group_data
 
     st_radio_mock.return_value = "Members"
 
@@ -147,11 +178,14 @@ def test_a_group_display_members(
 
 
 def test_a_group_display_expenses(
-    get_group_mock, st_radio_mock, members_display_mock, expenses_display_mock
+    get_group_dashboard_mock,
+    st_radio_mock,
+    members_display_mock,
+    expenses_display_mock,
 ):
     group_id = 123
     group_data = {"group_id": group_id, "group_name": "Test Group"}
-    get_group_mock.return_value = group_data
+    get_group_dashboard_mock.return_value = group_data
 
     st_radio_mock.return_value = "Expenses"
 
@@ -160,3 +194,18 @@ def test_a_group_display_expenses(
     expenses_display_mock.assert_called_once_with(group_data)
 
     members_display_mock.assert_not_called()
+
+
+def test_a_group_display_single_request(
+    get_group_dashboard_mock,
+    st_radio_mock,
+    members_display_mock,
+    expenses_display_mock,
+):
+    group_data = {"group_id": 123, "group_name": "Test Group"}
+    get_group_dashboard_mock.return_value = group_data
+    st_radio_mock.return_value = "Members"
+
+    a_group_display({"group_id": 123})
+
+    get_group_dashboard_mock.assert_called_once_with(123)